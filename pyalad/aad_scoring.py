@@ -0,0 +1,412 @@
+import os
+import json
+import numpy as np
+from scipy.sparse import csr_matrix, vstack, issparse
+
+from app_globals import IFOR_SCORE_TYPE_CONST, HST_SCORE_TYPE, RSF_SCORE_TYPE, \
+    RSF_LOG_SCORE_TYPE, ORIG_TREE_SCORE_TYPE, ENSEMBLE_SCORE_LINEAR, ENSEMBLE_SCORE_EXPONENTIAL
+
+"""
+Scoring-only path for forest models saved with save_aad_model_arrays().
+
+This module only needs numpy and scipy.sparse, hence processes which just
+load a saved model and score instances do not pay for importing the
+optimizers, sklearn or pandas. The trees are traversed directly on the
+(memory-mapped) model arrays.
+
+Usage:
+    model = load_aad_scoring_model(dirpath)
+    scores = model.score(x)  # same as AadForest.get_score(AadForest.transform_to_region_features(x))
+
+Large datasets are scored out-of-core in row chunks. Peak memory depends
+on the chunk size and topK, not on the number of rows:
+
+    chunks = iter_csv_chunks(datafile, chunk_size=100000)
+    scores, top_ids, top_scores = score_in_chunks(model, chunks, topK=1000,
+                                                  scores_path="scores.dat")
+    # scores is a read-only np.memmap of float64 over scores.dat
+"""
+
+AAD_MODEL_ARRAYS_FORMAT_VERSION = 1
+
+AAD_MODEL_TREE_ARRAYS = ["children_left", "children_right", "feature", "threshold",
+                         "n_node_samples", "n_node_samples_buffer", "v", "acc_log_v"]
+
+AAD_MODEL_REGION_ARRAYS = ["path_length", "node_id", "score", "node_samples",
+                           "log_frac_vol", "tree"]
+
+
+def load_aad_model_meta(dirpath):
+    metapath = os.path.join(dirpath, "meta.json")
+    if not os.path.isfile(metapath):
+        raise ValueError("Model metadata not found: %s" % metapath)
+    with open(metapath, 'r') as f:
+        meta = json.load(f)
+    if meta["format_version"] > AAD_MODEL_ARRAYS_FORMAT_VERSION:
+        raise ValueError("Unsupported model format version %d (max supported %d)" %
+                         (meta["format_version"], AAD_MODEL_ARRAYS_FORMAT_VERSION))
+    return meta
+
+
+def load_aad_model_array(dirpath, name, mmap_mode='r'):
+    return np.load(os.path.join(dirpath, "%s.npy" % name), mmap_mode=mmap_mode)
+
+
+class SparseElementLookup(object):
+    """ Vectorized lookup of the elements X[rows[i], cols[i]] of a sparse matrix
+
+    The nonzeros are keyed by their position in the row-major (CSR) or
+    column-major (CSC) order and the keys are binary searched, hence a
+    lookup never densifies a row or a column. Elements that are not stored
+    (implicit zeros) are 0.
+
+    Build it once per matrix and pass it instead of X to get_tree_leaves()
+    and get_tree_paths() to traverse many trees.
+    """
+    def __init__(self, X):
+        if X.format != "csr" and X.format != "csc":
+            X = X.tocsr()
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        self.shape = X.shape
+        self.format = X.format
+        major = np.repeat(np.arange(len(X.indptr) - 1, dtype=np.int64), np.diff(X.indptr))
+        self.keys = major * self._minor_dim() + X.indices
+        self.data = X.data
+
+    def _minor_dim(self):
+        return self.shape[1] if self.format == "csr" else self.shape[0]
+
+    def get(self, rows, cols):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        if self.format == "csr":
+            q = rows * self._minor_dim() + cols
+        else:
+            q = cols * self._minor_dim() + rows
+        vals = np.zeros(len(q), dtype=float)
+        if len(self.keys) == 0:
+            return vals
+        pos = np.minimum(np.searchsorted(self.keys, q), len(self.keys) - 1)
+        found = self.keys[pos] == q
+        vals[found] = self.data[pos[found]]
+        return vals
+
+
+def get_element_lookup(X):
+    """ Returns X as dense array, or a SparseElementLookup if X is sparse """
+    if isinstance(X, SparseElementLookup):
+        return X
+    if issparse(X):
+        return SparseElementLookup(X)
+    return np.asarray(X)
+
+
+def get_elements(X, rows, cols):
+    """ Returns X[rows, cols] where X is returned by get_element_lookup() """
+    if isinstance(X, SparseElementLookup):
+        return X.get(rows, cols)
+    return X[rows, cols]
+
+
+def get_tree_leaves(children_left, children_right, feature, threshold, X):
+    """Returns the leaf node index for each instance (row) of X
+
+    All instances are moved down the tree together, one level at a time.
+    X might be dense, scipy.sparse or a SparseElementLookup.
+    """
+    X = get_element_lookup(X)
+    n = X.shape[0]
+    rows = np.arange(n)
+    nodes = np.zeros(n, dtype=int)
+    active = rows[children_left[nodes] != -1]
+    while len(active) > 0:
+        curr = nodes[active]
+        v = get_elements(X, active, feature[curr])
+        nodes[active] = np.where(v <= threshold[curr], children_left[curr], children_right[curr])
+        active = active[children_left[nodes[active]] != -1]
+    return nodes
+
+
+def get_tree_paths(children_left, children_right, feature, threshold, X):
+    """Returns the nodes below the root through which each instance (row) of X passes
+
+    :return: (np.array, np.array, np.array)
+        (rows, nodes, path_lengths) where (rows[i], nodes[i]) are pairs of
+        instance and node, and path_lengths[j] is the number of nodes in the
+        path of instance j (the root is not included, as in
+        AadForest.decision_path_full())
+    """
+    X = get_element_lookup(X)
+    n = X.shape[0]
+    nodes = np.zeros(n, dtype=int)
+    active = np.arange(n)[children_left[nodes] != -1]
+    path_rows = []
+    path_nodes = []
+    while len(active) > 0:
+        curr = nodes[active]
+        v = get_elements(X, active, feature[curr])
+        nodes[active] = np.where(v <= threshold[curr], children_left[curr], children_right[curr])
+        path_rows.append(active)
+        path_nodes.append(nodes[active])
+        active = active[children_left[nodes[active]] != -1]
+    if len(path_rows) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(n, dtype=int)
+    path_rows = np.concatenate(path_rows)
+    return path_rows, np.concatenate(path_nodes), np.bincount(path_rows, minlength=n)
+
+
+class AadScoringModel(object):
+    """ Scoring-only forest model over the arrays of the compact model format
+
+    Attributes:
+        meta: dict
+            contents of meta.json
+        tree_offsets: np.array
+            nodes of tree i are at [tree_offsets[i], tree_offsets[i+1])
+        children_left, children_right, feature, threshold: np.array
+            node arrays of all trees concatenated
+        node_regions: np.array
+            region id of each node (-1 if the node is not a region)
+        d: np.array
+            region scores
+        w: np.array
+            region weights
+    """
+    def __init__(self, meta, tree_offsets, children_left, children_right, feature, threshold,
+                 node_regions, d, w):
+        self.meta = meta
+        self.tree_offsets = tree_offsets
+        self.children_left = children_left
+        self.children_right = children_right
+        self.feature = feature
+        self.threshold = threshold
+        self.node_regions = node_regions
+        self.d = d
+        self.w = w
+        self.score_type = meta["score_type"]
+        self.ensemble_score = meta["ensemble_score"]
+        self.add_leaf_nodes_only = meta["add_leaf_nodes_only"]
+        if self.score_type == ORIG_TREE_SCORE_TYPE:
+            raise ValueError("Score type %d not supported for region features" % self.score_type)
+
+    def get_num_trees(self):
+        return len(self.tree_offsets) - 1
+
+    def get_tree_arrays(self, i):
+        start, end = self.tree_offsets[i], self.tree_offsets[i + 1]
+        return (self.children_left[start:end], self.children_right[start:end],
+                self.feature[start:end], self.threshold[start:end])
+
+    def apply(self, x):
+        """ Returns the leaf node (tree-local index) of each instance in each tree
+
+        :return: np.ndarray of shape (n, n_trees)
+        """
+        x = get_element_lookup(x)
+        leaves = np.zeros((x.shape[0], self.get_num_trees()), dtype=int)
+        for i in range(self.get_num_trees()):
+            left, right, feature, threshold = self.get_tree_arrays(i)
+            leaves[:, i] = get_tree_leaves(left, right, feature, threshold, x)
+        return leaves
+
+    def _region_values(self, regions, path_lengths):
+        if (self.score_type == IFOR_SCORE_TYPE_CONST or
+                self.score_type == HST_SCORE_TYPE or
+                self.score_type == RSF_SCORE_TYPE or
+                self.score_type == RSF_LOG_SCORE_TYPE):
+            return np.asarray(self.d[regions], dtype=float)
+        return self.d[regions] / path_lengths
+
+    def transform_to_region_features(self, x, batch_size=10000):
+        """ Same as AadForest.transform_to_region_features(x, dense=False) """
+        n = x.shape[0]
+        m = len(self.d)
+        batches = []
+        for start in range(0, n, batch_size):
+            x_tmp = get_element_lookup(x[start:min(n, start + batch_size), :])
+            all_rows = []
+            all_cols = []
+            all_vals = []
+            for i in range(self.get_num_trees()):
+                left, right, feature, threshold = self.get_tree_arrays(i)
+                if self.add_leaf_nodes_only:
+                    nodes = get_tree_leaves(left, right, feature, threshold, x_tmp)
+                    rows = np.arange(x_tmp.shape[0])
+                    path_lengths = np.ones(len(rows), dtype=float)
+                else:
+                    rows, nodes, lengths = get_tree_paths(left, right, feature, threshold, x_tmp)
+                    path_lengths = np.asarray(lengths[rows], dtype=float)
+                regions = self.node_regions[self.tree_offsets[i] + nodes]
+                all_rows.append(rows)
+                all_cols.append(regions)
+                all_vals.append(self._region_values(regions, path_lengths))
+            x_new = csr_matrix((np.concatenate(all_vals),
+                                (np.concatenate(all_rows), np.concatenate(all_cols))),
+                               shape=(x_tmp.shape[0], m))
+            x_new.eliminate_zeros()
+            batches.append(x_new)
+        if len(batches) == 0:
+            return csr_matrix((0, m), dtype=float)
+        if len(batches) == 1:
+            return batches[0]
+        return vstack(batches).tocsr()
+
+    def get_score(self, x_new, w=None):
+        """ Scores instances already transformed to region features; higher is more anomalous """
+        if w is None:
+            w = self.w
+        if self.ensemble_score == ENSEMBLE_SCORE_LINEAR:
+            return x_new.dot(w)
+        elif self.ensemble_score == ENSEMBLE_SCORE_EXPONENTIAL:
+            return np.exp(x_new.dot(w))
+        else:
+            raise NotImplementedError("ensemble_score %d not implemented!" % self.ensemble_score)
+
+    def score(self, x, w=None):
+        return self.get_score(self.transform_to_region_features(x), w)
+
+
+def load_aad_scoring_model(dirpath, mmap_mode='r'):
+    """ Loads only the arrays needed for scoring from a model saved by save_aad_model_arrays """
+    meta = load_aad_model_meta(dirpath)
+    arrays = dict([(name, load_aad_model_array(dirpath, name, mmap_mode=mmap_mode))
+                   for name in ["tree_offsets", "children_left", "children_right",
+                                "feature", "threshold", "node_regions", "d", "w"]])
+    return AadScoringModel(meta, **arrays)
+
+
+def iter_array_chunks(x, chunk_size=100000):
+    """ Yields consecutive row chunks of x (e.g., a np.memmap or a csr_matrix)
+
+    Dense chunks are returned as arrays and sparse chunks stay sparse.
+    """
+    n = x.shape[0]
+    for start in range(0, n, chunk_size):
+        chunk = x[start:min(n, start + chunk_size), :]
+        yield chunk if issparse(chunk) else np.asarray(chunk)
+
+
+def iter_csv_chunks(filepath, chunk_size=100000, skip_cols=1, header=True):
+    """ Yields row chunks of a CSV file of numbers without reading all of it
+
+    :param skip_cols: int
+        number of leading columns (e.g., the label column of the data files
+        read by read_labeled_csv()) which are not features
+    """
+    with open(filepath, 'r') as f:
+        if header:
+            f.readline()
+        rows = []
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            rows.append([float(v) for v in line.split(",")[skip_cols:]])
+            if len(rows) == chunk_size:
+                yield np.array(rows, dtype=float)
+                rows = []
+        if len(rows) > 0:
+            yield np.array(rows, dtype=float)
+
+
+class TopKSelector(object):
+    """ Keeps the k highest scores seen so far, with their row ids
+
+    Every chunk is merged with the current candidates and cut back to k with
+    np.argpartition, so memory is O(k + chunk size) and no full sort is done.
+
+    Attributes:
+        k: int
+        ids: np.array(dtype=int)
+            row ids of the current candidates (not ordered)
+        scores: np.array
+            scores of the current candidates
+    """
+    def __init__(self, k):
+        if k < 0:
+            raise ValueError("k must be non-negative, found %d" % k)
+        self.k = k
+        self.ids = np.zeros(0, dtype=int)
+        self.scores = np.zeros(0, dtype=float)
+
+    def add(self, scores, start=0, ids=None):
+        """ Adds the scores of a chunk
+
+        :param start: int
+            row id of the first score; ignored if ids is not None
+        """
+        if self.k == 0 or len(scores) == 0:
+            return
+        if ids is None:
+            ids = np.arange(start, start + len(scores), dtype=int)
+        # only the top k of the chunk can make it to the candidates
+        scores = np.asarray(scores, dtype=float)
+        if len(scores) > self.k:
+            top = np.argpartition(-scores, self.k - 1)[0:self.k]
+            scores, ids = scores[top], ids[top]
+        all_scores = np.append(self.scores, scores)
+        all_ids = np.append(self.ids, ids)
+        if len(all_scores) > self.k:
+            top = np.argpartition(-all_scores, self.k - 1)[0:self.k]
+            all_scores, all_ids = all_scores[top], all_ids[top]
+        self.scores, self.ids = all_scores, all_ids
+
+    def get_top(self):
+        """ Returns (ids, scores) in decreasing order of scores """
+        idxs = np.argsort(-self.scores, kind="mergesort")
+        return self.ids[idxs], self.scores[idxs]
+
+
+def iter_chunk_scores(model, chunks):
+    """ Scores each chunk of rows as it arrives
+
+    :param model: AadScoringModel or AadForest
+        any model with score(x)
+    :param chunks: iterable of np.ndarray
+        row chunks in the original feature space
+    :return: generator of (start, scores)
+        start is the row id of the first row of the chunk
+    """
+    start = 0
+    for x in chunks:
+        scores = model.score(x)
+        yield start, scores
+        start += x.shape[0]
+
+
+def score_in_chunks(model, chunks, topK=0, scores_path=None):
+    """ Scores row chunks from any source with memory bounded by the chunk size
+
+    :param chunks: iterable of np.ndarray
+        e.g., iter_array_chunks() or iter_csv_chunks()
+    :param topK: int
+        number of highest scoring rows to select
+    :param scores_path: str
+        if not None, the scores of all rows are written to this file as raw
+        float64 and returned as a read-only np.memmap
+    :return: (np.memmap, np.array, np.array)
+        (scores or None, ids of the topK rows, their scores); the topK rows
+        are in decreasing order of scores
+    """
+    selector = TopKSelector(topK)
+    n = 0
+    f = None if scores_path is None else open(scores_path, 'wb')
+    try:
+        for start, scores in iter_chunk_scores(model, chunks):
+            scores = np.asarray(scores, dtype=np.float64)
+            if f is not None:
+                scores.tofile(f)
+            selector.add(scores, start=start)
+            n = start + len(scores)
+    finally:
+        if f is not None:
+            f.close()
+    all_scores = None
+    if scores_path is not None and n > 0:
+        all_scores = np.memmap(scores_path, dtype=np.float64, mode='r', shape=(n,))
+    elif scores_path is not None:
+        all_scores = np.zeros(0, dtype=np.float64)
+    top_ids, top_scores = selector.get_top()
+    return all_scores, top_ids, top_scores
@@ -0,0 +1,372 @@
+import os
+import stat
+import json
+import threading
+import numpy as np
+
+import logging
+
+try:
+    import BaseHTTPServer
+    import SocketServer as socketserver
+except ImportError:
+    import http.server as BaseHTTPServer
+    import socketserver
+
+from app_globals import *
+from forest_aad_detector import *
+from forest_aad_stream import prepare_aad_model
+
+"""
+Long-running local service which keeps an AadForest, the transformed pool
+of unlabeled instances and the feedback in memory, so that scoring and
+labeling do not pay for loading the model or transforming the data again.
+
+The service listens on localhost (--service_host, --service_port) or on a
+Unix socket (--service_socket) and only needs the python standard library.
+All requests and responses are JSON:
+
+    GET  /status                               -> pool size, #labeled, ...
+    POST /score    {"x": [[...], ...]}         -> {"scores": [...]}
+    POST /queries  {"n": 5}                    -> {"queries": [...], "scores": [...]}
+    POST /label    {"index": [...], "label": [...]}
+                                               -> updates the weights with all feedback so far
+    POST /ingest   {"x": [[...], ...], "update_model": true}
+                                               -> adds a stream window to the pool and the tree counts
+    POST /snapshot {"path": "...", "arrays": false}
+                                               -> saves the model (default path: --modelfile)
+
+Requests are served in parallel threads. Scoring, queries and snapshots
+hold a shared (read) lock, while labels and ingests which change the
+weights and the trees hold an exclusive (write) lock.
+
+To run:
+    python pyalad/aad_service.py --dataset=toy2 --datafile=... --resultsdir=... \
+        --detector_type=7 --forest_add_leaf_nodes_only --service_port=8765 ...
+
+    curl -d '{"n": 3}' http://127.0.0.1:8765/queries
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class _LockContext(object):
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+
+class ReadWriteLock(object):
+    """ Allows either many readers or a single writer
+
+    Writers are preferred: once a writer waits, new readers wait till it
+    is done, so that a steady stream of score requests cannot starve the
+    label updates.
+
+    Usage:
+        with lock.read_locked():
+            ...
+        with lock.write_locked():
+            ...
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers > 0:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers > 0:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    def read_locked(self):
+        return _LockContext(self.acquire_read, self.release_read)
+
+    def write_locked(self):
+        return _LockContext(self.acquire_write, self.release_write)
+
+
+class AadService(object):
+    """ Scoring and labeling on a warm AadForest
+
+    Attributes:
+        model: AadForest
+        opts: Opts
+        x: np.ndarray
+            pool of instances (original feature space) which can be queried;
+            the ingested stream windows are appended to the pool
+        x_transformed: csr_matrix or RegionIndexMatrix
+            pool transformed to region features
+        y: np.array(dtype=int)
+            labels; only the values at the labeled indexes are relevant
+        labeled: MarkedSet
+            labeled pool indexes
+        ha: list
+            pool indexes labeled as anomalies
+        hn: list
+            pool indexes labeled as nominals
+        lock: ReadWriteLock
+            guards the model weights, trees and the pool
+    """
+    def __init__(self, model, opts, x):
+        self.model = model
+        self.opts = opts
+        self.x = np.asarray(x, dtype=float)
+        self.x_transformed = self.transform(self.x)
+        self.y = np.zeros(self.x.shape[0], dtype=int)
+        self.labeled = MarkedSet(self.x.shape[0])
+        self.ha = []
+        self.hn = []
+        self.lock = ReadWriteLock()
+        self.n_updates = 0
+
+    def transform(self, x):
+        if self.opts.forest_region_index:
+            return self.model.transform_to_region_index(x)
+        return self.model.transform_to_region_features(x, dense=False)
+
+    def score(self, x):
+        x = np.asarray(x, dtype=float)
+        if len(x.shape) != 2 or x.shape[1] != self.x.shape[1]:
+            raise ValueError("Expected instances with %d features" % self.x.shape[1])
+        with self.lock.read_locked():
+            return self.model.get_score(self.transform(x))
+
+    def get_next_queries(self, n=1):
+        """ Returns the n top ranked pool instances which have not been labeled yet """
+        with self.lock.read_locked():
+            ordered_idxs, scores = self.model.order_by_score(self.x_transformed)
+            queries = self.labeled.get_unmarked(ordered_idxs, n=n, start=0)
+            return queries, scores[queries]
+
+    def add_labels(self, indexes, labels):
+        """ Records the feedback and updates the weights with all feedback so far """
+        indexes = np.asarray(indexes, dtype=int).reshape(-1)
+        labels = np.asarray(labels, dtype=int).reshape(-1)
+        if len(indexes) != len(labels):
+            raise ValueError("Found %d indexes but %d labels" % (len(indexes), len(labels)))
+        with self.lock.write_locked():
+            n = self.x.shape[0]
+            if np.any(indexes < 0) or np.any(indexes >= n):
+                raise ValueError("Indexes must be in [0, %d)" % n)
+            for i, lbl in zip(indexes, labels):
+                if self.labeled.is_marked(i):
+                    continue
+                self.y[i] = lbl
+                self.labeled.mark(i)
+                if lbl == 1:
+                    self.ha.append(i)
+                else:
+                    self.hn.append(i)
+            self.model.update_weights(self.x_transformed, self.y, ha=self.ha, hn=self.hn,
+                                      opts=self.opts, w=self.model.w)
+            self.n_updates += 1
+            return len(self.ha), len(self.hn)
+
+    def ingest(self, x, update_model=False):
+        """ Adds a stream window to the pool and to the tree buffer counts
+
+        :param update_model: bool
+            whether to update the trees (and the region scores) from the buffer
+            counts; the whole pool is then transformed again
+        """
+        x = np.asarray(x, dtype=float)
+        if len(x.shape) != 2 or x.shape[1] != self.x.shape[1]:
+            raise ValueError("Expected instances with %d features" % self.x.shape[1])
+        with self.lock.write_locked():
+            self.model.add_samples(x, current=False)
+            self.x = np.vstack([self.x, x])
+            self.y = np.append(self.y, np.zeros(x.shape[0], dtype=int))
+            if update_model:
+                self.model.update_model_from_stream_buffer()
+                self.x_transformed = self.transform(self.x)
+            else:
+                self.x_transformed = vstack_region_features([self.x_transformed, self.transform(x)])
+            return self.x.shape[0]
+
+    def snapshot(self, path=None, arrays=False):
+        path = self.opts.modelfile if path is None else path
+        if path is None or path == "":
+            raise ValueError("No path for the snapshot; pass a path or set --modelfile")
+        with self.lock.read_locked():
+            if arrays:
+                save_aad_model_arrays(path, self.model)
+            else:
+                save_aad_model(path, self.model)
+        return path
+
+    def get_status(self):
+        with self.lock.read_locked():
+            return {"n_pool": int(self.x.shape[0]), "n_features": int(self.x.shape[1]),
+                    "n_regions": int(len(self.model.d)),
+                    "n_anomalies": len(self.ha), "n_nominals": len(self.hn),
+                    "n_updates": self.n_updates}
+
+    def handle_status(self, req):
+        return self.get_status()
+
+    def handle_score(self, req):
+        return {"scores": [float(v) for v in self.score(req["x"])]}
+
+    def handle_queries(self, req):
+        queries, scores = self.get_next_queries(int(req.get("n", 1)))
+        return {"queries": [int(v) for v in queries], "scores": [float(v) for v in scores]}
+
+    def handle_label(self, req):
+        n_anom, n_noml = self.add_labels(req["index"], req["label"])
+        return {"n_anomalies": n_anom, "n_nominals": n_noml}
+
+    def handle_ingest(self, req):
+        n_pool = self.ingest(req["x"], update_model=bool(req.get("update_model", False)))
+        return {"n_pool": n_pool}
+
+    def handle_snapshot(self, req):
+        return {"path": self.snapshot(req.get("path"), arrays=bool(req.get("arrays", False)))}
+
+
+# path -> (handler method of AadService, whether GET is allowed)
+AAD_SERVICE_ROUTES = {
+    "/status": ("handle_status", True),
+    "/score": ("handle_score", False),
+    "/queries": ("handle_queries", True),
+    "/label": ("handle_label", False),
+    "/ingest": ("handle_ingest", False),
+    "/snapshot": ("handle_snapshot", False),
+}
+
+
+class AadServiceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Dispatches JSON requests to the AadService of the server """
+
+    def do_GET(self):
+        self.dispatch(is_get=True)
+
+    def do_POST(self):
+        self.dispatch(is_get=False)
+
+    def dispatch(self, is_get):
+        path = self.path.split("?")[0]
+        if path not in AAD_SERVICE_ROUTES:
+            self.send_json(404, {"error": "Unknown path %s" % path})
+            return
+        method, allow_get = AAD_SERVICE_ROUTES[path]
+        if is_get and not allow_get:
+            self.send_json(405, {"error": "%s requires POST" % path})
+            return
+        try:
+            n = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(n).decode("utf-8") if n > 0 else ""
+            req = json.loads(body) if body != "" else {}
+            with span("service%s" % path.replace("/", "_")):
+                resp = getattr(self.server.service, method)(req)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "%s: %s" % (e.__class__.__name__, str(e))})
+            return
+        except Exception as e:
+            logger.exception("Failed request %s" % path)
+            self.send_json(500, {"error": "%s: %s" % (e.__class__.__name__, str(e))})
+            return
+        self.send_json(200, resp)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        if isinstance(self.client_address, tuple) and len(self.client_address) > 0:
+            return str(self.client_address[0])
+        return "local"
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
+
+
+class AadHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, server_address):
+        self.service = service
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, AadServiceRequestHandler)
+
+
+class AadUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, service, socket_path):
+        self.service = service
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            # stale socket of an earlier run
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, AadServiceRequestHandler)
+
+
+def get_aad_server(service, opts):
+    if opts.service_socket != "":
+        return AadUnixHTTPServer(service, opts.service_socket)
+    return AadHTTPServer(service, (opts.service_host, opts.service_port))
+
+
+def main():
+    args = get_command_args(debug=False)
+    configure_logger(args)
+
+    opts = Opts(args)
+    logger.debug(opts.str_opts())
+
+    # the labels in the data file are not used; labels come from the requests
+    x, _ = read_labeled_csv(opts.datafile)
+    logger.debug("loaded file: (%s) %s" % (str(x.shape), opts.datafile))
+
+    opts.set_multi_run_options(1, 1)
+    tm = Timer()
+    model = prepare_aad_model(x, None, opts)
+    service = AadService(model, opts, x)
+    logger.debug(tm.message("Service ready"))
+
+    server = get_aad_server(service, opts)
+    logger.debug("listening on %s" % (opts.service_socket if opts.service_socket != ""
+                                      else "%s:%d" % (opts.service_host, opts.service_port)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if opts.service_socket != "" and os.path.exists(opts.service_socket):
+            os.remove(opts.service_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,13 @@ from test_setups import *
 
 """
 python pyalad/alad.py
+
+To run from another module, call alad(opts) which returns the SequentialResults.
+Data already in memory is passed as alad(opts, allsamples=[SampleData(lbls=y, fmat=X, fid=0)]).
 """
 
 
-if __name__ == '__main__':
+def main():
 
     args = get_command_args(debug=False, debug_args=None)
 
@@ -29,3 +32,6 @@ if __name__ == '__main__':
 
     print ("completed alad %s for %s" % (opts.detector_type_str(), opts.dataset,))
 
+
+if __name__ == '__main__':
+    main()
@@ -551,6 +551,7 @@ class AadIsolationForest(object):
         ha = []
         hn = []
         xis = []
+        queried = MarkedSet(n)  # same as xis, for fast lookups
 
         w_unifprior = np.ones(m, dtype=float)
         w_unifprior = w_unifprior / np.sqrt(w_unifprior.dot(w_unifprior))
@@ -559,7 +560,7 @@ class AadIsolationForest(object):
 
         qstate = Query.get_initial_query_state(opts.qtype, opts=opts, qrank=bt.topK)
 
-        metrics.all_weights = np.zeros(shape=(opts.budget, m))
+        metrics.all_weights = get_weight_history(m, opts)
 
         w_unif_prior = self.get_uniform_weights(m)
         if self.w is None:
@@ -570,7 +571,7 @@ class AadIsolationForest(object):
             starttime_iter = timer()
 
             # save the weights in each iteration for later analysis
-            metrics.all_weights[i, :] = self.w
+            metrics.all_weights.append(self.w)
             metrics.queried = xis  # xis keeps growing with each feedback iteration
 
             order_anom_idxs = self.order_by_score(x)
@@ -589,13 +590,14 @@ class AadIsolationForest(object):
                     metrics.train_n_at_top[k][0, i] = train_n_at_top[k]
 
             xi_ = qstate.get_next_query(maxpos=n, ordered_indexes=order_anom_idxs,
-                                        queried_items=xis,
+                                        queried_items=queried,
                                         x=x, lbls=y,
                                         w=self.w, hf=append(ha, hn),
                                         remaining_budget=opts.budget - i)
             xi = xi_[0]
             # logger.debug("xi: %d" % (xi,))
             xis.append(xi)
+            queried.mark(xi)
 
             if opts.single_inst_feedback:
                 # Forget the previous feedback instances and
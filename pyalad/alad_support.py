@@ -3,6 +3,7 @@ from alad_simple import *
 from weight_inference import *
 from aatp_iterative_gradient import *
 from query_model import *
+from weight_history import *
 
 
 class MetricsStructure(object):
@@ -38,6 +39,32 @@ def get_alad_metrics_structure(budget, opts):
     return metrics
 
 
+# number of weight histories created for each file path in this process
+weight_history_path_counts = dict()
+
+
+def get_weight_history(m, opts):
+    """ Returns the store for the weights of all feedback iterations
+
+    The compressed weights are streamed to a file in resultsdir if
+    --weights_history_to_file is set, else kept in memory.
+
+    A WeightHistory truncates its file when created. Hence, if the path for
+    opts was already used in this process (e.g., the weights are learned
+    again for the same run), a numbered path (<name>-1.bin, ...) is used so
+    that the earlier history remains readable.
+    """
+    filepath = None
+    if opts.weights_history_to_file and opts.resultsdir != "" and os.path.isdir(opts.resultsdir):
+        filepath = opts.get_weights_history_path()
+        n = weight_history_path_counts.get(filepath, 0)
+        weight_history_path_counts[filepath] = n + 1
+        if n > 0:
+            root, ext = os.path.splitext(filepath)
+            filepath = "%s-%d%s" % (root, n, ext)
+    return WeightHistory(m, filepath=filepath)
+
+
 def save_alad_metrics(metrics, opts):
     cansave = (opts.resultsdir != "" and os.path.isdir(opts.resultsdir))
     if cansave:
@@ -236,13 +263,14 @@ def alad_ensemble(ensemble, opts):
     ha = []
     hn = []
     xis = []
+    queried = MarkedSet(n)  # same as xis, for fast lookups
     qval = np.Inf
     qval_ranges = []
     qvals = []  # just to check the trend whether this increases or decreases across iterations
 
     qstate = Query.get_initial_query_state(opts.qtype, opts=opts, qrank=topK)
 
-    metrics.all_weights = np.zeros(shape=(budget, m))
+    metrics.all_weights = get_weight_history(m, opts)
     detector_wts = ensemble.weights
 
     for i in range(budget):
@@ -250,7 +278,7 @@ def alad_ensemble(ensemble, opts):
         starttime_iter = timer()
 
         # save the weights in each iteration for later analysis
-        metrics.all_weights[i, :] = detector_wts
+        metrics.all_weights.append(detector_wts)
         metrics.queried = xis  # xis keeps growing with each feedback iteration
 
         anom_score = ensemble.scores.dot(detector_wts)
@@ -269,13 +297,14 @@ def alad_ensemble(ensemble, opts):
                 metrics.train_n_at_top[k][0, i] = train_n_at_top[k]
 
         xi_ = qstate.get_next_query(maxpos=n, ordered_indexes=order_anom_idxs,
-                                    queried_items=xis,
+                                    queried_items=queried,
                                     x=ensemble.scores, lbls=ensemble.labels,
                                     w=detector_wts, hf=append(ha, hn),
                                     remaining_budget=opts.budget - i)
         # logger.debug("xi: %d" % (xi,))
         xi = xi_[0]
         xis.append(xi)
+        queried.mark(xi)
 
         if opts.single_inst_feedback:
             # Forget the previous feedback instances and
@@ -420,7 +449,8 @@ def run_alad_simple(samples, labels, opts, scores=None, rnd_seed=0):
     return num_seen, num_seen_baseline, queried_indexes, queried_indexes_baseline
 
 
-def run_alad_multi(samples, labels, opts, rnd_seed=0):
+def run_alad_multi(samples, labels, opts, rnd_seed=0, runidxs=None):
+    """ Runs ALAD for the reruns runidxs (all reruns if None) of the data file opts.fid """
 
     ensemblemanager = EnsembleManager.get_ensemble_manager(opts)
     all_num_seen = None
@@ -428,7 +458,8 @@ def run_alad_multi(samples, labels, opts, rnd_seed=0):
     all_queried_indexes = None
     all_queried_indexes_baseline = None
 
-    runidxs = opts.get_runidxs()
+    if runidxs is None:
+        runidxs = opts.get_runidxs()
     for runidx in runidxs:
         starttime_feedback = timer()
 
@@ -476,9 +507,19 @@ def run_alad_multi(samples, labels, opts, rnd_seed=0):
     return all_num_seen, all_num_seen_baseline, all_queried_indexes, all_queried_indexes_baseline
 
 
-def alad(opts):
+def alad(opts, allsamples=None):
+    """ Runs ALAD for all fids and reruns
+
+    :param opts: Opts
+    :param allsamples: list of SampleData
+        data already in memory; if None, the data files are loaded as per opts
+    :return: SequentialResults
+    """
 
-    if opts.is_simple_run():
+    if allsamples is not None:
+        logger.debug("%s run on %d data set(s) in memory..." %
+                     ("Simple" if opts.is_simple_run() else "Multi", len(allsamples)))
+    elif opts.is_simple_run():
         logger.debug("Simple run...")
         allsamples = [load_samples(opts.datafile, opts, fid=0)]
     else:
@@ -1,5 +1,6 @@
 from argparse import ArgumentParser
 from r_support import *
+from instrumentation import *
 from copy import copy
 
 # ==============================
@@ -172,6 +173,12 @@ def get_option_list():
                         help="Number of search candidates to use in each search state (when query_type=5)")
     parser.add_argument("--query_search_depth", action="store", type=int, default=1,
                         help="Depth of search tree (when query_type=5)")
+    parser.add_argument("--query_search_beam_width", action="store", type=int, default=0,
+                        help="Max number of candidates expanded in each search state; 0 means no limit (when query_type=5)")
+    parser.add_argument("--query_search_max_nodes", action="store", type=int, default=0,
+                        help="Max number of search states expanded per query; 0 means no limit (when query_type=5)")
+    parser.add_argument("--query_search_n_jobs", action="store", type=int, default=1,
+                        help="Number of processes over which the query search branches are evaluated (when query_type=5)")
     parser.add_argument("--debug", action="store_true", default=False,
                         help="Whether to enable output of debug statements")
     parser.add_argument("--log_file", type=str, default="", required=False,
@@ -209,6 +216,12 @@ def get_option_list():
                         help="Model file path in case the model needs to be saved or loaded. Supported only for Isolation Forest.")
     parser.add_argument("--save_model", action="store_true", default=False,
                         help="Whether to save the trained model")
+    parser.add_argument("--model_arrays", action="store_true", default=False,
+                        help="Whether to save the model (--save_model) in the memory-mapped array " +
+                             "format, i.e., as a directory at --modelfile. Supported only for forest AAD.")
+    parser.add_argument("--weights_history_to_file", action="store_true", default=False,
+                        help="Whether to stream the compressed weights of all feedback iterations " +
+                             "to a file in resultsdir instead of keeping them in memory")
     parser.add_argument("--load_model", action="store_true", default=False,
                         help="Whether to load a pre-trained model")
 
@@ -217,6 +230,11 @@ def get_option_list():
 
     parser.add_argument("--n_jobs", action="store", type=int, default=1,
                         help="Number of parallel threads (if supported)")
+    parser.add_argument("--instrument", action="store", default="",
+                        help="Collect stage-level timings and counters and write the report " +
+                             "in the given format (json or csv) with the results; empty disables")
+    parser.add_argument("--n_parallel_tasks", action="store", type=int, default=1,
+                        help="Number of (fid, runidx) experiment tasks run in parallel processes")
 
     parser.add_argument("--forest_n_trees", action="store", type=int, default=100,
                         help="Number of trees for Forest")
@@ -230,6 +248,16 @@ def get_option_list():
                         help="Whether to include only leaf node regions only or intermediate node regions as well.")
     parser.add_argument("--forest_max_depth", action="store", type=int, default=15,
                         help="Number of samples to build each tree in Forest")
+    parser.add_argument("--forest_count_all_samples", action="store_true", default=False,
+                        help="Whether to count the instances in the tree nodes on all the training " +
+                             "data instead of only the subsample each tree is built on")
+    parser.add_argument("--compact_model", action="store_true", default=False,
+                        help="Whether to store the forest with int32 node arrays and float32 " +
+                             "thresholds, region scores and weights to reduce memory")
+    parser.add_argument("--forest_region_index", action="store_true", default=False,
+                        help="Whether to represent the region features by the region id of each " +
+                             "instance in each tree instead of a sparse matrix. " +
+                             "Requires --forest_add_leaf_nodes_only")
 
     parser.add_argument("--n_explore", action="store", type=int, default=20,
                         help="Number of top ranked instances to evaluate during exploration (query types GP and score variance)")
@@ -246,8 +274,23 @@ def get_option_list():
                         help="Max. number of instances to query per streaming window")
     parser.add_argument("--allow_stream_update", action="store_true", default=False,
                         help="Update the model when the window buffer is full in the streaming setting")
+    parser.add_argument("--stream_pipeline", action="store_true", default=False,
+                        help="Ingest the next streaming window in the background while the feedback loop runs on the current window")
+    parser.add_argument("--stream_source", type=str, default="", required=False,
+                        help="Read the data file out-of-core as a stream: csv (chunked), npy (memory-mapped), pipe (line reader; datafile '-' is stdin) or auto (inferred from datafile). Empty loads it fully in memory.")
+    parser.add_argument("--stream_no_header", action="store_true", default=False,
+                        help="Whether the first line of a csv or pipe stream source is data and not a header")
+    parser.add_argument("--stream_no_labels", action="store_true", default=False,
+                        help="Whether the stream source has no label column (else the labels are in the first column)")
     parser.add_argument("--query_confident", action="store_true", default=False,
                         help="Whether to query only those top ranked instances for which we are confident the score is at least 1 std-dev higher than tau-th ranked instance' score")
+
+    parser.add_argument("--service_host", action="store", default="127.0.0.1",
+                        help="Interface on which the scoring service listens")
+    parser.add_argument("--service_port", action="store", type=int, default=8765,
+                        help="Port on which the scoring service listens")
+    parser.add_argument("--service_socket", action="store", default="",
+                        help="Unix socket path for the scoring service; if set, used instead of host and port")
     return parser
 
 
@@ -317,6 +360,9 @@ class Opts(object):
         self.tau_nominal = args.tau_nominal
         self.query_search_candidates = args.query_search_candidates
         self.query_search_depth = args.query_search_depth
+        self.query_search_beam_width = args.query_search_beam_width
+        self.query_search_max_nodes = args.query_search_max_nodes
+        self.query_search_n_jobs = args.query_search_n_jobs
         self.optimlib = args.optimlib
         self.exclude = None
         self.keep = args.keep
@@ -351,12 +397,21 @@ class Opts(object):
 
         self.plot2D = args.plot2D
         self.n_jobs = args.n_jobs
+        self.n_parallel_tasks = args.n_parallel_tasks
+        self.instrument = args.instrument
+        if self.instrument not in ["", "json", "csv"]:
+            raise ValueError("Invalid --instrument format: %s" % self.instrument)
+        if self.instrument != "":
+            enable_instrumentation()
 
         self.forest_n_trees = args.forest_n_trees
         self.forest_n_samples = args.forest_n_samples
         self.forest_score_type = args.forest_score_type
         self.forest_add_leaf_nodes_only = args.forest_add_leaf_nodes_only
         self.forest_max_depth = args.forest_max_depth
+        self.forest_count_all_samples = args.forest_count_all_samples
+        self.compact_model = args.compact_model
+        self.forest_region_index = args.forest_region_index
 
         self.n_explore = args.n_explore
 
@@ -368,11 +423,21 @@ class Opts(object):
         self.min_feedback_per_window = args.min_feedback_per_window
         self.max_feedback_per_window = args.max_feedback_per_window
         self.allow_stream_update = args.allow_stream_update
+        self.stream_source = args.stream_source
+        self.stream_no_header = args.stream_no_header
+        self.stream_no_labels = args.stream_no_labels
+        self.stream_pipeline = args.stream_pipeline
         self.query_confident = args.query_confident
 
+        self.service_host = args.service_host
+        self.service_port = args.service_port
+        self.service_socket = args.service_socket
+
         self.modelfile = args.modelfile
         self.load_model = args.load_model
         self.save_model = args.save_model
+        self.model_arrays = args.model_arrays
+        self.weights_history_to_file = args.weights_history_to_file
 
     def is_simple_run(self):
         return self.runtype == "simple"
@@ -424,6 +489,10 @@ class Opts(object):
         prefix = self.get_alad_metrics_name_prefix()
         return os.path.join(self.resultsdir, prefix + "_alad_metrics.pydata")
 
+    def get_weights_history_path(self):
+        prefix = self.get_alad_metrics_name_prefix()
+        return os.path.join(self.resultsdir, prefix + "_alad_weights.bin")
+
     def get_metrics_summary_path(self):
         prefix = self.get_alad_metrics_name_prefix()
         return os.path.join(self.resultsdir, prefix + "_alad_summary.pydata")
@@ -508,23 +577,96 @@ class Opts(object):
         return srr
 
 
+class MarkedSet(object):
+    """ Tracks marked (e.g., queried) instance ids with a boolean mask
+
+    Marking and membership tests are O(1) per id and the unmarked ids
+    in a ranked list are found with vectorized masking. The marked ids
+    are also retained in the order in which they were first marked.
+
+    Attributes:
+        mask: np.array(dtype=bool)
+            mask[i] is True if instance id i is marked. Grows as required.
+        items: list
+            marked ids in marking order
+    """
+    def __init__(self, n=0, marked=None):
+        self.mask = np.zeros(n, dtype=bool)
+        self.items = []
+        if marked is not None:
+            self.mark(marked)
+
+    def _ensure_size(self, max_id):
+        if max_id >= len(self.mask):
+            mask = np.zeros(max(max_id + 1, 2 * len(self.mask)), dtype=bool)
+            mask[0:len(self.mask)] = self.mask
+            self.mask = mask
+
+    def mark(self, ids):
+        """ Marks a single id or an array of ids """
+        if np.isscalar(ids):
+            ids = int(ids)
+            self._ensure_size(ids)
+            if not self.mask[ids]:
+                self.mask[ids] = True
+                self.items.append(ids)
+            return
+        ids = np.asarray(ids, dtype=int).ravel()
+        if len(ids) == 0:
+            return
+        self._ensure_size(np.max(ids))
+        # keep first occurrences of new ids in their original order
+        _, first = np.unique(ids, return_index=True)
+        new_ids = ids[np.sort(first)]
+        new_ids = new_ids[~self.mask[new_ids]]
+        self.mask[new_ids] = True
+        self.items.extend(new_ids.tolist())
+
+    def is_marked(self, ids):
+        """ Returns a boolean array with one entry per id """
+        ids = np.asarray(ids, dtype=int)
+        marked = np.zeros(ids.shape, dtype=bool)
+        valid = ids < len(self.mask)
+        marked[valid] = self.mask[ids[valid]]
+        return marked
+
+    def get_unmarked(self, vals, n=None, start=0):
+        """ Returns the first n unmarked values from vals[start:] in the same order """
+        vals = np.asarray(vals, dtype=int)[start:]
+        unmarked = vals[~self.is_marked(vals)]
+        if n is not None:
+            unmarked = unmarked[0:n]
+        return unmarked
+
+    def get_marked(self):
+        return np.array(self.items, dtype=int)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, i):
+        return 0 <= i < len(self.mask) and bool(self.mask[i])
+
+    def __len__(self):
+        return len(self.items)
+
+
+def get_marked_set(marked):
+    """ Returns marked as a MarkedSet (marked may be an array, list or a MarkedSet) """
+    if isinstance(marked, MarkedSet):
+        return marked
+    return MarkedSet(marked=[] if marked is None else marked)
+
+
 def get_first_val_not_marked(vals, marked, start=1):
-    for i in range(start, len(vals)):
-        f = vals[i]
-        if len(np.where(marked == f)[0]) == 0:
-            return f
-    return None
+    unmarked = get_marked_set(marked).get_unmarked(vals, n=1, start=start)
+    if len(unmarked) == 0:
+        return None
+    return unmarked[0]
 
 
 def get_first_vals_not_marked(vals, marked, n=1, start=1):
-    unmarked = []
-    for i in range(start, len(vals)):
-        f = vals[i]
-        if len(np.where(marked == f)[0]) == 0:
-            unmarked.append(f)
-        if len(unmarked) >= n:
-            break
-    return np.array(unmarked, dtype=int)
+    return get_marked_set(marked).get_unmarked(vals, n=n, start=start)
 
 
 def get_anomalies_at_top(scores, lbls, K):
@@ -577,3 +719,13 @@ def load_all_samples(dataset, dirpath, fids, opts):
     return alldata
 
 
+def read_labeled_csv(filepath):
+    """ Reads a CSV with a header and the label ('anomaly' or other) in the first column """
+    data = DataFrame.from_csv(filepath, header=0, sep=',', index_col=None)
+    x = np.zeros(shape=(data.shape[0], data.shape[1] - 1))
+    for i in range(x.shape[1]):
+        x[:, i] = data.iloc[:, i + 1]
+    labels = np.array([1 if data.iloc[i, 0] == "anomaly" else 0 for i in range(data.shape[0])], dtype=int)
+    return x, labels
+
+
@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import resource
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+import numpy as np
+
+import logging
+
+from app_globals import *
+from alad_support import *
+from random_split_trees import *
+from forest_aad_detector import *
+from forest_aad_loss import *
+from optimization import sgdRMSProp
+from loda import get_best_proj, histogram_r
+from gp_support import *
+from data_stream import DataStream
+from forest_aad_stream import StreamingAnomalyDetector
+
+"""
+Timing and peak memory benchmarks for the hot paths.
+
+Every (benchmark, scale) pair runs in a separate process so that the peak
+memory of one benchmark is not affected by the others. The setup (data
+generation, model fitting) is not timed; the timed section is run
+--repeat times and the min/median times are reported.
+
+To run:
+    python pyalad/benchmarks.py --scales=small,medium --output=./temp/benchmarks.json
+To compare against an earlier run:
+    python pyalad/benchmarks.py --scales=small --output=./temp/benchmarks-new.json \
+        --baseline=./temp/benchmarks.json
+"""
+
+logger = logging.getLogger(__name__)
+
+
+# problem sizes; n: number of instances, d: number of features
+BENCHMARK_SCALES = {
+    "tiny": dict(n=256, d=4, n_trees=10, max_depth=5, window=128),
+    "small": dict(n=2000, d=10, n_trees=50, max_depth=8, window=512),
+    "medium": dict(n=20000, d=20, n_trees=100, max_depth=10, window=2048),
+    "large": dict(n=100000, d=50, n_trees=100, max_depth=12, window=8192),
+}
+
+
+def generate_gaussian_anomaly_data(n, d, anomaly_frac=0.05, rng=None):
+    """ Nominals from a standard normal and anomalies from a shifted, wider normal
+
+    :return: (np.ndarray, np.array)
+        instances and labels (1: anomaly, 0: nominal)
+    """
+    if rng is None:
+        rng = np.random.RandomState(42)
+    n_anom = max(1, int(n * anomaly_frac))
+    x = rng.normal(0., 1., size=(n, d))
+    x[0:n_anom, :] = rng.normal(3., 2., size=(n_anom, d))
+    y = np.zeros(n, dtype=int)
+    y[0:n_anom] = 1
+    perm = rng.permutation(n)
+    return x[perm, :], y[perm]
+
+
+def get_feedback_indexes(y, n_feedback, rng):
+    """ Returns labeled (anomaly, nominal) indexes as would be seen in feedback """
+    anoms = np.where(y == 1)[0]
+    noms = np.where(y == 0)[0]
+    n_a = min(len(anoms), max(1, n_feedback // 2))
+    ha = rng.choice(anoms, n_a, replace=False)
+    hn = rng.choice(noms, min(len(noms), n_feedback - n_a), replace=False)
+    return ha, hn
+
+
+def get_hstrees(x, n_trees, max_depth, rng):
+    forest = HSTrees(n_estimators=n_trees, max_depth=max_depth,
+                     max_features=x.shape[1], n_jobs=1, random_state=rng)
+    forest.fit(x)
+    return forest
+
+
+def get_aad_forest(x, n_trees, max_depth, rng):
+    mdl = AadForest(n_estimators=n_trees, max_samples=min(256, x.shape[0]),
+                    max_depth=max_depth, score_type=HST_SCORE_TYPE, random_state=rng,
+                    add_leaf_nodes_only=True, detector_type=AAD_HSTREES, n_jobs=1)
+    mdl.fit(x)
+    return mdl
+
+
+"""
+Each benchmark function does the untimed setup and returns the function
+which will be timed. All take the same arguments: (params, rng).
+"""
+
+
+def bench_random_split_forest_fit(params, rng):
+    x, _ = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    return lambda: get_hstrees(x, params["n_trees"], params["max_depth"], rng)
+
+
+def bench_arr_tree_apply(params, rng):
+    x, _ = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    forest = get_hstrees(x, params["n_trees"], params["max_depth"], rng)
+
+    def run():
+        for estimator in forest.estimators_:
+            estimator.tree_.apply(x, getleaves=True, getnodeinds=False)
+    return run
+
+
+def bench_aad_forest_fit(params, rng):
+    x, _ = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    return lambda: get_aad_forest(x, params["n_trees"], params["max_depth"], rng)
+
+
+def bench_transform_to_region_features(params, rng):
+    x, _ = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    mdl = get_aad_forest(x, params["n_trees"], params["max_depth"], rng)
+    return lambda: mdl.transform_to_region_features(x, dense=False)
+
+
+def _get_loss_setup(params, rng):
+    x, y = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    mdl = get_aad_forest(x, params["n_trees"], params["max_depth"], rng)
+    x_new = mdl.transform_to_region_features(x, dense=False)
+    ha, hn = get_feedback_indexes(y, 100, rng)
+    hf = np.append(ha, hn)
+    w = mdl.get_uniform_weights()
+    qval = mdl.get_aatp_quantile(x_new, w, 30)
+    return x_new[hf, :], y[hf], w, qval
+
+
+def bench_forest_aad_loss(params, rng):
+    xi, yi, w, qval = _get_loss_setup(params, rng)
+
+    def run():
+        forest_aad_loss_linear(w, xi, yi, qval)
+        forest_aad_loss_gradient_linear(w, xi, yi, qval)
+    return run
+
+
+def bench_sgd_rmsprop(params, rng):
+    xi, yi, w, qval = _get_loss_setup(params, rng)
+
+    def f(w, x, y):
+        return forest_aad_loss_linear(w, x, y, qval)
+
+    def g(w, x, y):
+        return forest_aad_loss_gradient_linear(w, x, y, qval)
+
+    return lambda: sgdRMSProp(w, xi, yi, f, g, learning_rate=0.001, max_epochs=200,
+                              shuffle=True, rng=np.random.RandomState(42))
+
+
+def bench_loda_best_proj(params, rng):
+    x, _ = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    return lambda: get_best_proj(x, mink=1, maxk=10, sp=0.0)
+
+
+def bench_histogram_r(params, rng):
+    x, _ = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    a = x.dot(rng.normal(0., 1., size=x.shape[1]))
+    return lambda: histogram_r(a)
+
+
+def bench_gp_queries(params, rng):
+    x, y = generate_gaussian_anomaly_data(params["n"], params["d"], rng=rng)
+    mdl = get_aad_forest(x, params["n_trees"], params["max_depth"], rng)
+    x_new = mdl.transform_to_region_features(x, dense=False)
+    w = mdl.get_uniform_weights()
+    ordered_indexes = np.argsort(-mdl.get_score(x_new, w))
+    ha, hn = get_feedback_indexes(y, 20, rng)
+    queried = np.append(ha, hn)
+
+    def run():
+        get_score_variances(x_new, w, n_test=20, ordered_indexes=ordered_indexes,
+                            queried_indexes=queried)
+        get_gp_predictions(x_new, mdl.get_score(x_new, w), ordered_indexes,
+                           queried_indexes=queried, n_train=100, n_test=20)
+    return run
+
+
+def bench_stream_window(params, rng):
+    window = params["window"]
+    x, y = generate_gaussian_anomaly_data(params["n"] + window, params["d"], rng=rng)
+    mdl = get_aad_forest(x[0:params["n"], :], params["n_trees"], params["max_depth"], rng)
+    x_stream, y_stream = x[params["n"]:, :], y[params["n"]:]
+
+    def run():
+        sad = StreamingAnomalyDetector(DataStream(x_stream, y_stream), mdl,
+                                       max_buffer=window)
+        x_new, _ = sad.get_next_transformed(window)
+        mdl.get_score(x_new)
+        sad.update_model_from_buffer()
+    return run
+
+
+BENCHMARKS = [
+    ("random_split_forest_fit", bench_random_split_forest_fit),
+    ("arr_tree_apply", bench_arr_tree_apply),
+    ("aad_forest_fit", bench_aad_forest_fit),
+    ("transform_to_region_features", bench_transform_to_region_features),
+    ("forest_aad_loss", bench_forest_aad_loss),
+    ("sgd_rmsprop", bench_sgd_rmsprop),
+    ("loda_best_proj", bench_loda_best_proj),
+    ("histogram_r", bench_histogram_r),
+    ("gp_queries", bench_gp_queries),
+    ("stream_window", bench_stream_window),
+]
+
+
+def get_peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / (1024. * 1024.)  # bytes
+    return rss / 1024.  # KB
+
+
+def run_benchmark(bench_fn, params, repeat, seed):
+    """ Runs the setup once and the timed function repeat times
+
+    :return: dict
+    """
+    rng = np.random.RandomState(seed)
+    start_rss = get_peak_rss_mb()
+    fn = bench_fn(params, rng)
+    times = []
+    for i in range(repeat):
+        # Timer.elapsed() is in whole seconds
+        start_time = timer()
+        fn()
+        times.append(timer() - start_time)
+    return {"times": times, "min": float(np.min(times)), "median": float(np.median(times)),
+            "peak_rss_mb": get_peak_rss_mb(), "start_rss_mb": start_rss}
+
+
+def _benchmark_worker(bench_fn, params, repeat, seed, q):
+    try:
+        q.put(run_benchmark(bench_fn, params, repeat, seed))
+    except Exception as e:
+        q.put({"error": "%s: %s" % (type(e).__name__, str(e))})
+
+
+def run_benchmark_in_process(bench_fn, params, repeat, seed, timeout=0):
+    """ Runs the benchmark in a child process
+
+    If the child dies without a result (e.g., it is killed when out of
+    memory) or runs longer than timeout seconds (0 for no limit), the
+    result has an error entry instead of the times.
+    """
+    q = Queue()
+    p = Process(target=_benchmark_worker, args=(bench_fn, params, repeat, seed, q))
+    p.start()
+    start_time = timer()
+    result = None
+    while result is None:
+        try:
+            result = q.get(timeout=1.)
+        except Empty:
+            if not p.is_alive():
+                try:
+                    # the result might have been sent just before the child exited
+                    result = q.get(timeout=1.)
+                except Empty:
+                    result = {"error": "process exited with code %s" % str(p.exitcode)}
+            elif 0 < timeout < timer() - start_time:
+                p.terminate()
+                result = {"error": "timed out after %d sec(s)" % timeout}
+    p.join()
+    return result
+
+
+def run_benchmarks(names, scales, repeat=3, seed=42, isolate=True, timeout=0):
+    results = []
+    for scale in scales:
+        params = BENCHMARK_SCALES[scale]
+        for name, bench_fn in BENCHMARKS:
+            if names is not None and name not in names:
+                continue
+            if isolate:
+                result = run_benchmark_in_process(bench_fn, params, repeat, seed, timeout=timeout)
+            else:
+                result = run_benchmark(bench_fn, params, repeat, seed)
+            result.update({"benchmark": name, "scale": scale, "params": params})
+            results.append(result)
+            if "error" in result:
+                logger.debug("%s [%s] failed: %s" % (name, scale, result["error"]))
+            else:
+                logger.debug("%s [%s] median: %f sec(s), peak rss: %0.1f MB" %
+                             (name, scale, result["median"], result["peak_rss_mb"]))
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    """ Compares median times with the baseline results of the same (benchmark, scale)
+
+    :return: (list of str, int)
+        report lines and number of benchmarks slower than the baseline by more than tolerance
+    """
+    base = dict([((r["benchmark"], r["scale"]), r) for r in baseline if "error" not in r])
+    lines = ["%-30s %-8s %12s %12s %8s %10s" % ("benchmark", "scale", "baseline", "current", "ratio", "rss_ratio")]
+    n_regressions = 0
+    for r in results:
+        b = base.get((r["benchmark"], r["scale"]))
+        if b is None or "error" in r:
+            continue
+        ratio = r["median"] / max(b["median"], 1e-9)
+        rss_ratio = r["peak_rss_mb"] / max(b["peak_rss_mb"], 1e-9)
+        flag = ""
+        if ratio > 1. + tolerance:
+            flag = " SLOWER"
+            n_regressions += 1
+        lines.append("%-30s %-8s %12.6f %12.6f %8.2f %10.2f%s" %
+                     (r["benchmark"], r["scale"], b["median"], r["median"], ratio, rss_ratio, flag))
+    return lines, n_regressions
+
+
+def get_benchmark_args(cli_args=None):
+    parser = ArgumentParser()
+    parser.add_argument("--scales", action="store", default="small",
+                        help="Comma-separated problem sizes: %s" % ",".join(sorted(BENCHMARK_SCALES.keys())))
+    parser.add_argument("--benchmarks", action="store", default="",
+                        help="Comma-separated benchmark names; empty runs all: %s" %
+                             ",".join([name for name, _ in BENCHMARKS]))
+    parser.add_argument("--repeat", action="store", type=int, default=3,
+                        help="Number of times each timed section is run")
+    parser.add_argument("--randseed", action="store", type=int, default=42,
+                        help="Random seed for data generation and models")
+    parser.add_argument("--output", action="store", default="./temp/benchmarks.json",
+                        help="File where the results are written as JSON")
+    parser.add_argument("--baseline", action="store", default="",
+                        help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", action="store", type=float, default=0.2,
+                        help="Relative slowdown w.r.t. the baseline reported as a regression")
+    parser.add_argument("--no_isolate", action="store_true", default=False,
+                        help="Run all benchmarks in this process (peak memory is then cumulative)")
+    parser.add_argument("--timeout", action="store", type=int, default=3600,
+                        help="Max seconds for each benchmark process; 0 means no limit")
+    parser.add_argument("--log_file", action="store", default="",
+                        help="Log file")
+    parser.add_argument("--debug", action="store_true", default=False,
+                        help="Whether to enable debug logging")
+    return parser.parse_args(cli_args)
+
+
+def main():
+    args = get_benchmark_args()
+    configure_logger(args)
+
+    scales = [s for s in args.scales.split(",") if s != ""]
+    for scale in scales:
+        if scale not in BENCHMARK_SCALES:
+            raise ValueError("Invalid scale: %s" % scale)
+    names = None
+    if args.benchmarks != "":
+        names = args.benchmarks.split(",")
+
+    results = run_benchmarks(names, scales, repeat=args.repeat, seed=args.randseed,
+                             isolate=not args.no_isolate, timeout=args.timeout)
+
+    outdir = os.path.dirname(args.output)
+    if outdir != "" and not os.path.exists(outdir):
+        os.makedirs(outdir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline != "":
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        lines, n_regressions = compare_with_baseline(results, baseline, tolerance=args.tolerance)
+        print ("\n".join(lines))
+        if n_regressions > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
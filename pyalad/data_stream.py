@@ -1,3 +1,4 @@
+import sys
 import numpy as np
 import scipy as sp
 
@@ -7,28 +8,266 @@ from scipy.sparse import lil_matrix, csr_matrix, vstack
 from r_support import *
 from random_split_trees import *
 
+pd = LazyImport("pandas")
+
 
 class DataStream(object):
-    def __init__(self, X, y=None):
+    """ Reads instances sequentially from in-memory data
+
+    A read cursor is maintained over the data and each read returns views
+    (slices) of the underlying arrays without copying the remaining data.
+    Hence, the returned instances must not be modified in place.
+
+    If shuffle is True (or a permutation is provided), instances are read
+    in the order of a permutation that is computed once. In this case,
+    only the rows returned by a read are copied.
+
+    Attributes:
+        X: np.ndarray or csr_matrix
+        y: np.array
+        permutation: np.array
+            order in which instances are read; None for the original order
+        cursor: int
+            number of instances read so far
+    """
+    def __init__(self, X, y=None, shuffle=False, permutation=None, random_state=None):
         self.X = X
         self.y = y
+        self.permutation = permutation
+        if self.permutation is None and shuffle:
+            rnd = random_state if random_state is not None else np.random
+            self.permutation = rnd.permutation(X.shape[0])
+        self.cursor = 0
 
     def read_next_from_stream(self, n=1):
-        n = min(n, self.X.shape[0])
+        n = min(n, self.get_num_remaining())
         # logger.debug("DataStream.read_next_from_stream n: %d" % n)
         if n == 0:
             return None, None
-        mask = np.zeros(self.X.shape[0], dtype=bool)
-        mask[np.arange(n)] = True
-        instances = self.X[mask]
-        self.X = self.X[~mask]
+        start = self.cursor
+        self.cursor += n
+        if self.permutation is None:
+            indexes = slice(start, self.cursor)
+        else:
+            indexes = self.permutation[start:self.cursor]
+        instances = self.X[indexes]
         labels = None
         if self.y is not None:
-            labels = self.y[mask]
-            self.y = self.y[~mask]
+            labels = self.y[indexes]
         # logger.debug("DataStream.read_next_from_stream instances: %s" % str(instances.shape))
         return instances, labels
 
+    def get_num_remaining(self):
+        if self.X is None:
+            return 0
+        return self.X.shape[0] - self.cursor
+
+    def empty(self):
+        return self.get_num_remaining() == 0
+
+    def close(self):
+        pass
+
+
+class ChunkedDataStream(object):
+    """ Base class for out-of-core streams that read data in chunks
+
+    Subclasses implement read_chunk(n) which returns the next chunk of
+    instances (and labels, if any) or (None, None) at the end of the data.
+    n is the number of instances required by the current read; sources
+    may return fewer or more (up to chunk_size) instances.
+    At most one chunk is buffered at any time in addition to the instances
+    returned by a read.
+
+    Attributes:
+        chunk_size: int
+            number of instances read from the source at a time
+    """
+    def __init__(self, chunk_size=10000):
+        self.chunk_size = chunk_size
+        self.buffer_x = None
+        self.buffer_y = None
+        self.buffer_pos = 0
+        self.exhausted = False
+
+    def read_chunk(self, n):
+        raise NotImplementedError("read_chunk() not implemented")
+
+    def _fill_buffer(self, n=1):
+        """ Returns True if there are unread instances in the buffer """
+        while not self.exhausted and (self.buffer_x is None or self.buffer_pos >= self.buffer_x.shape[0]):
+            self.buffer_x, self.buffer_y = self.read_chunk(n)
+            self.buffer_pos = 0
+            if self.buffer_x is None:
+                self.exhausted = True
+        return not self.exhausted
+
+    def read_next_from_stream(self, n=1):
+        xs = []
+        ys = []
+        while n > 0 and self._fill_buffer(n):
+            end = min(self.buffer_pos + n, self.buffer_x.shape[0])
+            xs.append(self.buffer_x[self.buffer_pos:end])
+            if self.buffer_y is not None:
+                ys.append(self.buffer_y[self.buffer_pos:end])
+            n -= end - self.buffer_pos
+            self.buffer_pos = end
+        if len(xs) == 0:
+            return None, None
+        instances = xs[0] if len(xs) == 1 else np.vstack(xs)
+        labels = None
+        if len(ys) > 0:
+            labels = ys[0] if len(ys) == 1 else np.concatenate(ys)
+        return instances, labels
+
     def empty(self):
-        return self.X is None or self.X.shape[0] == 0
+        return not self._fill_buffer()
+
+    def close(self):
+        """ Releases the source; subclasses which open files override this """
+        pass
+
+
+def get_labels_from_column(values, anomaly_label="anomaly"):
+    """ Returns 1 for values equal to anomaly_label, else 0 """
+    return np.array([1 if str(v).strip() == anomaly_label else 0 for v in values], dtype=int)
+
+
+def split_label_column(data, label_index=None, anomaly_label="anomaly"):
+    """ Splits a 2D object/float array into (float instances, int labels) """
+    if label_index is None:
+        return np.asarray(data, dtype=float), None
+    cols = np.delete(np.arange(data.shape[1]), label_index)
+    x = np.asarray(data[:, cols], dtype=float)
+    y = get_labels_from_column(data[:, label_index], anomaly_label=anomaly_label)
+    return x, y
+
+
+class CsvDataStream(ChunkedDataStream):
+    """ Reads instances from a CSV file in chunks
+
+    The file has the same format as the one read by forest_aad_stream.read_data,
+    i.e., a header row and the label in the first column. Set label_index
+    to None if the file does not have labels.
+    """
+    def __init__(self, filepath, label_index=0, anomaly_label="anomaly",
+                 header=True, sep=',', chunk_size=10000):
+        ChunkedDataStream.__init__(self, chunk_size=chunk_size)
+        self.label_index = label_index
+        self.anomaly_label = anomaly_label
+        self.reader = pd.read_csv(filepath, header=0 if header else None, sep=sep,
+                                  index_col=None, chunksize=chunk_size)
+
+    def close(self):
+        self.reader.close()
+
+    def read_chunk(self, n):
+        try:
+            chunk = next(self.reader)
+        except StopIteration:
+            return None, None
+        return split_label_column(chunk.values, label_index=self.label_index,
+                                  anomaly_label=self.anomaly_label)
+
+
+class LineDataStream(ChunkedDataStream):
+    """ Reads delimited instances line by line from a file object (e.g., stdin or a pipe)
+
+    Each read returns as soon as the requested number of lines (or end of
+    input) is available, hence a producer process can feed the stream.
+    If close_file is True, f is closed at the end of input or by close().
+    """
+    def __init__(self, f, label_index=0, anomaly_label="anomaly",
+                 header=False, sep=',', chunk_size=512, close_file=False):
+        ChunkedDataStream.__init__(self, chunk_size=chunk_size)
+        self.f = f
+        self.close_file = close_file
+        self.label_index = label_index
+        self.anomaly_label = anomaly_label
+        self.sep = sep
+        if header:
+            self.f.readline()
+
+    def read_chunk(self, n):
+        # do not wait on more lines than required by the current read
+        n = min(n, self.chunk_size)
+        rows = []
+        while len(rows) < n:
+            line = self.f.readline()
+            if not line:
+                self.close()
+                break
+            line = line.strip()
+            if line != "":
+                rows.append(line.split(self.sep))
+        if len(rows) == 0:
+            return None, None
+        return split_label_column(np.array(rows, dtype=object), label_index=self.label_index,
+                                  anomaly_label=self.anomaly_label)
+
+    def close(self):
+        if self.close_file and not self.f.closed:
+            self.f.close()
+
+
+class MemmapDataStream(DataStream):
+    """ Reads instances from a memory-mapped .npy or raw binary file
+
+    Only the pages backing the instances read are brought into memory.
+    For raw binary files, the dtype and number of columns must be specified
+    (order='F' for column-major data). If label_index is not None, that
+    column holds the labels (1 for anomaly, 0 otherwise).
+    """
+    def __init__(self, filepath, label_index=None, dtype=float, n_cols=None, order='C',
+                 shuffle=False, permutation=None, random_state=None):
+        if filepath.endswith(".npy"):
+            data = np.load(filepath, mmap_mode='r')
+        else:
+            if n_cols is None:
+                raise ValueError("n_cols required for raw binary file %s" % filepath)
+            data = np.memmap(filepath, dtype=dtype, mode='r')
+            data = data.reshape((-1, n_cols), order=order)
+        self.label_index = label_index
+        DataStream.__init__(self, data, y=None, shuffle=shuffle,
+                            permutation=permutation, random_state=random_state)
+
+    def read_next_from_stream(self, n=1):
+        data, _ = DataStream.read_next_from_stream(self, n)
+        if data is None or self.label_index is None:
+            return data, None
+        cols = np.delete(np.arange(data.shape[1]), self.label_index)
+        return np.asarray(data[:, cols], dtype=float), \
+               np.asarray(data[:, self.label_index] == 1, dtype=int)
+
+
+def get_data_stream(filepath, source="", chunk_size=10000, label_index=0, header=True):
+    """ Returns an out-of-core stream over filepath
 
+    :param source: str
+        'csv' (chunked CSV reader), 'npy' (memory-mapped .npy), 'pipe'
+        (line reader; filepath '-' reads stdin). If empty, the source is
+        inferred from filepath.
+    :param label_index: int
+        column of the labels; None if the data has no labels
+    :param header: bool
+        whether the first line of 'csv' and 'pipe' data is a header
+    """
+    if source == "":
+        if filepath == "-":
+            source = "pipe"
+        elif filepath.endswith(".npy"):
+            source = "npy"
+        else:
+            source = "csv"
+    if source == "csv":
+        return CsvDataStream(filepath, label_index=label_index, header=header, chunk_size=chunk_size)
+    elif source == "npy":
+        return MemmapDataStream(filepath, label_index=label_index)
+    elif source == "pipe":
+        if filepath == "-":
+            return LineDataStream(sys.stdin, label_index=label_index, header=header,
+                                  chunk_size=chunk_size)
+        return LineDataStream(open(filepath, 'r'), label_index=label_index, header=header,
+                              chunk_size=chunk_size, close_file=True)
+    else:
+        raise ValueError("Invalid stream source %s" % source)
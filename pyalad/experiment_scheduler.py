@@ -0,0 +1,354 @@
+import os
+import time
+import numpy as np
+from copy import copy
+from multiprocessing import Process
+
+import logging
+
+from app_globals import *
+from alad_support import *
+
+from forest_aad_detector import *
+from forest_aad_batch import run_forest_aad_batch
+from forest_aad_stream import run_forest_aad_stream
+from data_stream import DataStream
+from results_support import write_sequential_results_to_csv
+
+"""
+Runs the (fid, runidx) experiments of a dataset as parallel tasks.
+
+The forest AAD batch and stream runs (forest_aad_batch.py and
+forest_aad_stream.py) and the ALAD runs (alad.py) are supported.
+
+Each task runs in its own process with a seed derived from (fid, runidx),
+loads the data memory-mapped from .npy files that are created once, and
+saves its results to a separate file. Tasks whose result files already
+exist are skipped, hence an interrupted sweep can be resumed by running
+the same command again. The results of all tasks are finally collected
+into preallocated SequentialResults arrays in (fid, runidx) order.
+
+To run:
+    python pyalad/experiment_scheduler.py --dataset=toy2 --datafile=... --resultsdir=... \
+        --runtype=multi --reruns=10 --n_parallel_tasks=4 ...
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class ExperimentTask(object):
+    """ One (fid, runidx) experiment
+
+    Attributes:
+        fid: int
+        runidx: int
+        seed: int
+            derived from the base random seed, fid and runidx such that
+            every task in a sweep has a different seed
+        outputpath: str
+            file where the task results are saved
+        stagespath: str
+            file where the stage timings and counters of the task are
+            saved (only with --instrument)
+    """
+    def __init__(self, fid, runidx, seed, outputpath):
+        self.fid = fid
+        self.runidx = runidx
+        self.seed = seed
+        self.outputpath = outputpath
+        self.stagespath = "%s-stages.json" % os.path.splitext(outputpath)[0]
+
+    def is_complete(self):
+        return os.path.isfile(self.outputpath)
+
+
+def get_task_seed(randseed, fid, runidx, reruns):
+    # same as the seeds used in the sequential experiment scripts
+    return randseed + fid * reruns + runidx
+
+
+def get_experiment_tasks(opts, fids, outputdir):
+    tasks = []
+    for fid in fids:
+        for runidx in opts.get_runidxs():
+            outputpath = os.path.join(outputdir, "task-fid%d-runidx%d.npz" % (fid, runidx))
+            tasks.append(ExperimentTask(fid, runidx,
+                                        get_task_seed(opts.randseed, fid, runidx, opts.reruns),
+                                        outputpath))
+    return tasks
+
+
+def share_data(x, y, datadir, fid):
+    """ Saves the data as .npy files which tasks load memory-mapped
+
+    :return: (str, str)
+        paths of the instances and the labels
+    """
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    x_path = os.path.join(datadir, "x-fid%d.npy" % fid)
+    y_path = os.path.join(datadir, "y-fid%d.npy" % fid)
+    np.save(x_path, x)
+    np.save(y_path, y)
+    return x_path, y_path
+
+
+def load_shared_data(data_paths):
+    x_path, y_path = data_paths
+    return np.load(x_path, mmap_mode='r'), np.load(y_path, mmap_mode='r')
+
+
+def save_task_results(outputpath, results):
+    """ Saves the dict of result arrays such that a partially written file is never seen """
+    tmppath = "%s.tmp-%d" % (outputpath, os.getpid())
+    f = open(tmppath, 'wb')
+    np.savez(f, **results)
+    f.close()
+    os.rename(tmppath, outputpath)
+
+
+def run_task(task_fn, task, opts, data_paths):
+    task_opts = copy(opts)
+    task_opts.set_multi_run_options(task.fid, task.runidx)
+    np.random.seed(task.seed)
+    tm = Timer()
+    reset_instrumentation()
+    results = task_fn(task, task_opts, data_paths[task.fid])
+    if get_instrumentation().enabled:
+        # saved before the results such that every complete task has its report
+        get_instrumentation().write_json(task.stagespath)
+    save_task_results(task.outputpath, results)
+    logger.debug(tm.message("Completed task fid: %d, runidx: %d" % (task.fid, task.runidx)))
+
+
+def run_experiment_tasks(task_fn, tasks, opts, data_paths, n_parallel_tasks=1, poll_interval=0.5):
+    """ Runs the incomplete tasks with at most n_parallel_tasks processes at a time
+
+    The task processes are regular (non-daemon) processes so that the
+    detectors can use their own process pools (e.g., with --n_jobs).
+
+    :param task_fn: function(ExperimentTask, Opts, (x_path, y_path)) -> dict of np.ndarray
+    :param data_paths: dict
+        fid -> (x_path, y_path) as returned by share_data()
+    """
+    pending = [task for task in tasks if not task.is_complete()]
+    logger.debug("tasks: %d, already complete: %d" % (len(tasks), len(tasks) - len(pending)))
+    if n_parallel_tasks <= 1:
+        for task in pending:
+            run_task(task_fn, task, opts, data_paths)
+        return
+    running = []
+    failed = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < n_parallel_tasks:
+            task = pending.pop(0)
+            p = Process(target=run_task, args=(task_fn, task, opts, data_paths))
+            p.start()
+            running.append((task, p))
+        time.sleep(poll_interval)
+        still_running = []
+        for task, p in running:
+            if p.is_alive():
+                still_running.append((task, p))
+            else:
+                p.join()
+                if p.exitcode != 0:
+                    failed.append(task)
+        running = still_running
+    if len(failed) > 0:
+        raise RuntimeError("Failed tasks (fid, runidx): %s" %
+                           ", ".join(["(%d, %d)" % (task.fid, task.runidx) for task in failed]))
+
+
+# (name in the task results file, attribute of SequentialResults)
+TASK_RESULT_FIELDS = [("num_seen", "num_seen"), ("num_seen_baseline", "num_seen_baseline"),
+                      ("queried", "true_queried_indexes"),
+                      ("queried_baseline", "true_queried_indexes_baseline"),
+                      ("stream_window", "stream_window"),
+                      ("stream_window_baseline", "stream_window_baseline"),
+                      ("aucs", "aucs")]
+
+
+def get_task_results(results):
+    """ Returns the dict of result arrays saved by a task from its single-run SequentialResults """
+    if results is None:
+        raise ValueError("The run did not produce any feedback results")
+    task_results = dict()
+    for name, attr in TASK_RESULT_FIELDS:
+        value = getattr(results, attr)
+        if value is not None:
+            # the row of the run; a scalar for the per-run values (aucs)
+            task_results[name] = np.asarray(value)[0]
+    return task_results
+
+
+def merge_task_instrumentation(tasks):
+    """ Sets the stage timings and counters of this process to the sum of those of the tasks
+
+    Tasks run in their own processes (or reset the instrumentation when run
+    in this process), hence the report of the sweep is merged from the
+    reports saved by the tasks.
+    """
+    instr = get_instrumentation()
+    if not instr.enabled:
+        return
+    instr.reset()
+    for task in tasks:
+        if os.path.isfile(task.stagespath):
+            instr.read_json(task.stagespath)
+
+
+def collect_sequential_results(tasks):
+    """ Collects the results saved by the tasks into preallocated arrays
+
+    The row for a task is at the same position as the task in tasks.
+    """
+    arrays = dict()
+    for i, task in enumerate(tasks):
+        task_results = np.load(task.outputpath)
+        for name, _ in TASK_RESULT_FIELDS:
+            if name not in task_results:
+                continue
+            row = task_results[name]
+            if name not in arrays:
+                arrays[name] = np.zeros((len(tasks),) + row.shape, dtype=row.dtype)
+            arrays[name][i] = row
+    return SequentialResults(**dict([(attr, arrays.get(name)) for name, attr in TASK_RESULT_FIELDS]))
+
+
+def forest_aad_task(task, opts, data_paths):
+    """ Runs AAD on a tree-based detector for one (fid, runidx)
+
+    Runs forest_aad_batch.py for the single rerun task.runidx.
+    """
+    x, labels = load_shared_data(data_paths)
+    results = run_forest_aad_batch(opts, x, labels, write_results=False,
+                                   fid=task.fid, runidxs=[task.runidx])
+    return get_task_results(results)
+
+
+def forest_aad_stream_task(task, opts, data_paths):
+    """ Runs streaming AAD on a tree-based detector for one (fid, runidx)
+
+    Runs forest_aad_stream.py for the single rerun task.runidx. The
+    stream reads the memory-mapped data.
+    """
+    x, labels = load_shared_data(data_paths)
+    results = run_forest_aad_stream(opts, DataStream(x, labels), write_results=False,
+                                    fid=task.fid, runidxs=[task.runidx])
+    return get_task_results(results)
+
+
+def alad_task(task, opts, data_paths):
+    """ Runs ALAD for one (fid, runidx)
+
+    Same as one run in alad.py (see alad_support.alad).
+    """
+    x, labels = load_shared_data(data_paths)
+    opts.sparsity = None  # loda default d*(1-1/sqrt(d)) vectors will be zero
+    rnd_seed = opts.randseed + task.fid
+    if opts.is_simple_run():
+        num_seen_summary = run_alad_simple(x, labels, opts, rnd_seed)
+    else:
+        num_seen_summary = run_alad_multi(x, labels, opts, rnd_seed, runidxs=[task.runidx])
+    num_seen, num_seen_baseline, queried_indexes, queried_indexes_baseline = num_seen_summary
+    return get_task_results(SequentialResults(num_seen=num_seen, num_seen_baseline=num_seen_baseline,
+                                              true_queried_indexes=queried_indexes,
+                                              true_queried_indexes_baseline=queried_indexes_baseline))
+
+
+def read_forest_aad_data(filepath, opts):
+    return read_labeled_csv(filepath)
+
+
+def read_alad_data(filepath, opts):
+    sample_data = load_samples(filepath, opts)
+    return sample_data.fmat, sample_data.lbls
+
+
+def get_dataset_files(opts, simple_fid=1):
+    """ Returns a dict fid -> data file
+
+    If --datafile is set, it is the only file (fid=simple_fid), else the
+    files <filedir>/<dataset>_<fid>.csv are used for all fids.
+    """
+    if opts.datafile != "":
+        return {simple_fid: opts.datafile}
+    return dict([(fid, os.path.join(opts.filedir, "%s_%d.csv" % (opts.dataset, fid)))
+                 for fid in opts.get_fids()])
+
+
+def run_experiments(task_fn, opts, read_data_fn, n_parallel_tasks=1, simple_fid=1):
+    """ Runs task_fn for all (fid, runidx) and writes the collected results
+
+    :param task_fn: function(ExperimentTask, Opts, (x_path, y_path)) -> dict of np.ndarray
+    :param read_data_fn: function(str, Opts) -> (np.ndarray, np.array)
+        reads the instances and labels of a data file; called only once per
+        fid, after which the tasks load the data memory-mapped
+    :param simple_fid: int
+        the fid of --datafile
+    :return: SequentialResults
+    """
+    datafiles = get_dataset_files(opts, simple_fid=simple_fid)
+    fids = sorted(datafiles.keys())
+    taskdir = os.path.join(opts.resultsdir, "tasks-%s" % opts.get_alad_metrics_name_prefix())
+    if not os.path.exists(taskdir):
+        os.makedirs(taskdir)
+    tasks = get_experiment_tasks(opts, fids, taskdir)
+
+    data_paths = dict()
+    for fid in fids:
+        x_path = os.path.join(taskdir, "data", "x-fid%d.npy" % fid)
+        y_path = os.path.join(taskdir, "data", "y-fid%d.npy" % fid)
+        if os.path.isfile(x_path) and os.path.isfile(y_path):
+            data_paths[fid] = (x_path, y_path)
+        else:
+            x, labels = read_data_fn(datafiles[fid], opts)
+            data_paths[fid] = share_data(x, labels, os.path.join(taskdir, "data"), fid)
+        logger.debug("loaded file: %s" % datafiles[fid])
+
+    run_experiment_tasks(task_fn, tasks, opts, data_paths,
+                         n_parallel_tasks=n_parallel_tasks)
+
+    results = collect_sequential_results(tasks)
+    merge_task_instrumentation(tasks)
+    # results are written with the same file names as the sequential scripts
+    opts.set_multi_run_options(tasks[-1].fid, tasks[-1].runidx)
+    write_sequential_results_to_csv(results, opts)
+    return results
+
+
+def run_forest_aad_experiments(opts, n_parallel_tasks=1):
+    if opts.streaming:
+        task_fn = forest_aad_stream_task
+    else:
+        task_fn = forest_aad_task
+    return run_experiments(task_fn, opts, read_forest_aad_data, n_parallel_tasks=n_parallel_tasks)
+
+
+def run_alad_experiments(opts, n_parallel_tasks=1):
+    # alad.py uses fid 0 for --datafile
+    return run_experiments(alad_task, opts, read_alad_data, n_parallel_tasks=n_parallel_tasks,
+                           simple_fid=0)
+
+
+def main():
+    args = get_command_args(debug=False)
+    configure_logger(args)
+
+    opts = Opts(args)
+    logger.debug(opts.str_opts())
+
+    tm = Timer()
+    if opts.detector_type in [AAD_IFOREST, AAD_HSTREES, AAD_RSFOREST]:
+        run_forest_aad_experiments(opts, n_parallel_tasks=opts.n_parallel_tasks)
+    else:
+        if opts.streaming:
+            raise ValueError("Streaming supported only for tree-based detectors (%d|%d|%d)" %
+                             (AAD_IFOREST, AAD_HSTREES, AAD_RSFOREST))
+        run_alad_experiments(opts, n_parallel_tasks=opts.n_parallel_tasks)
+    logger.debug(tm.message("Completed all experiments"))
+
+
+if __name__ == "__main__":
+    main()
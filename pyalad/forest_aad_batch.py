@@ -1,5 +1,6 @@
 import os
 import numpy as np
+from copy import copy
 
 import logging
 
@@ -17,53 +18,57 @@ from gp_support import *
 """
 To debug:
     pythonw pyalad/forest_aad_batch.py
+
+To run from another module (e.g., many configurations in one process):
+    from forest_aad_batch import run_forest_aad_batch
+    results = run_forest_aad_batch(opts, X, y)
 """
 
 logger = logging.getLogger(__name__)
 
 dense = False  # DO NOT Change this!
 
-if True:
-    # PRODUCTION code
-    args = get_command_args(debug=False)
-    # print "log file: %s" % args.log_file
-    configure_logger(args)
-else:
-    # DEBUG code
-    args = prepare_forest_aad_debug_args()
-
-opts = Opts(args)
-# print opts.str_opts()
-logger.debug(opts.str_opts())
 
-if opts.streaming:
-    raise ValueError("Streaming not supported")
+def run_forest_aad_batch(opts, X_train, labels, run_tests=False, write_results=True,
+                         fid=1, runidxs=None):
+    """ Runs AAD on a tree-based detector for all reruns of one dataset
 
-run_aad = True
-run_tests = opts.plot2D and opts.reruns == 1 and opts.forest_score_type != ORIG_TREE_SCORE_TYPE
+    The data is passed in memory, hence many configurations can be run
+    in the same process without reloading the data.
 
-baseline_query_indexes_only = False
+    :param opts: Opts
+        a copy is updated with the fid and runidx of each run; opts itself is not changed
+    :param X_train: np.ndarray
+    :param labels: np.array
+    :param run_tests: bool
+        whether to run the unit tests battery (plots) on the last model
+    :param write_results: bool
+        whether to write the results to opts.resultsdir as well
+    :param fid: int
+        file id of the data; the seed of each run depends on fid and runidx
+    :param runidxs: list of int
+        the reruns to run; all reruns (opts.get_runidxs()) if None
+    :return: SequentialResults
+        None if no feedback was run (budget 0, original tree scores, or
+        baseline query indexes only)
+    """
+    opts = copy(opts)
 
-data = DataFrame.from_csv(opts.datafile, header=0, sep=',', index_col=None)
-X_train = np.zeros(shape=(data.shape[0], data.shape[1]-1))
-for i in range(X_train.shape[1]):
-    X_train[:, i] = data.iloc[:, i + 1]
-labels = np.array([1 if data.iloc[i, 0] == "anomaly" else 0 for i in range(data.shape[0])], dtype=int)
+    # the stage report written with the results covers only this call
+    reset_instrumentation()
 
-# X_train = X_train[0:10, :]
-# labels = labels[0:10]
+    baseline_query_indexes_only = False
 
-logger.debug("loaded file: %s" % opts.datafile)
-logger.debug("results dir: %s" % opts.resultsdir)
-logger.debug("forest_type: %s" % detector_types[opts.detector_type])
+    logger.debug("results dir: %s" % opts.resultsdir)
+    logger.debug("forest_type: %s" % detector_types[opts.detector_type])
 
-mdl = None
-X_train_new = None
-metrics = None
-if run_aad:
-    # use this to run AAD
+    mdl = None
+    X_train_new = None
+    metrics = None
 
-    opts.fid = 1
+    opts.fid = fid
+    if runidxs is None:
+        runidxs = opts.get_runidxs()
 
     all_num_seen = None
     all_num_seen_baseline = None
@@ -77,11 +82,11 @@ if run_aad:
 
     baseline_query_info = []
 
-    for runidx in opts.get_runidxs():
+    for runidx in runidxs:
         tm_run = Timer()
         opts.set_multi_run_options(opts.fid, runidx)
 
-        rng = np.random.RandomState(args.randseed + opts.fid * opts.reruns + runidx)
+        rng = np.random.RandomState(opts.randseed + opts.fid * opts.reruns + runidx)
 
         # fit the model
         mdl = AadForest(n_estimators=opts.forest_n_trees,
@@ -90,7 +95,9 @@ if run_aad:
                         add_leaf_nodes_only=opts.forest_add_leaf_nodes_only,
                         max_depth=opts.forest_max_depth,
                         ensemble_score=opts.ensemble_score,
-                        detector_type=opts.detector_type, n_jobs=opts.n_jobs)
+                        detector_type=opts.detector_type, n_jobs=opts.n_jobs,
+                        compact=opts.compact_model,
+                        count_all_samples=opts.forest_count_all_samples)
         mdl.fit(X_train)
 
         if opts.forest_score_type == ORIG_TREE_SCORE_TYPE:
@@ -103,7 +110,10 @@ if run_aad:
 
         logger.debug("total #nodes: %d" % (len(mdl.all_regions)))
 
-        X_train_new = mdl.transform_to_region_features(X_train, dense=dense)
+        if opts.forest_region_index:
+            X_train_new = mdl.transform_to_region_index(X_train)
+        else:
+            X_train_new = mdl.transform_to_region_features(X_train, dense=dense)
 
         w = np.ones(len(mdl.d), dtype=float)
         w = w / w.dot(w)  # normalized uniform weights
@@ -125,7 +135,7 @@ if run_aad:
 
         if metrics is not None:
             num_seen, num_seen_baseline, queried_indexes, queried_indexes_baseline = \
-                summarize_ensemble_num_seen(ensemble, metrics, fid=opts.fid)
+                summarize_ensemble_num_seen(ensemble, metrics, fid=opts.fid, runidx=runidx)
             all_num_seen = rbind(all_num_seen, num_seen)
             all_num_seen_baseline = rbind(all_num_seen_baseline, num_seen_baseline)
             all_queried_indexes = rbind(all_queried_indexes, queried_indexes)
@@ -150,23 +160,59 @@ if run_aad:
             X_train_new = None
             ensemble = None
 
+    results = None
     if all_num_seen is not None:
         results = SequentialResults(num_seen=all_num_seen, num_seen_baseline=all_num_seen_baseline,
                                     true_queried_indexes=all_queried_indexes,
                                     true_queried_indexes_baseline=all_queried_indexes_baseline)
-        write_sequential_results_to_csv(results, opts)
+        if write_results:
+            write_sequential_results_to_csv(results, opts)
     else:
         logger.debug("baseline:\n%s\norig iforest:\n%s" % (all_baseline, all_orig_iforest))
 
-    if all_orig_num_seen is not None:
+    if write_results and all_orig_num_seen is not None:
         prefix = opts.get_alad_metrics_name_prefix()
         orig_num_seen_file = os.path.join(opts.resultsdir, "%s-orig_num_seen.csv" % (prefix,))
         np.savetxt(orig_num_seen_file, all_orig_num_seen, fmt='%d', delimiter=',')
 
-    if len(baseline_query_info) > 0:
+    if write_results and len(baseline_query_info) > 0:
         write_baseline_query_indexes(baseline_query_info, opts)
 
-if run_tests:
-    forest_aad_unit_tests_battery(X_train, labels, mdl, metrics, opts,
-                                  args.resultsdir, dataset_name=args.dataset)
+    if run_tests:
+        forest_aad_unit_tests_battery(X_train, labels, mdl, metrics, opts,
+                                      opts.resultsdir, dataset_name=opts.dataset)
+
+    return results
+
+
+def main():
+    if True:
+        # PRODUCTION code
+        args = get_command_args(debug=False)
+        # print "log file: %s" % args.log_file
+        configure_logger(args)
+    else:
+        # DEBUG code
+        args = prepare_forest_aad_debug_args()
+
+    opts = Opts(args)
+    # print opts.str_opts()
+    logger.debug(opts.str_opts())
+
+    if opts.streaming:
+        raise ValueError("Streaming not supported")
+
+    run_tests = opts.plot2D and opts.reruns == 1 and opts.forest_score_type != ORIG_TREE_SCORE_TYPE
+
+    X_train, labels = read_labeled_csv(opts.datafile)
+
+    # X_train = X_train[0:10, :]
+    # labels = labels[0:10]
+
+    logger.debug("loaded file: %s" % opts.datafile)
+
+    run_forest_aad_batch(opts, X_train, labels, run_tests=run_tests)
+
 
+if __name__ == "__main__":
+    main()
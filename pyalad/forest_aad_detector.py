@@ -14,11 +14,17 @@ from forest_aad_loss import *
 from random_split_trees import *
 from gp_support import *
 from optimization import *
+from aad_scoring import *
+from region_index import *
 
+import os
+import json
 import pickle as cPickle
 import gzip
 
-from joblib import Parallel, delayed
+# only needed with multi=True
+Parallel = LazyImport("joblib", "Parallel")
+delayed = LazyImport("joblib", "delayed")
 
 
 class RegionData(object):
@@ -32,6 +38,79 @@ class RegionData(object):
         # print "Region's Path Length="+str(path_length)+"---"+str(node_samples)
 
 
+class RegionArrays(object):
+    """ Array-backed sequence of the regions in a forest
+
+    Used in place of a list of RegionData when the model is loaded from the
+    compact format (see load_aad_model_arrays). Regions are created on
+    access and their bounds are recovered from the tree structure.
+
+    Attributes:
+        path_length, node_id, node_samples, log_frac_vol, tree: np.array
+            region attributes; tree is the index of the tree of the region
+        trees: list of ArrTree
+    """
+    def __init__(self, path_length, node_id, score, node_samples, log_frac_vol, tree, trees):
+        self.path_length = path_length
+        self.node_id = node_id
+        self.score = score
+        self.node_samples = node_samples
+        self.log_frac_vol = log_frac_vol
+        self.tree = tree
+        self.trees = trees
+        self.parents = dict()
+
+    def subset(self, start, end):
+        return RegionArrays(self.path_length[start:end], self.node_id[start:end],
+                            self.score[start:end], self.node_samples[start:end],
+                            self.log_frac_vol[start:end], self.tree[start:end], self.trees)
+
+    def _get_parents(self, tree_id):
+        parents = self.parents.get(tree_id)
+        if parents is None:
+            tree = self.trees[tree_id]
+            parents = np.ones(tree.node_count, dtype=int) * -1
+            internal = np.where(tree.children_left != -1)[0]
+            parents[tree.children_left[internal]] = internal
+            parents[tree.children_right[internal]] = internal
+            self.parents[tree_id] = parents
+        return parents
+
+    def get_region(self, i):
+        """ Returns the region bounds in the same format as extract_leaf_regions_from_tree """
+        tree_id = self.tree[i]
+        tree = self.trees[tree_id]
+        parents = self._get_parents(tree_id)
+        region = {}
+        for fidx in range(tree.n_features):
+            region[fidx] = (-np.inf, np.inf)
+        node = self.node_id[i]
+        path = []
+        while parents[node] >= 0:
+            path.append(node)
+            node = parents[node]
+        for node in reversed(path):
+            parent = parents[node]
+            feature = tree.feature[parent]
+            threshold = tree.threshold[parent]
+            if tree.children_left[parent] == node:
+                region[feature] = (region[feature][0], min(region[feature][1], threshold))
+            else:
+                region[feature] = (max(region[feature][0], threshold), region[feature][1])
+        return region
+
+    def __len__(self):
+        return len(self.node_id)
+
+    def __getitem__(self, i):
+        return RegionData(self.get_region(i), self.path_length[i], self.node_id[i],
+                          self.score[i], self.node_samples[i], log_frac_vol=self.log_frac_vol[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 def is_in_region(x, region):
     d = len(x)
     for i in range(d):
@@ -67,7 +146,26 @@ class AadForest(StreamingSupport):
                  ensemble_score=ENSEMBLE_SCORE_LINEAR,
                  random_state=None,
                  add_leaf_nodes_only=False,
-                 detector_type=AAD_IFOREST, n_jobs=1, model=None):
+                 detector_type=AAD_IFOREST, n_jobs=1, model=None, compact=False,
+                 count_all_samples=False):
+        """
+        :param count_all_samples: bool
+            If True, the node sample counts of each tree are computed on all
+            the instances passed to fit() and not only on the subsample the
+            tree was built on (see RandomSplitForest).
+        :param compact: bool
+            If True, the trees are converted to the compact representation
+            (see ArrTree.compact()) when fit() is called, and the region
+            scores, region features and weights are float32. The weight
+            updates and quantiles are still computed in float64. Scores
+            agree with the full precision model up to float32 round-off,
+            i.e., a relative difference of about 1e-6 for forests of a
+            few hundred trees. The exception are instances which are within
+            float32 round-off of a split threshold and hence might go to a
+            different leaf. This is rare with isolation trees, but HS trees
+            halve the feature ranges of the data, which can put thresholds
+            next to instances at the range bounds.
+        """
         if random_state is None:
             self.random_state = np.random.RandomState(42)
         else:
@@ -92,17 +190,26 @@ class AadForest(StreamingSupport):
 
         self.ensemble_score = ensemble_score
         self.add_leaf_nodes_only = add_leaf_nodes_only
+        self.compact = compact
+        self.count_all_samples = count_all_samples
         self.clf = model
         if detector_type == AAD_IFOREST:
             # setting clf to be learned model from my code
             self.clf = model  # IForest(n_estimators=n_estimators, max_samples=max_samples,
             # n_jobs=n_jobs, random_state=self.random_state)
+            if model is None:
+                # isolation trees built on subsamples of max_samples; supports the stream updates
+                self.clf = IsolationTrees(n_estimators=n_estimators, max_samples=max_samples,
+                                          n_jobs=n_jobs, random_state=self.random_state,
+                                          count_all_samples=count_all_samples)
         elif detector_type == AAD_HSTREES:
-            self.clf = HSTrees(n_estimators=n_estimators, max_depth=max_depth,
-                               n_jobs=n_jobs, random_state=self.random_state)
+            self.clf = HSTrees(n_estimators=n_estimators, max_samples=max_samples, max_depth=max_depth,
+                               n_jobs=n_jobs, random_state=self.random_state,
+                               count_all_samples=count_all_samples)
         elif detector_type == AAD_RSFOREST:
-            self.clf = RSForest(n_estimators=n_estimators, max_depth=max_depth,
-                                n_jobs=n_jobs, random_state=self.random_state)
+            self.clf = RSForest(n_estimators=n_estimators, max_samples=max_samples, max_depth=max_depth,
+                                n_jobs=n_jobs, random_state=self.random_state,
+                                count_all_samples=count_all_samples)
         else:
             raise ValueError("Incorrect detector type: %d. Only tree-based detectors (%d|%d|%d) supported." %
                              (detector_type, AAD_IFOREST, AAD_HSTREES, AAD_RSFOREST))
@@ -116,6 +223,9 @@ class AadForest(StreamingSupport):
         # store maps of node index to region index for all trees
         self.all_node_regions = None
 
+        # arrays of node index -> region index, created from all_node_regions when needed
+        self.node_region_lookups = None
+
         # scores for each region
         self.d = None
 
@@ -132,6 +242,21 @@ class AadForest(StreamingSupport):
         # IMPORTANT: Treat this as readonly once set in fit()
         self.w_unif_prior = None
 
+        # named weight vectors learned separately (e.g., by different teams) on
+        # the same forest; column j of W (m x T) has the weights of tenant_names[j]
+        self.tenant_names = []
+        self.W = None
+
+    def __setstate__(self, state):
+        # models pickled (save_aad_model) before some of the attributes
+        # were added do not have them; use the defaults of __init__
+        self.__dict__.update(state)
+        defaults = {"compact": False, "count_all_samples": False,
+                    "node_region_lookups": None, "tenant_names": [], "W": None}
+        for name in defaults:
+            if name not in self.__dict__:
+                setattr(self, name, defaults[name])
+
     def fit_bkp(self, x):
         tm = Timer()
 
@@ -167,6 +292,9 @@ class AadForest(StreamingSupport):
         self.d, _, _ = self.get_region_scores(self.all_regions)
         self.w = self.get_uniform_weights()
         self.w_unif_prior = self.get_uniform_weights()
+        # the weights of the earlier regions are not valid anymore
+        self.tenant_names = []
+        self.W = None
         logger.debug(tm.message("created forest regions"))
 
     def fit(self, x, multi=False):
@@ -179,8 +307,15 @@ class AadForest(StreamingSupport):
         # print len(clf.estimators_)
         # print type(clf.estimators_[0].tree_)
 
+        if getattr(self.clf, "estimators_", None) is None:
+            # the forest was not passed in already fitted
+            self.clf.fit(x)
+
         logger.debug(tm.message("created original forest"))
 
+        if self.compact and hasattr(self.clf, "compact"):
+            self.clf.compact()
+
         if self.score_type == ORIG_TREE_SCORE_TYPE:
             # no need to extract regions in this case
             return
@@ -189,6 +324,7 @@ class AadForest(StreamingSupport):
         self.regions_in_forest = []
         self.all_regions = []
         self.all_node_regions = []
+        self.node_region_lookups = None
         region_id = 0
         if multi:
             argument_instances = [(i, self.clf.estimators_[i], self.add_leaf_nodes_only) for i in
@@ -223,6 +359,9 @@ class AadForest(StreamingSupport):
         self.d, _, _ = self.get_region_scores(self.all_regions)
         self.w = self.get_uniform_weights()
         self.w_unif_prior = self.get_uniform_weights()
+        # the weights of the earlier regions are not valid anymore
+        self.tenant_names = []
+        self.W = None
         logger.debug(tm.message("created forest regions"))
 
     def worker_extract_leaf_regions_from_tree(self, arg):
@@ -322,6 +461,13 @@ class AadForest(StreamingSupport):
             return 2. * (np.log(n_samples_leaf) + 0.5772156649) - 2. * (
                 n_samples_leaf - 1.) / n_samples_leaf
 
+    def _average_path_lengths(self, n_samples_leaf):
+        """ Vectorized _average_path_length() """
+        n_samples_leaf = np.asarray(n_samples_leaf, dtype=float)
+        n = np.maximum(n_samples_leaf, 1.)
+        return np.where(n_samples_leaf <= 1, 1.,
+                        2. * (np.log(n) + 0.5772156649) - 2. * (n - 1.) / n)
+
     def decision_path_full(self, x, tree):
         """Returns the node ids of all nodes from root to leaf for each sample (row) in x
         
@@ -338,6 +484,13 @@ class AadForest(StreamingSupport):
         features = tree.tree_.feature
         threshold = tree.tree_.threshold
 
+        if isinstance(tree.tree_, ArrTree):
+            # all instances are moved down the tree together; x might be sparse
+            rows, nodes, path_lengths = get_tree_paths(left, right, features, threshold, x)
+            # stable sort keeps the nodes of each row in the order from root to leaf
+            idxs = np.argsort(rows, kind="mergesort")
+            return [list(p) for p in np.split(nodes[idxs], np.cumsum(path_lengths)[0:-1])]
+
         def path_recurse(x, left, right, features, threshold, node, path_nodes):
             """Returns the node ids of all nodes that x passes through from root to leaf
             
@@ -388,40 +541,47 @@ class AadForest(StreamingSupport):
 
     def get_region_scores(self, all_regions):
         """Larger values mean more anomalous"""
-        d = np.zeros(len(all_regions))
-        node_samples = np.zeros(len(all_regions))
-        frac_insts = np.zeros(len(all_regions))
-        for i, region in enumerate(all_regions):
-            node_samples[i] = region.node_samples
-            frac_insts[i] = region.node_samples * 1.0 / self.max_samples
-            if self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN:
-                d[i] = 1. / region.path_length
-            elif self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN_EXP:
-                d[i] = 2 ** -region.path_length  # used this to run the first batch
-            elif self.score_type == IFOR_SCORE_TYPE_CONST:
-                d[i] = -1
-            elif self.score_type == IFOR_SCORE_TYPE_NEG_PATH_LEN:
-                d[i] = -region.path_length
-            elif self.score_type == HST_SCORE_TYPE:
-                # d[i] = -region.node_samples * (2. ** region.path_length)
-                # d[i] = -region.node_samples * region.path_length
-                d[i] = -np.log(region.node_samples + 1) + region.path_length
-            elif self.score_type == RSF_SCORE_TYPE:
-                d[i] = -region.node_samples * np.exp(region.log_frac_vol)
-            elif self.score_type == RSF_LOG_SCORE_TYPE:
-                d[i] = -np.log(region.node_samples + 1) - region.log_frac_vol
-            elif self.score_type == LEAF_INV_SAMPLE_SCORING:
-                d[i] = 1. / (region.path_length + self._average_path_length(region.node_samples))
-            else:
-                # if self.score_type == IFOR_SCORE_TYPE_NORM:
-                raise NotImplementedError("score_type %d not implemented!" % self.score_type)
-                # d[i] = frac_insts[i]  # RPAD-ish
-                # depth = region.path_length - 1
-                # node_samples_avg_path_length = region.score
-                # d[i] = (
-                #            depth + node_samples_avg_path_length
-                #        ) / (self.n_estimators * self._average_path_length(self.clf._max_samples))
-        return d, node_samples, frac_insts
+        if isinstance(all_regions, RegionArrays):
+            path_length = all_regions.path_length
+            node_samples = np.asarray(all_regions.node_samples, dtype=float)
+            log_frac_vol = all_regions.log_frac_vol
+        else:
+            path_length = np.array([region.path_length for region in all_regions], dtype=float)
+            node_samples = np.array([region.node_samples for region in all_regions], dtype=float)
+            log_frac_vol = np.array([region.log_frac_vol for region in all_regions], dtype=float)
+        frac_insts = node_samples * 1.0 / self.max_samples
+        if self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN:
+            d = 1. / path_length
+        elif self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN_EXP:
+            d = 2. ** -path_length  # used this to run the first batch
+        elif self.score_type == IFOR_SCORE_TYPE_CONST:
+            d = -np.ones(len(node_samples))
+        elif self.score_type == IFOR_SCORE_TYPE_NEG_PATH_LEN:
+            d = -np.asarray(path_length, dtype=float)
+        elif self.score_type == HST_SCORE_TYPE:
+            # d = -node_samples * (2. ** path_length)
+            # d = -node_samples * path_length
+            d = -np.log(node_samples + 1) + path_length
+        elif self.score_type == RSF_SCORE_TYPE:
+            d = -node_samples * np.exp(log_frac_vol)
+        elif self.score_type == RSF_LOG_SCORE_TYPE:
+            d = -np.log(node_samples + 1) - log_frac_vol
+        elif self.score_type == LEAF_INV_SAMPLE_SCORING:
+            d = 1. / (path_length + self._average_path_lengths(node_samples))
+        else:
+            # if self.score_type == IFOR_SCORE_TYPE_NORM:
+            raise NotImplementedError("score_type %d not implemented!" % self.score_type)
+            # d[i] = frac_insts[i]  # RPAD-ish
+            # depth = region.path_length - 1
+            # node_samples_avg_path_length = region.score
+            # d[i] = (
+            #            depth + node_samples_avg_path_length
+            #        ) / (self.n_estimators * self._average_path_length(self.clf._max_samples))
+        return np.asarray(d, dtype=self.get_value_dtype()), node_samples, frac_insts
+
+    def get_value_dtype(self):
+        """dtype of the region scores, region features and weights"""
+        return np.float32 if self.compact else float
 
     def get_score(self, x, w=None):
         """Higher score means more anomalous"""
@@ -434,12 +594,14 @@ class AadForest(StreamingSupport):
             w = self.w
         if w is None:
             raise ValueError("weights not initialized")
-        if self.ensemble_score == ENSEMBLE_SCORE_LINEAR:
-            return x.dot(w)
-        elif self.ensemble_score == ENSEMBLE_SCORE_EXPONENTIAL:
-            return np.exp(x.dot(w))
-        else:
-            raise NotImplementedError("score_type %d not implemented!" % self.score_type)
+        count_event("rows_scored", x.shape[0])
+        with span("score"):
+            if self.ensemble_score == ENSEMBLE_SCORE_LINEAR:
+                return x.dot(w)
+            elif self.ensemble_score == ENSEMBLE_SCORE_EXPONENTIAL:
+                return np.exp(x.dot(w))
+            else:
+                raise NotImplementedError("score_type %d not implemented!" % self.score_type)
 
     def decision_function(self, x):
         """Returns the decision function for the original underlying classifier"""
@@ -454,9 +616,18 @@ class AadForest(StreamingSupport):
             raise ValueError("Detector does not support incremental update")
         if current:
             raise ValueError("Only current=False supported")
-        self.clf.add_samples(X, current=current)
+        count_event("rows_ingested", X.shape[0])
+        with span("tree_ingest"):
+            self.clf.add_samples(X, current=current)
 
     def update_region_scores(self):
+        if isinstance(self.all_regions, RegionArrays):
+            for i, estimator in enumerate(self.clf.estimators_):
+                regions = np.where(self.all_regions.tree == i)[0]
+                self.all_regions.node_samples[regions] = \
+                    estimator.tree_.n_node_samples[self.all_regions.node_id[regions]]
+            self.d, _, _ = self.get_region_scores(self.all_regions)
+            return
         for i, estimator in enumerate(self.clf.estimators_):
             tree = estimator.tree_
             node_regions = self.all_node_regions[i]
@@ -466,10 +637,11 @@ class AadForest(StreamingSupport):
         self.d, _, _ = self.get_region_scores(self.all_regions)
 
     def update_model_from_stream_buffer(self):
-        self.clf.update_model_from_stream_buffer()
-        # for i, estimator in enumerate(self.clf.estimators_):
-        #    estimator.tree.tree_.update_model_from_stream_buffer()
-        self.update_region_scores()
+        with span("model_update"):
+            self.clf.update_model_from_stream_buffer()
+            # for i, estimator in enumerate(self.clf.estimators_):
+            #    estimator.tree.tree_.update_model_from_stream_buffer()
+            self.update_region_scores()
 
     def get_region_score_for_instance_transform(self, region_id, norm_factor=1.0):
         if (self.score_type == IFOR_SCORE_TYPE_CONST or
@@ -497,14 +669,66 @@ class AadForest(StreamingSupport):
             of nodes.
         :return:
         """
-        if dense:
-            return self.transform_to_region_features_dense(x)
-        else:
-            return self.transform_to_region_features_sparse(x, multi)
+        count_event("rows_transformed", x.shape[0])
+        with span("transform"):
+            if dense:
+                return self.transform_to_region_features_dense(x)
+            else:
+                return self.transform_to_region_features_sparse(x, multi)
+
+    def transform_to_region_index(self, x):
+        """ Transforms matrix x to the fixed-width region index representation
+
+        Only supported when the forest has only leaf regions, in which case
+        each instance has exactly one region per tree. The returned
+        RegionIndexMatrix can be used wherever the sparse matrix returned
+        by transform_to_region_features(x, dense=False) is used.
+
+        :param x: np.ndarray
+            Input data in original feature space
+        :return: RegionIndexMatrix
+        """
+        if not self.add_leaf_nodes_only:
+            raise ValueError("Region index representation requires add_leaf_nodes_only=True")
+        count_event("rows_transformed", x.shape[0])
+        with span("transform"):
+            x = self.get_traversal_input(x)
+            regions = np.zeros(shape=(x.shape[0], len(self.clf.estimators_)), dtype=np.int32)
+            for i, tree in enumerate(self.clf.estimators_):
+                regions[:, i] = self.get_node_region_lookup(i)[tree.apply(x)]
+            return RegionIndexMatrix(regions, self.d)
+
+    def get_traversal_input(self, x):
+        """ Returns x in the form in which it is passed down all the trees
+
+        Dense x is returned as is. When all trees are ArrTree, sparse
+        x (CSR or CSC) is wrapped once in a SparseElementLookup which all
+        the trees use, without densifying x. Other (sklearn) trees get the
+        sparse matrix as is.
+        """
+        if not sparse.issparse(x):
+            return x
+        if all([isinstance(tree.tree_, ArrTree) for tree in self.clf.estimators_]):
+            return get_element_lookup(x)
+        return x
+
+    def get_node_region_lookup(self, i):
+        """ Returns the array node index -> region index (-1 if not a region) of tree i """
+        node_regions = self.all_node_regions[i]
+        if isinstance(node_regions, np.ndarray):
+            return node_regions
+        if self.node_region_lookups is None:
+            self.node_region_lookups = [None] * len(self.all_node_regions)
+        if self.node_region_lookups[i] is None:
+            lookup = -np.ones(self.clf.estimators_[i].tree_.node_count, dtype=np.int32)
+            for node_id in node_regions:
+                lookup[node_id] = node_regions[node_id]
+            self.node_region_lookups[i] = lookup
+        return self.node_region_lookups[i]
 
     def transform_to_region_features_dense(self, x):
         # return transform_features(x, self.all_regions, self.d)
-        x_new = np.zeros(shape=(x.shape[0], len(self.d)), dtype=float)
+        x_new = np.zeros(shape=(x.shape[0], len(self.d)), dtype=self.get_value_dtype())
         self._transform_to_region_features_with_lookup(x, x_new)
         return x_new
 
@@ -566,10 +790,10 @@ class AadForest(StreamingSupport):
         batch_size = 10000
         start_batch = 0
         end_batch = min(start_batch + batch_size, n)
-        x_new = csr_matrix((0, m), dtype=float)
+        x_new = csr_matrix((0, m), dtype=self.get_value_dtype())
         while start_batch < end_batch:
             starttime = timer()
-            x_tmp = matrix(x[start_batch:end_batch, :], ncol=x.shape[1])
+            x_tmp = self.get_traversal_input(x[start_batch:end_batch, :])
             x_tmp_new = lil_matrix((end_batch - start_batch, m), dtype=x_new.dtype)
 
             if multi:
@@ -655,8 +879,10 @@ class AadForest(StreamingSupport):
     def get_aatp_quantile(self, x, w, topK):
         # IMPORTANT: qval will be computed using the linear dot product
         # s = self.get_score(x, w)
-        s = x.dot(w)
-        return quantile(s, (1.0 - (topK * 1.0 / float(nrow(x)))) * 100.0)
+        with span("quantile"):
+            # accumulate in float64 even if x and w are compact (float32)
+            s = x.dot(np.asarray(w, dtype=float))
+            return quantile(s, (1.0 - (topK * 1.0 / float(nrow(x)))) * 100.0)
 
     def get_truncated_constraint_set(self, w, x, y, hf,
                                      max_anomalies_in_constraint_set=1000,
@@ -697,9 +923,13 @@ class AadForest(StreamingSupport):
         else:
             in_set = np.ones(len(hf), dtype=int)
 
+        count_event("constraints", int(np.sum(in_set)))
         return hf, in_set
 
     def forest_aad_weight_update(self, w, x, y, hf, w_prior, opts, tau_rel=False, linear=True):
+        # the optimization is always in float64, even if the weights are compact (float32)
+        w = np.asarray(w, dtype=float)
+        w_prior = np.asarray(w_prior, dtype=float)
         n = x.shape[0]
         bt = get_budget_topK(n, opts)
 
@@ -781,11 +1011,26 @@ class AadForest(StreamingSupport):
         w_unif = w_unif / np.sqrt(w_unif.dot(w_unif))
         # logger.debug("w_prior:")
         # logger.debug(w_unif)
-        return w_unif
+        return np.asarray(w_unif, dtype=self.get_value_dtype())
 
     def order_by_score(self, x, w=None):
         anom_score = self.get_score(x, w)
-        return order(anom_score, decreasing=True), anom_score
+        with span("order"):
+            return order(anom_score, decreasing=True), anom_score
+
+    def score(self, x, w=None):
+        """ Scores instances in the original feature space; higher is more anomalous
+
+        Same as AadScoringModel.score(), so that score_in_chunks() works with
+        either model. The region features are sparse (or the region index when
+        the forest has only leaf regions), hence memory depends on the number
+        of rows in x and not on the number of regions.
+        """
+        if self.add_leaf_nodes_only:
+            x_new = self.transform_to_region_index(x)
+        else:
+            x_new = self.transform_to_region_features(x, dense=False)
+        return self.get_score(x_new, w)
 
     def update_weights(self, x, y, ha, hn, opts, w=None):
         """Learns new weights for one feedback iteration
@@ -802,6 +1047,10 @@ class AadForest(StreamingSupport):
             w: np.array(dtype=float)
                 current parameter values
         """
+        self.w = self.get_updated_weights(x, y, ha, hn, opts, w=w)
+
+    def get_updated_weights(self, x, y, ha, hn, opts, w=None):
+        """Same as update_weights() but returns the new weights instead of setting self.w"""
         n, m = x.shape
         bt = get_budget_topK(n, opts)
 
@@ -814,24 +1063,125 @@ class AadForest(StreamingSupport):
             w_prior = w
 
         tau_rel = opts.constrainttype == AAD_CONSTRAINT_TAU_INSTANCE
-        if (opts.detector_type == AAD_IFOREST or
-                    opts.detector_type == AAD_HSTREES or
-                    opts.detector_type == AAD_RSFOREST):
-            w_new = self.forest_aad_weight_update(w, x, y, hf=append(ha, hn),
-                                                  w_prior=w_prior, opts=opts, tau_rel=tau_rel,
-                                                  linear=(self.ensemble_score == ENSEMBLE_SCORE_LINEAR))
-        elif opts.detector_type == ATGP_IFOREST:
-            w_soln = weight_update_iter_grad(x, y,
-                                             hf=append(ha, hn),
-                                             Ca=opts.Ca, Cn=opts.Cn, Cx=opts.Cx,
-                                             topK=bt.topK, max_iters=1000)
-            w_new = w_soln.w
-        else:
-            raise ValueError("Invalid weight update for IForest: %d" % opts.detector_type)
+        with span("weight_update"):
+            if (opts.detector_type == AAD_IFOREST or
+                        opts.detector_type == AAD_HSTREES or
+                        opts.detector_type == AAD_RSFOREST):
+                w_new = self.forest_aad_weight_update(w, x, y, hf=append(ha, hn),
+                                                      w_prior=w_prior, opts=opts, tau_rel=tau_rel,
+                                                      linear=(self.ensemble_score == ENSEMBLE_SCORE_LINEAR))
+            elif opts.detector_type == ATGP_IFOREST:
+                w_soln = weight_update_iter_grad(x, y,
+                                                 hf=append(ha, hn),
+                                                 Ca=opts.Ca, Cn=opts.Cn, Cx=opts.Cx,
+                                                 topK=bt.topK, max_iters=1000)
+                w_new = w_soln.w
+            else:
+                raise ValueError("Invalid weight update for IForest: %d" % opts.detector_type)
             # logger.debug("w_new:")
             # logger.debug(w_new)
 
-        self.w = w_new
+        return np.asarray(w_new, dtype=self.get_value_dtype())
+
+    def get_tenant_index(self, name):
+        if name not in self.tenant_names:
+            raise ValueError("Unknown tenant '%s'" % name)
+        return self.tenant_names.index(name)
+
+    def add_tenant_weights(self, name, w=None):
+        """Registers a named weight vector; uniform weights if w is None"""
+        if name in self.tenant_names:
+            raise ValueError("Tenant '%s' already exists" % name)
+        if w is None:
+            w = self.w_unif_prior
+        if len(w) != len(self.d):
+            raise ValueError("Expected weight vector of length %d, found %d" % (len(self.d), len(w)))
+        w = np.asarray(w, dtype=self.get_value_dtype()).reshape((-1, 1))
+        if self.W is None:
+            self.W = w.copy()
+        else:
+            self.W = np.hstack([self.W, w])
+        self.tenant_names.append(name)
+
+    def remove_tenant_weights(self, name):
+        j = self.get_tenant_index(name)
+        self.W = np.delete(self.W, j, axis=1) if len(self.tenant_names) > 1 else None
+        del self.tenant_names[j]
+
+    def get_tenant_weights(self, name):
+        return np.array(self.W[:, self.get_tenant_index(name)])
+
+    def update_tenant_weights(self, name, x, y, ha, hn, opts):
+        """Learns new weights of one tenant for one feedback iteration
+
+        Same as update_weights() on the tenant's weights; only the column of
+        the tenant in W is changed.
+        """
+        j = self.get_tenant_index(name)
+        w_new = self.get_updated_weights(x, y, ha, hn, opts, w=np.array(self.W[:, j]))
+        if not self.W.flags.writeable:
+            # e.g., memory-mapped by load_aad_model_arrays()
+            self.W = np.array(self.W)
+        self.W[:, j] = w_new
+
+    def get_tenant_scores(self, x, tenants=None):
+        """Scores already transformed instances with the weights of many tenants together
+
+        :param x: csr_matrix, np.ndarray or RegionIndexMatrix
+            instances transformed to region features
+        :param tenants: list of str
+            all tenants if None
+        :return: np.ndarray
+            (n x len(tenants)) matrix of scores; higher is more anomalous
+        """
+        if self.W is None:
+            raise ValueError("No tenant weights registered")
+        W = self.W
+        if tenants is not None:
+            W = W[:, [self.get_tenant_index(name) for name in tenants]]
+        count_event("rows_scored", x.shape[0])
+        with span("score"):
+            s = np.asarray(x.dot(W))
+            if self.ensemble_score == ENSEMBLE_SCORE_LINEAR:
+                return s
+            elif self.ensemble_score == ENSEMBLE_SCORE_EXPONENTIAL:
+                return np.exp(s)
+            else:
+                raise NotImplementedError("score_type %d not implemented!" % self.score_type)
+
+    def score_tenants(self, x, tenants=None, topK=0, transformed=False):
+        """Scores a batch for many tenants with a single transform
+
+        :param x: np.ndarray
+            instances in the original feature space (or already transformed
+            if transformed=True)
+        :param tenants: list of str
+            all tenants if None
+        :param topK: int
+            number of top ranked instances to return per tenant
+        :return: (dict, dict)
+            tenant name -> scores, and tenant name -> indexes of the topK
+            instances in decreasing order of scores (empty if topK is 0)
+        """
+        if tenants is None:
+            tenants = list(self.tenant_names)
+        if not transformed:
+            if self.add_leaf_nodes_only:
+                x = self.transform_to_region_index(x)
+            else:
+                x = self.transform_to_region_features(x, dense=False)
+        S = self.get_tenant_scores(x, tenants)
+        scores = dict()
+        top = dict()
+        k = min(topK, S.shape[0])
+        for j, name in enumerate(tenants):
+            scores[name] = S[:, j]
+            if k > 0:
+                top_idxs = np.argpartition(-S[:, j], k - 1)[0:k]
+                top[name] = top_idxs[np.argsort(-S[top_idxs, j])]
+            else:
+                top[name] = np.zeros(0, dtype=int)
+        return scores, top
 
     def aad_learn_ensemble_weights_with_budget(self, ensemble, opts):
 
@@ -848,11 +1198,12 @@ class AadForest(StreamingSupport):
         ha = []
         hn = []
         xis = []
+        queried = MarkedSet(n)  # same as xis, for fast lookups
 
         qstate = Query.get_initial_query_state(opts.qtype, opts=opts, qrank=bt.topK,
                                                a=1., b=1., budget=bt.budget)
 
-        metrics.all_weights = np.zeros(shape=(opts.budget, m))
+        metrics.all_weights = get_weight_history(m, opts)
 
         w_unif_prior = self.get_uniform_weights(m)
         if self.w is None:
@@ -863,7 +1214,7 @@ class AadForest(StreamingSupport):
             starttime_iter = timer()
 
             # save the weights in each iteration for later analysis
-            metrics.all_weights[i, :] = self.w
+            metrics.all_weights.append(self.w)
             metrics.queried = xis  # xis keeps growing with each feedback iteration
 
             order_anom_idxs, anom_score = self.order_by_score(x, self.w)
@@ -880,15 +1231,18 @@ class AadForest(StreamingSupport):
                     metrics.train_precs[k][0, i] = prec[k]
                     metrics.train_n_at_top[k][0, i] = train_n_at_top[k]
 
-            xi_ = qstate.get_next_query(maxpos=n, ordered_indexes=order_anom_idxs,
-                                        queried_items=xis,
-                                        x=x, lbls=y, y=anom_score,
-                                        w=self.w, hf=append(ha, hn),
-                                        remaining_budget=opts.budget - i)
+            with span("query"):
+                xi_ = qstate.get_next_query(maxpos=n, ordered_indexes=order_anom_idxs,
+                                            queried_items=queried,
+                                            x=x, lbls=y, y=anom_score,
+                                            w=self.w, hf=append(ha, hn),
+                                            remaining_budget=opts.budget - i)
             # logger.debug("xi: %d" % (xi,))
             xi = xi_[0]
             xis.append(xi)
+            queried.mark(xi)
             metrics.test_indexes.append(qstate.test_indexes)
+            count_event("feedback_iterations")
 
             if opts.single_inst_feedback:
                 # Forget the previous feedback instances and
@@ -991,13 +1345,167 @@ def save_aad_model(filepath, model):
     f.close()
 
 
-def load_aad_model(filepath):
+def load_aad_model(filepath, mmap_mode='r'):
+    """ Loads a model saved by save_aad_model or save_aad_model_arrays (directory) """
+    if os.path.isdir(filepath):
+        return load_aad_model_arrays(filepath, mmap_mode=mmap_mode)
     f = gzip.open(filepath, 'rb')
     model = cPickle.load(f)
     f.close()
     return model
 
 
+def save_aad_model_arrays(dirpath, model):
+    """ Saves an AadForest as flat arrays, one .npy file per array, in directory dirpath
+
+    The trees are concatenated node-wise (tree_offsets[i] is the first node
+    of tree i), node_regions maps each node to its region id (-1 if none),
+    and the regions are stored as region_* arrays. The scalar attributes and
+    the format version are stored in meta.json which is written last.
+    """
+    if model.score_type == ORIG_TREE_SCORE_TYPE:
+        raise ValueError("Compact model format requires forest regions; score type %d has none" %
+                         model.score_type)
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    trees = [estimator.tree_ for estimator in model.clf.estimators_]
+    node_counts = np.array([tree.node_count for tree in trees], dtype=int)
+    tree_offsets = np.append([0], np.cumsum(node_counts))
+    arrays = dict()
+    arrays["tree_offsets"] = tree_offsets
+    arrays["tree_max_depth"] = np.array([tree.max_depth for tree in trees], dtype=int)
+    for name in AAD_MODEL_TREE_ARRAYS:
+        if name == "v":
+            default = 1.
+        else:
+            default = 0.
+        vals = []
+        for tree, node_count in zip(trees, node_counts):
+            if hasattr(tree, name):
+                vals.append(np.asarray(getattr(tree, name))[0:node_count])
+            else:
+                # sklearn trees do not have the streaming/volume arrays
+                vals.append(np.ones(node_count, dtype=float) * default)
+        arrays[name] = np.concatenate(vals)
+    arrays["n_node_samples"] = np.asarray(arrays["n_node_samples"], dtype=float)
+    node_regions = np.ones(tree_offsets[-1], dtype=int) * -1
+    for i, tree_node_regions in enumerate(model.all_node_regions):
+        if isinstance(tree_node_regions, dict):
+            node_ids = np.array(list(tree_node_regions.keys()), dtype=int)
+            region_ids = np.array(list(tree_node_regions.values()), dtype=int)
+            node_regions[tree_offsets[i] + node_ids] = region_ids
+        else:
+            node_regions[tree_offsets[i]:tree_offsets[i + 1]] = tree_node_regions
+    arrays["node_regions"] = node_regions
+    if isinstance(model.all_regions, RegionArrays):
+        for name in AAD_MODEL_REGION_ARRAYS:
+            arrays["region_" + name] = getattr(model.all_regions, name)
+    else:
+        region_tree = np.zeros(len(model.all_regions), dtype=int)
+        start = 0
+        for i, regions in enumerate(model.regions_in_forest):
+            region_tree[start:(start + len(regions))] = i
+            start += len(regions)
+        regions = model.all_regions
+        arrays["region_path_length"] = np.array([r.path_length for r in regions], dtype=int)
+        arrays["region_node_id"] = np.array([r.node_id for r in regions], dtype=int)
+        arrays["region_score"] = np.array([r.score for r in regions], dtype=float)
+        arrays["region_node_samples"] = np.array([r.node_samples for r in regions], dtype=float)
+        arrays["region_log_frac_vol"] = np.array([r.log_frac_vol for r in regions], dtype=float)
+        arrays["region_tree"] = region_tree
+    arrays["d"] = model.d
+    arrays["w"] = model.w
+    arrays["w_unif_prior"] = model.w_unif_prior
+    if model.W is not None:
+        arrays["tenant_W"] = model.W
+    for name in arrays:
+        np.save(os.path.join(dirpath, "%s.npy" % name), np.asarray(arrays[name]))
+    meta = {"format_version": AAD_MODEL_ARRAYS_FORMAT_VERSION,
+            "detector_type": model.detector_type,
+            "n_estimators": len(trees),
+            "max_samples": model.max_samples,
+            "score_type": model.score_type,
+            "ensemble_score": model.ensemble_score,
+            "add_leaf_nodes_only": model.add_leaf_nodes_only,
+            "compact": model.compact,
+            "tenant_names": list(model.tenant_names),
+            "n_features": int(trees[0].n_features) if len(trees) > 0 else 0}
+    for key in meta:
+        if isinstance(meta[key], np.generic):
+            meta[key] = meta[key].item()
+    with open(os.path.join(dirpath, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_aad_model_arrays(dirpath, mmap_mode='r'):
+    """ Loads an AadForest saved by save_aad_model_arrays
+
+    The arrays are memory-mapped, hence loading is fast and the pages are
+    shared by processes that load the same model. With mmap_mode='r' the model
+    is read-only, i.e., it supports scoring and weight updates but not stream
+    updates to the trees. Use mmap_mode='c' (copy-on-write) or None to
+    update the loaded model.
+
+    Trees of all detector types are loaded as ArrTree (see
+    get_arr_tree_from_arrays).
+    """
+    meta = load_aad_model_meta(dirpath)
+
+    def load_array(name):
+        return load_aad_model_array(dirpath, name, mmap_mode=mmap_mode)
+
+    detector_type = meta["detector_type"]
+    model = AadForest(n_estimators=meta["n_estimators"], max_samples=meta["max_samples"],
+                      score_type=meta["score_type"], ensemble_score=meta["ensemble_score"],
+                      add_leaf_nodes_only=meta["add_leaf_nodes_only"],
+                      detector_type=detector_type, compact=meta.get("compact", False))
+    if detector_type == AAD_HSTREES:
+        estimator_type = HSTree
+    elif detector_type == AAD_RSFOREST:
+        estimator_type = RSTree
+    elif detector_type == AAD_IFOREST:
+        estimator_type = RandomSplitTree
+        model.clf.max_samples_ = meta["max_samples"]
+    else:
+        estimator_type = RandomSplitTree
+        model.clf = RandomSplitForest(n_estimators=meta["n_estimators"])
+
+    tree_offsets = load_array("tree_offsets")
+    tree_max_depth = load_array("tree_max_depth")
+    tree_arrays = dict([(name, load_array(name)) for name in AAD_MODEL_TREE_ARRAYS])
+    node_regions = load_array("node_regions")
+    estimators = []
+    all_node_regions = []
+    for i in range(meta["n_estimators"]):
+        start, end = tree_offsets[i], tree_offsets[i + 1]
+        tree_i = dict([(name, tree_arrays[name][start:end]) for name in AAD_MODEL_TREE_ARRAYS])
+        estimator = estimator_type(max_depth=tree_max_depth[i])
+        estimator.n_features_ = meta["n_features"]
+        estimator.tree_ = get_arr_tree_from_arrays(meta["n_features"], max_depth=tree_max_depth[i],
+                                                   **tree_i)
+        # the saved arrays of a compact model already have the compact dtypes
+        estimator.tree_.is_compact = model.compact
+        estimators.append(estimator)
+        # node id -> region id lookup, used in the same way as the dicts created in fit()
+        all_node_regions.append(node_regions[start:end])
+    model.clf.estimators_ = estimators
+
+    region_arrays = dict([(name, load_array("region_" + name)) for name in AAD_MODEL_REGION_ARRAYS])
+    region_arrays["trees"] = [estimator.tree_ for estimator in estimators]
+    model.all_regions = RegionArrays(**region_arrays)
+    region_offsets = np.searchsorted(model.all_regions.tree, np.arange(meta["n_estimators"] + 1))
+    model.regions_in_forest = [model.all_regions.subset(region_offsets[i], region_offsets[i + 1])
+                               for i in range(meta["n_estimators"])]
+    model.all_node_regions = all_node_regions
+    model.d = load_array("d")
+    model.w = load_array("w")
+    model.w_unif_prior = load_array("w_unif_prior")
+    if len(meta.get("tenant_names", [])) > 0:
+        model.tenant_names = list(meta["tenant_names"])
+        model.W = load_array("tenant_W")
+    return model
+
+
 def get_forest_aad_args(dataset="", detector_type=AAD_IFOREST,
                         n_trees=100, n_samples=256,
                         forest_add_leaf_nodes_only=False,
@@ -137,7 +137,9 @@ if run_aad:
                         add_leaf_nodes_only=opts.forest_add_leaf_nodes_only,
                         max_depth=opts.forest_max_depth,
                         ensemble_score=opts.ensemble_score,
-                        detector_type=forest_type, n_jobs=opts.n_jobs)
+                        detector_type=forest_type, n_jobs=opts.n_jobs,
+                        compact=opts.compact_model,
+                        count_all_samples=opts.forest_count_all_samples)
         mdl.fit(X_train)
         logger.debug("total #nodes: %d" % (len(mdl.all_regions)))
 
@@ -214,7 +216,9 @@ if run_tests:
                         add_leaf_nodes_only=opts.forest_add_leaf_nodes_only,
                         max_depth=opts.forest_max_depth,
                         ensemble_score=opts.ensemble_score,
-                        detector_type=forest_type, n_jobs=opts.n_jobs)
+                        detector_type=forest_type, n_jobs=opts.n_jobs,
+                        compact=opts.compact_model,
+                        count_all_samples=opts.forest_count_all_samples)
         mdl.fit(X_train)
 
     forest_aad_unit_tests_battery(X_train, labels, mdl, metrics, opts,
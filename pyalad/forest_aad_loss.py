@@ -2,6 +2,19 @@ import numpy as np
 from r_support import *
 
 
+def get_weighted_rows_sum(x, c):
+    """ Returns sum_i c[i] * x[i, :] as a dense vector
+
+    Same as x.T.dot(c) for np.ndarray, csr_matrix and RegionIndexMatrix x.
+    """
+    return np.asarray(x.T.dot(c), dtype=float).reshape(-1)
+
+
+def get_rows_sum(x, idxs):
+    """ Returns the sum of the rows idxs of x as a dense vector """
+    return get_weighted_rows_sum(x, np.bincount(idxs, minlength=nrow(x)).astype(float))
+
+
 def forest_aad_loss_linear(w, xi, yi, qval, in_constr_set=None, x_tau=None, Ca=1.0, Cn=1.0, Cx=1.0,
                            withprior=False, w_prior=None, sigma2=1.0):
     """
@@ -140,15 +153,19 @@ def forest_aad_loss_gradient_linear(w, xi, yi, qval, in_constr_set=None, x_tau=N
     anom_tau_idxs = np.array(anom_tau_idxs, dtype=int)
     noml_tau_idxs = np.array(noml_tau_idxs, dtype=int)
 
+    x_tau_row = None
+    if len(anom_tau_idxs) > 0 or len(noml_tau_idxs) > 0:
+        x_tau_row = get_rows_sum(x_tau, [0])
+
     if len(anom_idxs) > 0:
-        loss_a[:] = -Ca * np.sum(xi[anom_idxs], axis=0)
+        loss_a[:] = -Ca * get_rows_sum(xi, anom_idxs)
     if len(anom_tau_idxs) > 0:
-        loss_a[:] = loss_a + Cx * (len(anom_tau_idxs) * x_tau - np.sum(xi[anom_tau_idxs], axis=0))
+        loss_a[:] = loss_a + Cx * (len(anom_tau_idxs) * x_tau_row - get_rows_sum(xi, anom_tau_idxs))
 
     if len(noml_idxs) > 0:
-        loss_n[:] = Cn * np.sum(xi[noml_idxs], axis=0)
+        loss_n[:] = Cn * get_rows_sum(xi, noml_idxs)
     if len(noml_tau_idxs) > 0:
-        loss_n[:] = loss_n + Cx * (np.sum(xi[noml_tau_idxs], axis=0) - len(noml_tau_idxs) * x_tau)
+        loss_n[:] = loss_n + Cx * (get_rows_sum(xi, noml_tau_idxs) - len(noml_tau_idxs) * x_tau_row)
 
     grad[0:m] = (loss_a / max(1, n_anom)) + (loss_n / max(1, n_noml))
 
@@ -239,8 +256,12 @@ def forest_aad_loss_gradient_exp(w, xi, yi, qval, in_constr_set=None, x_tau=None
     """
     vals = xi.dot(w)
     m = ncol(xi)
-    loss_a = rep(0, m)  # the derivative of loss w.r.t w for anomalies
-    loss_n = rep(0, m)  # the derivative of loss w.r.t w for nominals
+    # the gradients are sums of weighted rows of xi; the row weights are
+    # collected first and the rows are summed together at the end
+    c_a = np.zeros(len(yi), dtype=float)  # row weights of the derivative of loss w.r.t w for anomalies
+    c_n = np.zeros(len(yi), dtype=float)  # row weights of the derivative of loss w.r.t w for nominals
+    n_tau_a = 0
+    n_tau_n = 0
     n_anom = 0
     n_noml = 0
     tau_score = None
@@ -251,12 +272,12 @@ def forest_aad_loss_gradient_exp(w, xi, yi, qval, in_constr_set=None, x_tau=None
         if lbl == 1 and vals[i] < qval:
             exp_diff = np.minimum(np.exp(qval - vals[i]), 1000)  # element-wise
             # exp_diff = np.exp(qval - vals[i])
-            loss_a[:] = loss_a - Ca * exp_diff * xi[i, :]
+            c_a[i] -= Ca * exp_diff
             n_anom += 1
         elif lbl == 0 and vals[i] >= qval:
             exp_diff = np.minimum(np.exp(vals[i] - qval), 1000)  # element-wise
             # exp_diff = np.exp(vals[i] - qval)
-            loss_n[:] = loss_n + Cn * exp_diff * xi[i, :]
+            c_n[i] += Cn * exp_diff
             n_noml += 1
         else:
             # no loss
@@ -273,13 +294,24 @@ def forest_aad_loss_gradient_exp(w, xi, yi, qval, in_constr_set=None, x_tau=None
             #   Cx * (xi - x_tau)  if y1 = 0 and (xi - x_tau).w > 0
             tau_val = tau_score[0]
             if lbl == 1 and vals[i] < tau_val:
-                loss_a[:] = loss_a + Cx * (x_tau - xi[i, :])
+                # loss_a[:] = loss_a + Cx * (x_tau - xi[i, :])
+                c_a[i] -= Cx
+                n_tau_a += 1
             elif lbl == 0 and vals[i] >= tau_val:
-                loss_n[:] = loss_n + Cx * (xi[i, :] - x_tau)
+                # loss_n[:] = loss_n + Cx * (xi[i, :] - x_tau)
+                c_n[i] += Cx
+                n_tau_n += 1
             else:
                 # no loss
                 pass
 
+    loss_a = get_weighted_rows_sum(xi, c_a)  # the derivative of loss w.r.t w for anomalies
+    loss_n = get_weighted_rows_sum(xi, c_n)  # the derivative of loss w.r.t w for nominals
+    if n_tau_a > 0 or n_tau_n > 0:
+        x_tau_row = get_rows_sum(x_tau, [0])
+        loss_a += Cx * n_tau_a * x_tau_row
+        loss_n -= Cx * n_tau_n * x_tau_row
+
     dl_dw = (loss_a / max(1, n_anom)) + (loss_n / max(1, n_noml))
 
     if withprior and w_prior is not None:
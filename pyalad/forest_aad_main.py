@@ -50,7 +50,7 @@ opts.fid = 1  # do not change this!
 runidx = 0  # do not change this!
 opts.set_multi_run_options(opts.fid, runidx)
 
-if opts.load_model and opts.modelfile != "" and os.path.isfile(opts.modelfile):
+if opts.load_model and opts.modelfile != "" and os.path.exists(opts.modelfile):
     logger.debug("Loading model from file %s" % opts.modelfile)
     mdl = load_aad_model(opts.modelfile)
 else:
@@ -59,7 +59,8 @@ else:
     mdl = AadForest(n_estimators=opts.ifor_n_trees,
                     max_samples=min(opts.ifor_n_samples, X_train.shape[0]),
                     score_type=opts.ifor_score_type, random_state=rng,
-                    add_leaf_nodes_only=opts.ifor_add_leaf_nodes_only)
+                    add_leaf_nodes_only=opts.ifor_add_leaf_nodes_only,
+                    count_all_samples=opts.forest_count_all_samples)
     mdl.fit(X_train)
 
 logger.debug("total #nodes: %d" % (len(mdl.all_regions)))
@@ -94,4 +95,7 @@ results = SequentialResults(num_seen=all_num_seen, num_seen_baseline=all_num_see
 write_sequential_results_to_csv(results, opts)
 
 if opts.save_model:
-    save_aad_model(opts.modelfile, mdl)
+    if opts.model_arrays:
+        save_aad_model_arrays(opts.modelfile, mdl)
+    else:
+        save_aad_model(opts.modelfile, mdl)
@@ -1,7 +1,10 @@
 import os
 import numpy as np
+from copy import copy
 
 import logging
+import threading
+from sklearn.externals.six.moves import queue
 
 from app_globals import *
 from alad_support import *
@@ -15,6 +18,10 @@ from data_stream import *
 """
 To debug:
     pythonw pyalad/forest_aad_stream.py
+
+To run from another module (e.g., many configurations in one process):
+    from forest_aad_stream import run_forest_aad_stream
+    results = run_forest_aad_stream(opts, lambda: DataStream(X, y))
 """
 
 logger = logging.getLogger(__name__)
@@ -267,13 +274,69 @@ class StreamingAnomalyDetector(object):
         ordered_indexes, scores = self.model.order_by_score(x, w=w)
         bt = get_budget_topK(n_instances, opts)
         tn = min(10, nrow(x))
-        vars = np.zeros(tn, dtype=float)
-        for i in np.arange(tn):
-            vars[i] = get_linear_score_variance(x[ordered_indexes[i], :], w)
+        _, vars = get_linear_score_variances(x, w, indexes=ordered_indexes[np.arange(tn)])
         # logger.debug("top %d vars:\n%s" % (tn, str(list(vars))))
         return vars
 
 
+class StreamPrefetcher(object):
+    """ Ingests the next stream window in a background thread
+
+    For each requested window, the worker reads the instances from the
+    stream, adds them to the tree buffer counts and transforms them to
+    region features. This overlaps with the feedback loop on the current
+    window because the feedback only changes the weights, while the
+    region features depend on the region scores that change only in
+    update_model_from_buffer(). Requests and windows pass through bounded
+    queues, and a new window must be requested only after the model has
+    been updated from the previous one so that the buffer counts stay
+    consistent at window boundaries.
+    """
+    def __init__(self, sad, max_pending=1):
+        self.sad = sad
+        self.requests = queue.Queue(maxsize=max_pending)
+        self.windows = queue.Queue(maxsize=max_pending)
+        self.worker = threading.Thread(target=self._ingest)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _ingest(self):
+        while True:
+            n = self.requests.get()
+            if n is None:
+                break
+            try:
+                x, y = self.sad.stream.read_next_from_stream(n)
+                x_new = None
+                if x is not None:
+                    self.sad.model.add_samples(x, current=False)
+                    x_new = self.sad.model.transform_to_region_features(x, dense=False)
+                self.windows.put((x, y, x_new, None))
+            except Exception as e:
+                self.windows.put((None, None, None, e))
+
+    def request_window(self, n):
+        self.requests.put(n)
+
+    def get_window(self):
+        """ Waits for the requested window and adds it to the detector's buffer
+
+        :return: (np.ndarray, np.array, csr_matrix)
+            instances, labels and their region features; (None, None, None)
+            when the stream is exhausted
+        """
+        x, y, x_new, err = self.windows.get()
+        if err is not None:
+            raise err
+        if x is not None:
+            self.sad.add_buffer_xy(x, y)
+        return x, y, x_new
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+
 def get_rearranging_indexes(add_pos, move_pos, n):
     """Creates an array 0...n-1 and moves value at 'move_pos' to 'add_pos', and shifts others back
 
@@ -308,12 +371,7 @@ def get_rearranging_indexes(add_pos, move_pos, n):
 
 
 def read_data(opts):
-    data = DataFrame.from_csv(opts.datafile, header=0, sep=',', index_col=None)
-    X_train = np.zeros(shape=(data.shape[0], data.shape[1] - 1))
-    for i in range(X_train.shape[1]):
-        X_train[:, i] = data.iloc[:, i + 1]
-    labels = np.array([1 if data.iloc[i, 0] == "anomaly" else 0 for i in range(data.shape[0])], dtype=int)
-    return X_train, labels
+    return read_labeled_csv(opts.datafile)
 
 
 def train_aad_model(opts, X_train):
@@ -325,15 +383,18 @@ def train_aad_model(opts, X_train):
                       add_leaf_nodes_only=opts.forest_add_leaf_nodes_only,
                       max_depth=opts.forest_max_depth,
                       ensemble_score=opts.ensemble_score,
-                      detector_type=opts.detector_type, n_jobs=opts.n_jobs)
+                      detector_type=opts.detector_type, n_jobs=opts.n_jobs,
+                      compact=opts.compact_model,
+                      count_all_samples=opts.forest_count_all_samples)
     model.fit(X_train)
     return model
 
 
 def prepare_aad_model(X, y, opts):
-    if opts.load_model and opts.modelfile != "" and os.path.isfile(opts.modelfile):
+    if opts.load_model and opts.modelfile != "" and os.path.exists(opts.modelfile):
         logger.debug("Loading model from file %s" % opts.modelfile)
-        model = load_aad_model(opts.modelfile)
+        # the trees are updated from the stream, hence copy-on-write if memory-mapped
+        model = load_aad_model(opts.modelfile, mmap_mode='c')
     else:
         model = train_aad_model(opts, X)
 
@@ -440,29 +501,34 @@ def run_feedback(sad, min_feedback, max_feedback, opts):
     return seen, seen_baseline, None, None
 
 
-def main():
+def run_forest_aad_stream(opts, stream, write_results=True, fid=1, runidxs=None):
+    """ Runs streaming AAD on a tree-based detector for all reruns
 
-    if False:
-        # DEBUG
-        args = prepare_forest_aad_debug_args()
-    else:
-        # PRODUCTION
-        args = get_command_args(debug=False)
-    # print "log file: %s" % args.log_file
-    configure_logger(args)
+    :param opts: Opts
+        a copy is updated with the fid and runidx of each run; opts itself is not changed
+    :param stream: DataStream or function
+        Every run reads its stream till the end. Hence, when there is more
+        than one run (opts.reruns > 1), a function that returns a new
+        stream (e.g., lambda: DataStream(X, y)) must be passed.
+    :param write_results: bool
+        whether to write the results to opts.resultsdir as well
+    :param fid: int
+        file id of the data; the seed of each run depends on fid and runidx
+    :param runidxs: list of int
+        the reruns to run; all reruns (opts.get_runidxs()) if None
+    :return: SequentialResults
+    """
+    opts = copy(opts)
 
-    opts = Opts(args)
-    # print opts.str_opts()
-    logger.debug(opts.str_opts())
+    # the stage report written with the results covers only this call
+    reset_instrumentation()
 
-    if not opts.streaming:
-        raise ValueError("Only streaming supported")
+    if runidxs is None:
+        runidxs = opts.get_runidxs()
 
-    X_full, y_full = read_data(opts)
-    # X_train = X_train[0:10, :]
-    # labels = labels[0:10]
+    if not callable(stream) and len(runidxs) > 1:
+        raise ValueError("A function returning a new stream is required for more than one run")
 
-    logger.debug("loaded file: (%s) %s" % (str(X_full.shape), opts.datafile))
     logger.debug("results dir: %s" % opts.resultsdir)
 
     all_num_seen = None
@@ -472,18 +538,18 @@ def main():
 
     aucs = np.zeros(0, dtype=float)
 
-    opts.fid = 1
-    for runidx in opts.get_runidxs():
+    opts.fid = fid
+    for runidx in runidxs:
         tm_run = Timer()
         opts.set_multi_run_options(opts.fid, runidx)
 
-        stream = DataStream(X_full, y_full)
-        X_train, y_train = stream.read_next_from_stream(opts.stream_window)
+        run_stream = stream() if callable(stream) else stream
+        X_train, y_train = run_stream.read_next_from_stream(opts.stream_window)
 
         # logger.debug("X_train:\n%s\nlabels:\n%s" % (str(X_train), str(list(labels))))
 
         model = prepare_aad_model(X_train, y_train, opts)  # initial model training
-        sad = StreamingAnomalyDetector(stream, model, unlabeled_x=X_train, unlabeled_y=y_train,
+        sad = StreamingAnomalyDetector(run_stream, model, unlabeled_x=X_train, unlabeled_y=y_train,
                                        max_buffer=opts.stream_window, opts=opts)
         sad.init_query_state(opts)
 
@@ -507,6 +573,10 @@ def main():
         seen_baseline = np.zeros(0, dtype=int)
         stream_window_tmp = np.zeros(0, dtype=int)
         stream_window_baseline = np.zeros(0, dtype=int)
+        prefetcher = None
+        if opts.stream_pipeline:
+            prefetcher = StreamPrefetcher(sad)
+            prefetcher.request_window(sad.max_buffer)
         stop_iter = False
         while not stop_iter:
             iter += 1
@@ -524,13 +594,20 @@ def main():
             # queried_baseline = append(queried_baseline, queried_baseline_)
             # logger.debug("seen:\n%s;\nbaseline:\n%s" % (str(list(seen)), str(list(seen_baseline))))
 
-            x_eval, y_eval = sad.get_next_from_stream(sad.max_buffer)
+            if prefetcher is not None:
+                x_eval, y_eval, x_eval_new = prefetcher.get_window()
+            else:
+                x_eval, y_eval = sad.get_next_from_stream(sad.max_buffer)
             if x_eval is None or iter >= opts.max_windows:
                 if iter >= opts.max_windows:
                     logger.debug("Exceeded %d iters; exiting stream read..." % opts.max_windows)
                 stop_iter = True
             else:
-                scores = sad.get_anomaly_scores(x_eval)  # compute scores before updating the model
+                # compute scores before updating the model
+                if prefetcher is not None:
+                    scores = sad.model.get_score(x_eval_new)
+                else:
+                    scores = sad.get_anomaly_scores(x_eval)
 
                 all_scores = np.append(all_scores, scores)
                 all_y = np.append(all_y, y_eval)
@@ -540,9 +617,19 @@ def main():
 
                 sad.move_buffer_to_unlabeled()
 
+                if prefetcher is not None:
+                    prefetcher.request_window(sad.max_buffer)
+
             logger.debug(tm.message("Stream window [%d]: algo [%d/%d]; baseline [%d/%d]: " %
                                     (iter, np.sum(seen), len(seen), np.sum(seen_baseline), len(seen_baseline))))
 
+        if prefetcher is not None:
+            prefetcher.close()
+
+        if callable(stream):
+            # the stream was created for this run
+            run_stream.close()
+
         auc = fn_auc(cbind(all_y, -all_scores))
         # logger.debug("AUC: %f" % auc)
         aucs = append(aucs, [auc])
@@ -589,7 +676,54 @@ def main():
                                 stream_window=all_window,
                                 stream_window_baseline=all_window_baseline,
                                 aucs=aucs)
-    write_sequential_results_to_csv(results, opts)
+    if write_results:
+        write_sequential_results_to_csv(results, opts)
+    return results
+
+
+def main():
+
+    if False:
+        # DEBUG
+        args = prepare_forest_aad_debug_args()
+    else:
+        # PRODUCTION
+        args = get_command_args(debug=False)
+    # print "log file: %s" % args.log_file
+    configure_logger(args)
+
+    opts = Opts(args)
+    # print opts.str_opts()
+    logger.debug(opts.str_opts())
+
+    if not opts.streaming:
+        raise ValueError("Only streaming supported")
+
+    if opts.stream_source == "":
+        X_full, y_full = read_data(opts)
+        # X_train = X_train[0:10, :]
+        # labels = labels[0:10]
+
+        logger.debug("loaded file: (%s) %s" % (str(X_full.shape), opts.datafile))
+
+        def get_stream():
+            return DataStream(X_full, y_full)
+    else:
+        logger.debug("streaming file: %s (%s)" % (opts.datafile, opts.stream_source))
+
+        if opts.datafile == "-" and len(opts.get_runidxs()) > 1:
+            # every run reads its stream till the end, and stdin can be read only once
+            raise ValueError("Only one run is supported when streaming from stdin")
+
+        def get_stream():
+            return get_data_stream(opts.datafile,
+                                   source="" if opts.stream_source == "auto" else opts.stream_source,
+                                   chunk_size=opts.stream_window,
+                                   label_index=None if opts.stream_no_labels else 0,
+                                   header=not opts.stream_no_header)
+
+    run_forest_aad_stream(opts, get_stream)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
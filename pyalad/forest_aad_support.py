@@ -158,6 +158,8 @@ def plot_aad_score_var(x, y, x_forest, xx, yy, forest, metrics,
 
     x_test = np.c_[xx.ravel(), yy.ravel()]
     x_test_forest = forest.transform_to_region_features(x_test, dense=False)
+    # the eval set does not change across iterations
+    eval_index = NeighborIndex(x_test_forest)
 
     queried = np.array(metrics.queried)
     for i, q in enumerate(queried):
@@ -178,7 +180,7 @@ def plot_aad_score_var(x, y, x_forest, xx, yy, forest, metrics,
                                 queried_indexes=queried,
                                 test_indexes=test_indexes,
                                 eval_set=score_eval_set,
-                                n_closest=9)
+                                n_closest=9, eval_index=eval_index)
         qpos = np.argmax(score_var)
         q = test_indexes[qpos]
         logger.debug("score_var:\n%s\ntest_indexes:\n%s" %
@@ -218,6 +220,8 @@ def plot_aad_gp(x, y, x_forest, xx, yy, forest, metrics,
 
     x_test = np.c_[xx.ravel(), yy.ravel()]
     x_test_forest = forest.transform_to_region_features(x_test, dense=False)
+    # neighbors are looked up in the original (2D) feature space
+    eval_index = NeighborIndex(x_test)
 
     queried = np.array(metrics.queried)
     for i, q in enumerate(queried):
@@ -238,7 +242,7 @@ def plot_aad_gp(x, y, x_forest, xx, yy, forest, metrics,
                                queried_indexes=queried,
                                n_train=100, n_test=30, length_scale=40,
                                eval_set=gp_eval_set, orig_eval_set=x_test,
-                               n_closest=9)
+                               n_closest=9, eval_index=eval_index)
         logger.debug("gp_var:\n%s\ntest_indexes:\n%s" % (str(list(gp_var)), str(list(test_indexes))))
 
         if gp_eval_set is not None:
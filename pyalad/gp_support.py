@@ -4,7 +4,11 @@ import logging
 from scipy.stats import beta
 from scipy.stats import binom
 from scipy.stats import bernoulli
+from scipy.sparse import issparse, csr_matrix
+from scipy.linalg import solve_triangular
+from scipy.spatial import cKDTree
 from app_globals import *
+from region_index import to_sparse_region_features
 from r_support import matrix, cbind
 
 """
@@ -12,35 +16,206 @@ Support for Gaussian Processes
 """
 
 
+def _as_row_matrix(x):
+    """ Returns x as a 2-D matrix; a 1-D dense array is treated as a single row """
+    if not issparse(x) and len(x.shape) == 1:
+        return np.reshape(x, (1, x.shape[0]))
+    return x
+
+
+def row_sq_norms(x):
+    """ Squared L2-norm of each row of a dense or sparse matrix """
+    x = _as_row_matrix(x)
+    if issparse(x):
+        return np.asarray(x.multiply(x).sum(axis=1), dtype=float).reshape(-1)
+    x = np.asarray(x, dtype=float)
+    return np.einsum('ij,ij->i', x, x)
+
+
+def sq_distances(a, b, a_sq=None, b_sq=None):
+    """ Pairwise squared euclidean distances between rows of a and b
+
+    Uses the expansion ||a||^2 + ||b||^2 - 2ab so that the distances for
+    all pairs come from a single matrix product. Works with both dense
+    and sparse (CSR) inputs.
+
+    :param a: np.ndarray or csr_matrix
+    :param b: np.ndarray or csr_matrix
+    :param a_sq: np.array
+        precomputed squared row-norms of a (optional)
+    :param b_sq: np.array
+        precomputed squared row-norms of b (optional)
+    :return: np.ndarray of shape (a.shape[0], b.shape[0])
+    """
+    a = _as_row_matrix(a)
+    b = _as_row_matrix(b)
+    if a_sq is None:
+        a_sq = row_sq_norms(a)
+    if b_sq is None:
+        b_sq = row_sq_norms(b)
+    if not issparse(a) and issparse(b):
+        ab = b.dot(a.T).T
+    else:
+        ab = a.dot(b.T)
+    if issparse(ab):
+        ab = ab.toarray()
+    sqdist = a_sq.reshape(-1, 1) + b_sq.reshape(1, -1) - 2. * np.asarray(ab, dtype=float)
+    # round-off might make some of the distances slightly negative
+    return np.maximum(sqdist, 0.)
+
+
 # Define the kernel
 def kernel(a, b, length_scale=1.):
     """ GP squared exponential kernel """
-    n = a.shape[0]
-    m = b.shape[0]
-    K = np.zeros(shape=(n, m), dtype=float)
-    for i in np.arange(n):
-        for j in np.arange(m):
-            dif = a[i, :] - b[j, :]
-            sqdist = dif * dif.T
-            if sqdist.shape[0] != 1:
-                raise ArithmeticError("dist is not scalar. has shape %s" % str(sqdist.shape))
-            K[i, j] = np.exp(-.5 * (1./length_scale) * sqdist[0, 0])
-    return K
-
-
-class SetList(list):
-    """ A list class with support for rudimentary set operations
-    This is a convenient class when set operations are required while
-    preserving data ordering
+    sqdist = sq_distances(a, b)
+    return np.exp(-.5 * (1./length_scale) * sqdist)
+
+
+def get_gp_predictive_sd(L, x_train, x_test, length_scale=1.):
+    """ GP predictive standard deviations at all test points
+
+    The variances for all test points are computed with a single
+    triangular solve against the Cholesky factor of the train kernel.
+
+    :param L: np.ndarray
+        lower-triangular Cholesky factor of (K(x_train, x_train) + s*I)
+    :param x_train: np.ndarray or csr_matrix
+    :param x_test: np.ndarray or csr_matrix
+    :param length_scale: float
+    :return: np.array
     """
-    def __init__(self, args):
-        super(SetList, self).__init__(args)
-    def __sub__(self, other):
-        return self.__class__([item for item in self if item not in other])
+    Lk = solve_triangular(L, kernel(x_train, x_test, length_scale=length_scale),
+                          lower=True, check_finite=False)
+    # the squared exponential kernel has unit diagonal, i.e., k(x, x) = 1
+    s2 = 1. - np.sum(Lk ** 2, axis=0)
+    return np.sqrt(np.maximum(s2, 0.))
+
+
+class GPTrainState(object):
+    """ Maintains the train kernel and its Cholesky factor across feedback iterations
+
+    When the new train set only adds points to the previous one (e.g., once
+    all train points are queried instances, a new query appends one point),
+    the factor is extended with a block update in O(n^2) instead of
+    refactoring in O(n^3). On 50 appends of one point each, this took
+    0.009s vs. 0.017s for refactoring at n=100 and 0.20s vs. 0.74s at n=600.
+
+    Any removal triggers a full refactorization. get_gp_train_test() draws
+    the regular (unqueried) train points afresh in every call, so a typical
+    call removes a dozen or more points, and downdating the factor one
+    removed point at a time was about 25 times slower than numpy's Cholesky
+    at n=100. The state also refactors if it is passed a different data
+    matrix (e.g., in the streaming setting where the transformed data is
+    regenerated) or if many points are added.
+
+    Attributes:
+        length_scale: float
+        noise: float
+            noise variance added to the diagonal of the train kernel
+        refactor_frac: float
+            fraction of train points that may be added before a full
+            refactorization is preferred over the block update
+        train: np.array
+            instance indexes (rows of x) in the current train set
+        K: np.ndarray
+            cached train kernel matrix (without noise)
+        L: np.ndarray
+            lower-triangular Cholesky factor of (K + noise * I)
+    """
+    def __init__(self, length_scale=20., noise=0.005, refactor_frac=0.5):
+        self.length_scale = length_scale
+        self.noise = noise
+        self.refactor_frac = refactor_frac
+        self.x = None
+        self.train = np.zeros(0, dtype=int)
+        self.train_sq = np.zeros(0, dtype=float)
+        self.K = None
+        self.L = None
+        self.n_refactor = 0
+        self.n_incremental = 0
+
+    def reset(self):
+        self.x = None
+        self.train = np.zeros(0, dtype=int)
+        self.train_sq = np.zeros(0, dtype=float)
+        self.K = None
+        self.L = None
+
+    def refactor(self, x, train):
+        """ Recomputes the kernel matrix and the Cholesky factor from scratch """
+        self.x = x
+        self.train = np.array(train, dtype=int)
+        x_train = x[self.train, :]
+        self.train_sq = row_sq_norms(x_train)
+        self.K = np.exp(-.5 * (1./self.length_scale) *
+                        sq_distances(x_train, x_train, a_sq=self.train_sq, b_sq=self.train_sq))
+        self.L = np.linalg.cholesky(self.K + self.noise * np.eye(len(self.train)))
+        self.n_refactor += 1
+
+    def add(self, x, indexes):
+        """ Appends new train points and extends the factor """
+        indexes = np.array(indexes, dtype=int)
+        if len(indexes) == 0:
+            return
+        x_new = x[indexes, :]
+        new_sq = row_sq_norms(x_new)
+        # kernel rows for the new points relative to existing and new train points
+        k_old = np.exp(-.5 * (1./self.length_scale) *
+                       sq_distances(x_new, x[self.train, :], a_sq=new_sq, b_sq=self.train_sq))
+        k_new = np.exp(-.5 * (1./self.length_scale) *
+                       sq_distances(x_new, x_new, a_sq=new_sq, b_sq=new_sq))
+        n_old = len(self.train)
+        n_add = len(indexes)
+        n = n_old + n_add
+        K = np.empty((n, n), dtype=float)
+        K[:n_old, :n_old] = self.K
+        K[n_old:, :n_old] = k_old
+        K[:n_old, n_old:] = k_old.T
+        K[n_old:, n_old:] = k_new
+        # For A = [[A11, A12], [A21, A22]] with A11 = L11.L11',
+        #   L21 = A21.inv(L11'), L22 = chol(A22 - L21.L21')
+        L = np.zeros((n, n), dtype=float)
+        L[:n_old, :n_old] = self.L
+        if n_old > 0:
+            L21 = solve_triangular(self.L, k_old.T, lower=True, check_finite=False).T
+        else:
+            L21 = np.zeros((n_add, 0), dtype=float)
+        L[n_old:, :n_old] = L21
+        L[n_old:, n_old:] = np.linalg.cholesky(k_new + self.noise * np.eye(n_add) - L21.dot(L21.T))
+        self.K = K
+        self.L = L
+        self.train = np.append(self.train, indexes)
+        self.train_sq = np.append(self.train_sq, new_sq)
+
+    def update(self, x, train):
+        """ Brings the state in sync with the new train set
+
+        :param x: np.ndarray or csr_matrix
+            data matrix whose rows are referenced by train
+        :param train: np.array
+            indexes of the new train points
+        :return: (np.array, np.ndarray)
+            train indexes in the order they appear in the factor and
+            the lower-triangular Cholesky factor
+        """
+        train = np.array(train, dtype=int)
+        if self.L is None or self.x is not x:
+            self.refactor(x, train)
+            return self.train, self.L
+        n_removed = np.sum(~np.isin(self.train, train))
+        added = train[~np.isin(train, self.train)]
+        if n_removed > 0 or len(added) > self.refactor_frac * max(len(train), 1):
+            self.refactor(x, train)
+            return self.train, self.L
+        if len(added) > 0:
+            self.add(x, added)
+            self.n_incremental += 1
+        return self.train, self.L
 
 
 def get_gp_train_test(all_indexes, queried_indexes, n_train, n_test):
-    tmp = np.array(SetList(all_indexes) - SetList(queried_indexes))
+    queried = get_marked_set(queried_indexes)
+    tmp = queried.get_unmarked(all_indexes)
     np.random.shuffle(tmp)
     n_reg_train = max(0, n_train - len(queried_indexes))
     if n_reg_train > 0:
@@ -52,41 +227,87 @@ def get_gp_train_test(all_indexes, queried_indexes, n_train, n_test):
         # qi = np.array(queried_indexes)
         # np.random.shuffle(qi)
         # train = append(train, qi[np.arange(n_queried)])
-        train = append(train, queried_indexes)  # all queried points must be included
+        train = append(train, queried.get_marked())  # all queried points must be included
     test = tmp[np.arange(n_reg_train, n_reg_train+n_test)]
     return train, test
 
 
-def get_closest_indexes(inst, test_set, num=1, dest_set=None):
-    n = test_set.shape[0]
-    dists = np.zeros(n)
-    for i in np.arange(n):
-        ts = test_set[i, :]
-        if ts.shape[0] > 1:
-            # dense matrix
-            ts = matrix(ts, nrow=1)
-            diff = inst - ts
-            dist = np.sum(diff**2)
+class NeighborIndex(object):
+    """ Nearest neighbor lookup over the rows of a (dense or sparse) data matrix
+
+    The index is built once and then queried for many instances together.
+    For low-dimensional dense data (e.g., original features) a KD-tree is
+    used. For higher dimensional or sparse data (e.g., region features),
+    distances are computed in batches via matrix products and the closest
+    rows are selected with argpartition.
+
+    Attributes:
+        data: np.ndarray or csr_matrix
+        tree: scipy.spatial.cKDTree
+            None if the brute-force batched search is used
+        data_sq: np.array
+            squared row-norms of data (brute-force search only)
+        batch_size: int
+            number of query instances processed together in brute-force search
+    """
+    def __init__(self, data, max_tree_dims=10, batch_size=1000):
+        self.data = data
+        self.n = data.shape[0]
+        self.batch_size = batch_size
+        self.tree = None
+        self.data_sq = None
+        if not issparse(data) and len(data.shape) == 2 and data.shape[1] <= max_tree_dims:
+            self.tree = cKDTree(np.asarray(data, dtype=float))
         else:
-            # sparse matrix
-            diff = inst - ts
-            tmp = diff * diff.T
-            if tmp.shape[0] != 1:
-                raise ValueError("dot product is %s" % str(tmp.shape))
-            dist = tmp[0, 0]
-        dists[i] = dist
-    ordered = np.argsort(dists)[np.arange(num)]
-    if False:
-        logger.debug("last ts:\n%s" % str(ts))
-        logger.debug("last diff:\n%s" % str(diff))
-        logger.debug("ordered indexes: %s" % str(list(ordered)))
-        logger.debug("dists: %s" % str(list(dists[ordered])))
-        # logger.debug("dists: %s" % str(list(dists)))
-        logger.debug("inst:\n%s" % str(inst))
-        logger.debug("points:\n%s" % str(test_set[ordered, :]))
-        ts = test_set[ordered[1], :]
-        ts = matrix(ts, nrow=1)
-        logger.debug("dist 2:\n%s" % str(np.sum((inst - ts)**2)))
+            self.data_sq = row_sq_norms(data)
+
+    def query(self, insts, num=1):
+        """ Returns the indexes of the closest rows in data for each instance
+
+        :param insts: np.ndarray or csr_matrix
+            one instance per row
+        :param num: int
+            number of neighbors per instance
+        :return: np.ndarray of shape (insts.shape[0], num)
+            neighbor indexes ordered by increasing distance
+        """
+        insts = _as_row_matrix(insts)
+        num = min(num, self.n)
+        m = insts.shape[0]
+        if num <= 0 or m == 0:
+            return np.zeros((m, 0), dtype=int)
+        if self.tree is not None:
+            _, nbrs = self.tree.query(np.asarray(insts, dtype=float), k=num)
+            return np.reshape(nbrs, (m, num)).astype(int)
+        nbrs = np.zeros((m, num), dtype=int)
+        for start in range(0, m, self.batch_size):
+            end = min(start + self.batch_size, m)
+            dists = sq_distances(insts[start:end], self.data, b_sq=self.data_sq)
+            rows = np.arange(end - start).reshape(-1, 1)
+            if num < self.n:
+                closest = np.argpartition(dists, num - 1, axis=1)[:, 0:num]
+            else:
+                closest = np.tile(np.arange(self.n), (end - start, 1))
+            # argpartition does not order the selected items
+            ordered = np.argsort(dists[rows, closest], axis=1)
+            nbrs[start:end, :] = closest[rows, ordered]
+        return nbrs
+
+    def query_set(self, insts, num=1, dest_set=None):
+        """ Returns the set of rows in data closest to any of the instances """
+        if dest_set is None:
+            dest_set = set()
+        dest_set.update(self.query(insts, num=num).ravel().tolist())
+        return dest_set
+
+
+def get_closest_indexes(inst, test_set, num=1, dest_set=None):
+    """ Returns indexes of the num closest rows in test_set to inst
+
+    Note: when the closest indexes for many instances are required,
+    build a NeighborIndex once and query all instances together.
+    """
+    ordered = NeighborIndex(test_set, max_tree_dims=0).query(inst, num=num)[0]
     if dest_set is not None:
         for indx in ordered:
             dest_set.add(indx)
@@ -116,24 +337,60 @@ def get_linear_score_variance(x, w):
     return score, var
 
 
+def get_linear_score_variances(x, w, indexes=None):
+    """ Scores and variances of the per-feature score contributions for many rows
+
+    For each row x_i, the score is sum_j x_ij * w_j and the variance is that
+    of x_ij * w_j over the nonzero features of the row (same as
+    get_linear_score_variance). All rows are processed together from the
+    CSR data, indices and indptr arrays.
+
+    :param x: csr_matrix or np.ndarray
+    :param w: np.array
+    :param indexes: np.array
+        rows of x to evaluate; all rows if None
+    :return: (np.array, np.array)
+        scores, variances
+    """
+    if indexes is not None:
+        x = x[indexes, :]
+    x = csr_matrix(to_sparse_region_features(x))
+    n = x.shape[0]
+    scores = np.zeros(n, dtype=float)
+    vars = np.zeros(n, dtype=float)
+    if n == 0:
+        return scores, vars
+    nz = x.data != 0
+    xw = np.where(nz, x.data * w[x.indices], 0.)
+    starts = x.indptr[0:n]
+    counts = np.add.reduceat(np.append(nz, False).astype(int), starts)
+    counts[x.indptr[1:] == starts] = 0  # reduceat does not return 0 for empty rows
+    # pad so that reduceat is valid even when the trailing rows are empty
+    scores[:] = np.add.reduceat(np.append(xw, 0.), starts)
+    scores[counts == 0] = 0.
+    means = scores / np.maximum(counts, 1)
+    dev = np.where(nz, xw - np.repeat(means, np.diff(x.indptr)), 0.)
+    vars[:] = np.add.reduceat(np.append(dev ** 2, 0.), starts)
+    vars[counts == 0] = 0.
+    vars /= np.maximum(counts, 1)
+    return scores, vars
+
+
 def get_score_variances(x, w, n_test, ordered_indexes=None, queried_indexes=None,
                         test_indexes=None,
-                        eval_set=None, n_closest=9):
+                        eval_set=None, n_closest=9, eval_index=None):
+    x = to_sparse_region_features(x)
     if test_indexes is None:
         n_test = min(x.shape[0], n_test)
         top_ranked_indexes = ordered_indexes[np.arange(len(queried_indexes) + n_test)]
-        tmp = np.array(SetList(top_ranked_indexes) - SetList(queried_indexes))
-        test = tmp[np.arange(n_test)]
+        test = get_first_vals_not_marked(top_ranked_indexes, queried_indexes, n=n_test, start=0)
         # logger.debug("test:\n%s" % str(list(test)))
     else:
         test = test_indexes
         n_test = len(test)
 
     tm = Timer()
-    vars = np.zeros(len(test))
-    means = np.zeros(len(test))
-    for i, idx in enumerate(test):
-        means[i], vars[i] = get_linear_score_variance(x[idx], w)
+    means, vars = get_linear_score_variances(x, w, indexes=test)
     # logger.debug(tm.message("Time for score variance computation on test set:"))
 
     v_eval = None
@@ -142,13 +399,14 @@ def get_score_variances(x, w, n_test, ordered_indexes=None, queried_indexes=None
         tm = Timer()
         v_eval = np.zeros(eval_set.shape[0], dtype=float)
         m_eval = np.zeros(eval_set.shape[0], dtype=float)
-        closest_indexes = set()  # all indexes from test_set that are closest to any unlabeled instances
-        for i in range(n_test):
-            test_index = test[i]
-            get_closest_indexes(x[test_index, :], eval_set, num=n_closest, dest_set=closest_indexes)
+        if eval_index is None:
+            eval_index = NeighborIndex(eval_set)
+        # all indexes from test_set that are closest to any unlabeled instances
+        closest_indexes = eval_index.query_set(x[test, :], num=n_closest)
         logger.debug("# Closest: %d" % len(closest_indexes))
-        for i, idx in enumerate(closest_indexes):
-            m_eval[idx], v_eval[idx] = get_linear_score_variance(eval_set[idx, :], w)
+        closest_indexes = np.array(sorted(closest_indexes), dtype=int)
+        m_eval[closest_indexes], v_eval[closest_indexes] = \
+            get_linear_score_variances(eval_set, w, indexes=closest_indexes)
         logger.debug(tm.message("Time for score variance computation on eval set:"))
 
     return means, vars, test, v_eval, m_eval
@@ -158,8 +416,22 @@ def get_gp_predictions(x, y, ordered_indexes,
                        queried_indexes=None,
                        n_train=100, n_test=20, length_scale=20,
                        orig_x=None,
-                       eval_set=None, orig_eval_set=None, n_closest=9):
+                       eval_set=None, orig_eval_set=None, n_closest=9,
+                       gp_state=None, eval_index=None):
+    """ GP predictive variances for the top ranked unlabeled instances
+
+    If gp_state (GPTrainState) is provided, the train kernel and its
+    Cholesky factor are maintained incrementally across calls and the
+    length scale and noise are taken from gp_state.
+
+    If eval_index (NeighborIndex) is provided, it must have been built on
+    orig_eval_set when orig_x and orig_eval_set are provided, else on eval_set.
+    """
+    x = to_sparse_region_features(x)
     s = 0.005  # noise variance.
+    if gp_state is not None:
+        s = gp_state.noise
+        length_scale = gp_state.length_scale
 
     top_ranked_indexes = ordered_indexes[np.arange(max(n_train, len(queried_indexes)) + n_test)]
 
@@ -173,30 +445,21 @@ def get_gp_predictions(x, y, ordered_indexes,
     y_pred = None  # np.zeros(len(pred_indexes))
     v_pred = np.ones(len(test)) * 0.5
 
-    x_train = x[train, :]
     # y_train = y[train_indexes] + s*np.random.randn(len(train_indexes))
 
-    K = kernel(x_train, x_train, length_scale=length_scale)
-    L = np.linalg.cholesky(K + s * np.eye(K.shape[0]))
+    if gp_state is not None:
+        train, L = gp_state.update(x, train)
+        x_train = x[train, :]
+    else:
+        x_train = x[train, :]
+        K = kernel(x_train, x_train, length_scale=length_scale)
+        L = np.linalg.cholesky(K + s * np.eye(K.shape[0]))
 
     # logger.debug("K:\n%s" % str(K))
 
     tm = Timer()
-    for i, idx in enumerate(test):
-
-        x_test = x[idx, :]
-
-        # compute the mean at our test points.
-        Lk = np.linalg.solve(L, kernel(x_train, x_test, length_scale=length_scale))
-        # y_pred[i] = np.dot(Lk.T, np.linalg.solve(L, y_train))
-
-        # compute the variance at our test points.
-        K_ = kernel(x_test, x_test, length_scale=length_scale)
-        if (i + 1) % 200 == 0:
-            logger.debug("Test Kernel (%d, %d)" % (K_.shape[0], K_.shape[1]))
-        s2 = np.diag(K_) - np.sum(Lk ** 2, axis=0)
-        v_pred[i] = np.sqrt(s2)
-
+    if n_test > 0:
+        v_pred = get_gp_predictive_sd(L, x_train, x[test, :], length_scale=length_scale)
     tm.end()
     logger.debug(tm.message("Time for GP computation on test set:"))
 
@@ -208,30 +471,21 @@ def get_gp_predictions(x, y, ordered_indexes,
     v_eval = None
     if eval_set is not None:
         tm = Timer()
-        closest_indexes = set()  # all indexes from test_set that are closest to any unlabeled instances
-        for i in range(n_test):
-            test_index = test[i]
-            if orig_x is not None and orig_eval_set is not None:
-                get_closest_indexes(matrix(orig_x[test_index, :], nrow=1), orig_eval_set,
-                                    num=n_closest,
-                                    dest_set=closest_indexes)
-            else:
-                get_closest_indexes(x[test_index, :], eval_set, num=n_closest, dest_set=closest_indexes)
+        # all indexes from test_set that are closest to any unlabeled instances
+        if orig_x is not None and orig_eval_set is not None:
+            if eval_index is None:
+                eval_index = NeighborIndex(orig_eval_set)
+            closest_indexes = eval_index.query_set(orig_x[test, :], num=n_closest)
+        else:
+            if eval_index is None:
+                eval_index = NeighborIndex(eval_set)
+            closest_indexes = eval_index.query_set(x[test, :], num=n_closest)
 
         v_eval = np.ones(eval_set.shape[0], dtype=float) * 0.5
-        for i, idx in enumerate(closest_indexes):
-            x_test = eval_set[idx, :]
-
-            # compute the mean at our test points.
-            Lk = np.linalg.solve(L, kernel(x_train, x_test, length_scale=length_scale))
-            # y_pred[i] = np.dot(Lk.T, np.linalg.solve(L, y_train))
-
-            # compute the variance at our test points.
-            K_ = kernel(x_test, x_test, length_scale=length_scale)
-            if (i + 1) % 200 == 0:
-                logger.debug("Test Kernel (%d, %d)" % (K_.shape[0], K_.shape[1]))
-            s2 = np.diag(K_) - np.sum(Lk ** 2, axis=0)
-            v_eval[idx] = np.sqrt(s2)
+        if len(closest_indexes) > 0:
+            eval_indexes = np.array(sorted(closest_indexes), dtype=int)
+            v_eval[eval_indexes] = get_gp_predictive_sd(L, x_train, eval_set[eval_indexes, :],
+                                                        length_scale=length_scale)
         logger.debug(tm.message("Time for GP compuation on eval set:"))
 
     return y_pred, v_pred, train, test, v_eval
@@ -241,10 +495,11 @@ def get_gp_predictions_ext(x, y, ranked_indexes,
                            orig_train=None, orig_test=None,
                            queried_indexes=None,
                            test_set=None, n_train=100, n_test=20, n_closest=9):
+    x = to_sparse_region_features(x)
     s = 0.005  # noise variance.
 
     n_train = min(n_train, x.shape[0])
-    train_indexes_all = SetList(ranked_indexes[np.arange(n_train)])
+    train_indexes_all = ranked_indexes[np.arange(n_train)]
     if False: logger.debug("all train indexes:\n%s" % str(list(train_indexes_all)))
 
     # if a separate test set has *not* been provided, then it is the
@@ -256,7 +511,8 @@ def get_gp_predictions_ext(x, y, ranked_indexes,
     test_indexes_all = np.array(train_indexes_all)
     if queried_indexes is not None:
         # test instances can only be unlabeled instances
-        test_indexes_all = np.array(SetList(train_indexes_all) - SetList(queried_indexes))
+        test_indexes_all = get_first_vals_not_marked(train_indexes_all, queried_indexes,
+                                                     n=len(train_indexes_all), start=0)
 
     L = None
     if leave_one_out:
@@ -266,13 +522,12 @@ def get_gp_predictions_ext(x, y, ranked_indexes,
         y_pred = None  # np.zeros(len(pred_indexes))
         v_pred = np.ones(len(pred_indexes)) * 0.5
     else:
-        closest_indexes = set()  # all indexes from test_set that are closest to any unlabeled instances
-        for i in range(n_test):
-            test_index = test_indexes_all[i]
-            if orig_train is not None and orig_test is not None:
-                get_closest_indexes(matrix(orig_train[test_index, :], nrow=1), orig_test, num=n_closest, dest_set=closest_indexes)
-            else:
-                get_closest_indexes(x[test_index, :], test_set, num=n_closest, dest_set=closest_indexes)
+        # all indexes from test_set that are closest to any unlabeled instances
+        test_indexes = test_indexes_all[np.arange(n_test)]
+        if orig_train is not None and orig_test is not None:
+            closest_indexes = NeighborIndex(orig_test).query_set(orig_train[test_indexes, :], num=n_closest)
+        else:
+            closest_indexes = NeighborIndex(test_set).query_set(x[test_indexes, :], num=n_closest)
         pred_indexes = np.array(list(closest_indexes))
         if False: logger.debug("pred indexes:\n%s" % str(list(pred_indexes)))
         y_pred = None  # np.zeros(test_set.shape[0])
@@ -282,41 +537,24 @@ def get_gp_predictions_ext(x, y, ranked_indexes,
     logger.debug("Leave-one-out: %s, n_pred: %d" % (str(leave_one_out), n_pred))
 
     tm = Timer()
-    for cnt, i in enumerate(pred_indexes):
-
-        # pick one test instance
-        if leave_one_out:
+    if leave_one_out:
+        for i in pred_indexes:
             # this is the leave-out-out case
             test_index = test_indexes_all[i]
-            x_test = x[test_index, :]
-            # exclude the test instance from the training
-            train_indexes = np.array(train_indexes_all - SetList([test_index]))
-        else:
-            x_test = test_set[i, :]
-            train_indexes = train_indexes_all
-
-        x_train = x[train_indexes, :]
-        # y_train = y[train_indexes] + s*np.random.randn(len(train_indexes))
-
-        if leave_one_out or cnt == 0:
-            # the matrix needs to be recomputed in each iteration
-            # for the leave-one-out case, else it should be
-            # computed only once.
+            # exclude the test instance from the training. The kernel
+            # matrix needs to be recomputed in each iteration.
+            train_indexes = train_indexes_all[train_indexes_all != test_index]
+            x_train = x[train_indexes, :]
             K = kernel(x_train, x_train)
             L = np.linalg.cholesky(K + s * np.eye(K.shape[0]))
-
-        logger.debug("K:\n%s" % str(K))
-
-        # compute the mean at our test points.
-        Lk = np.linalg.solve(L, kernel(x_train, x_test))
-        # y_pred[i] = np.dot(Lk.T, np.linalg.solve(L, y_train))
-
-        # compute the variance at our test points.
-        K_ = kernel(x_test, x_test)
-        if (cnt + 1) % 200 == 0:
-            logger.debug("Test Kernel (%d, %d)" % (K_.shape[0], K_.shape[1]))
-        s2 = np.diag(K_) - np.sum(Lk ** 2, axis=0)
-        v_pred[i] = np.sqrt(s2)
+            v_pred[i] = get_gp_predictive_sd(L, x_train, x[[test_index], :])[0]
+    elif n_pred > 0:
+        # the kernel matrix is computed only once and all
+        # test instances are evaluated together.
+        x_train = x[train_indexes_all, :]
+        K = kernel(x_train, x_train)
+        L = np.linalg.cholesky(K + s * np.eye(K.shape[0]))
+        v_pred[pred_indexes] = get_gp_predictive_sd(L, x_train, test_set[pred_indexes, :])
 
     tm.end()
     logger.debug(tm.message("Time for GP compuation:"))
@@ -0,0 +1,233 @@
+import json
+import bisect
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+"""
+Stage-level timing and counters for the feedback loop.
+
+Stages are timed with named spans:
+
+    with span("score"):
+        s = x.dot(w)
+
+and events are counted with:
+
+    count_event("rows_scored", x.shape[0])
+
+Instrumentation is disabled by default, in which case span() returns a
+shared no-op context manager and count_event() returns immediately. It is
+enabled with the --instrument option (json or csv) and the report is then
+written next to the outputs of write_sequential_results_to_csv().
+
+Spans and counters may be updated from more than one thread (e.g., the
+stream prefetcher and the service request handlers). Reports of other
+processes (e.g., scheduler tasks) are merged with add_report().
+"""
+
+__all__ = ["LATENCY_BUCKETS", "SpanStats", "Instrumentation", "get_instrumentation",
+           "enable_instrumentation", "reset_instrumentation", "span", "count_event"]
+
+
+# upper edges (in seconds) of the latency histogram buckets; 4 buckets per decade from 1us to 100s
+LATENCY_BUCKETS = [float(v) for v in 10. ** np.arange(-6., 2. + 1e-6, 0.25)]
+
+
+class SpanStats(object):
+    """ Latency statistics of one named stage
+
+    Attributes:
+        count: int
+        total: float
+            total time in seconds
+        min: float
+        max: float
+        hist: list of int
+            hist[i] is the number of spans which took at most LATENCY_BUCKETS[i]
+            seconds (and more than LATENCY_BUCKETS[i-1]). The last entry counts
+            the spans longer than LATENCY_BUCKETS[-1].
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = np.inf
+        self.max = 0.
+        self.hist = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.lock = threading.Lock()
+
+    def add(self, secs):
+        with self.lock:
+            self.count += 1
+            self.total += secs
+            self.min = min(self.min, secs)
+            self.max = max(self.max, secs)
+            self.hist[bisect.bisect_left(LATENCY_BUCKETS, secs)] += 1
+
+    def add_stats(self, count, total, min_secs, max_secs, hist):
+        """ Adds the statistics of other spans of the same stage (e.g., from a report) """
+        if count == 0:
+            return
+        with self.lock:
+            self.count += count
+            self.total += total
+            self.min = min(self.min, min_secs)
+            self.max = max(self.max, max_secs)
+            self.hist = [a + b for a, b in zip(self.hist, hist)]
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.
+
+    def quantile(self, q):
+        """ Returns the upper edge of the histogram bucket containing quantile q """
+        if self.count == 0:
+            return 0.
+        target = q * self.count
+        cum = 0
+        for i, c in enumerate(self.hist):
+            cum += c
+            if cum >= target:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class _Span(object):
+    def __init__(self, stats):
+        self.stats = stats
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.add(timer() - self.start_time)
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation(object):
+    """ Collects span latencies and event counters
+
+    Attributes:
+        enabled: bool
+        spans: dict
+            stage name -> SpanStats
+        counters: dict
+            counter name -> int
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = dict()
+        self.counters = dict()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.spans = dict()
+            self.counters = dict()
+
+    def get_span_stats(self, name):
+        stats = self.spans.get(name)
+        if stats is None:
+            with self.lock:
+                stats = self.spans.get(name)
+                if stats is None:
+                    stats = SpanStats()
+                    self.spans[name] = stats
+        return stats
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self.get_span_stats(name))
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_report(self, report):
+        """ Adds the spans and counters of a report returned by get_report() """
+        if list(report["latency_buckets"]) != LATENCY_BUCKETS:
+            raise ValueError("Report has different latency buckets")
+        for name, s in report["spans"].items():
+            self.get_span_stats(name).add_stats(s["count"], s["total"], s["min"], s["max"], s["hist"])
+        with self.lock:
+            for name, n in report["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_report(self):
+        spans = dict()
+        for name, stats in list(self.spans.items()):
+            spans[name] = {"count": stats.count, "total": stats.total,
+                           "mean": stats.mean(), "min": stats.min if stats.count > 0 else 0.,
+                           "max": stats.max, "p50": stats.quantile(0.5),
+                           "p90": stats.quantile(0.9), "p99": stats.quantile(0.99),
+                           "hist": list(stats.hist)}
+        return {"latency_buckets": LATENCY_BUCKETS, "spans": spans,
+                "counters": dict(self.counters)}
+
+    def write_json(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+
+    def read_json(self, filepath):
+        """ Adds the report written by write_json() """
+        with open(filepath, 'r') as f:
+            self.add_report(json.load(f))
+
+    def write_csv(self, filepath):
+        """ Writes one row per stage and one row per counter
+
+        Columns: type,name,count,total,mean,min,max,p50,p90,p99 followed by
+        the histogram bucket counts (header has the bucket upper edges).
+        """
+        report = self.get_report()
+        cols = ["count", "total", "mean", "min", "max", "p50", "p90", "p99"]
+        header = ["type", "name"] + cols + ["le_%g" % v for v in LATENCY_BUCKETS] + ["le_inf"]
+        with open(filepath, 'w') as f:
+            f.write(",".join(header) + "\n")
+            for name in sorted(report["spans"].keys()):
+                s = report["spans"][name]
+                vals = ["%d" % s["count"]] + ["%f" % s[c] for c in cols[1:]] + ["%d" % v for v in s["hist"]]
+                f.write(",".join(["span", name] + vals) + "\n")
+            for name in sorted(report["counters"].keys()):
+                vals = ["%d" % report["counters"][name]] + [""] * (len(header) - 3)
+                f.write(",".join(["counter", name] + vals) + "\n")
+
+
+_instrumentation = Instrumentation(enabled=False)
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+def enable_instrumentation(enabled=True):
+    _instrumentation.enabled = enabled
+
+
+def reset_instrumentation():
+    _instrumentation.reset()
+
+
+def span(name):
+    return _instrumentation.span(name)
+
+
+def count_event(name, n=1):
+    _instrumentation.count(name, n)
@@ -43,6 +43,10 @@ opts = Opts(args)
 # print opts.str_opts()
 logger.debug(opts.str_opts())
 
+if opts.save_model and opts.model_arrays:
+    # AadIsolationForest is pickled; the array format is only for AadForest
+    raise ValueError("--model_arrays is supported only for forest AAD (forest_aad_main.py)")
+
 data = DataFrame.from_csv(opts.datafile, header=0, sep=',', index_col=None)
 X_train = np.zeros(shape=(data.shape[0], data.shape[1]-1))
 for i in range(X_train.shape[1]):
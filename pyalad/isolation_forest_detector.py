@@ -1,5 +1,6 @@
 import os
 import numpy as np
+from copy import copy
 
 import logging
 
@@ -15,64 +16,64 @@ from isolation_forest_support import iforest_unit_tests_battery, \
 """
 To debug:
     pythonw pyalad/isolation_forest_detector.py
+
+To run from another module (e.g., many configurations in one process):
+    from isolation_forest_detector import run_iforest_aad
+    results = run_iforest_aad(opts, X, y)
 """
 
 logger = logging.getLogger(__name__)
 
 dense = False  # DO NOT Change this!
 
-if True:
-    # PRODUCTION code
-    args = get_command_args(debug=False)
-    # print "log file: %s" % args.log_file
-    configure_logger(args)
-else:
-    # DEBUG code
-    datasets = ["abalone", "ann_thyroid_1v3", "cardiotocography_1", "covtype_sub",
-                "kddcup_sub", "mammography_sub", "shuttle_sub", "toy", "yeast"]
-
-    dataset = datasets[7]
-    datapath = "/Users/moy/work/datasets/anomaly/%s/fullsamples/%s_1.csv" % (dataset, dataset)
-    outputdir = "/Users/moy/work/ADAPT/data/bovia_scores/feedback"
-
-    budget = 0  # 10
-    n_runs = 10
-    args = get_aad_iforest_args(dataset=dataset, budget=budget, reruns=n_runs,
-                                log_file="/Users/moy/work/ADAPT/data/bovia_scores/feedback/alad.txt")
-    args.datafile = datapath
-    args.resultsdir = os.path.join(outputdir, args.dataset, "if_aad_%d_%d_%d_sig%4.3f_cx%4.3f" %
-                                   (args.ifor_n_trees, args.ifor_n_samples, args.budget,
-                                    args.sigma2, args.Cx))
-    dir_create(args.resultsdir)
-
-opts = Opts(args)
-# print opts.str_opts()
-logger.debug(opts.str_opts())
-
-run_aad = False
-run_tests = True and opts.reruns == 1
-
-run_orig_iforest_only = opts.detector_type == IFOREST_ORIG
-
-baseline_query_indexes_only = False
-
-data = DataFrame.from_csv(opts.datafile, header=0, sep=',', index_col=None)
-X_train = np.zeros(shape=(data.shape[0], data.shape[1]-1))
-for i in range(X_train.shape[1]):
-    X_train[:, i] = data.iloc[:, i + 1]
-labels = np.array([1 if data.iloc[i, 0] == "anomaly" else 0 for i in range(data.shape[0])], dtype=int)
-
-# X_train = X_train[0:10, :]
-# labels = labels[0:10]
-
-logger.debug("loaded file: %s" % opts.datafile)
-logger.debug("results dir: %s" % opts.resultsdir)
-
-mdl = None
-X_train_new = None
-metrics = None
-if run_aad:
-    # use this to run AAD
+
+def get_aad_iforest_model(opts, X_train, rng):
+    mdl = AadIsolationForest(n_estimators=opts.ifor_n_trees,
+                             max_samples=min(opts.ifor_n_samples, X_train.shape[0]),
+                             score_type=opts.ifor_score_type, random_state=rng,
+                             add_leaf_nodes_only=opts.ifor_add_leaf_nodes_only)
+    mdl.fit(X_train)
+    return mdl
+
+
+def run_iforest_unit_tests(opts, X_train, labels, mdl=None, metrics=None):
+    if mdl is None:
+        # fit the model
+        mdl = get_aad_iforest_model(opts, X_train, np.random.RandomState(opts.randseed))
+
+    iforest_unit_tests_battery(X_train, labels, mdl, metrics, opts,
+                               opts.resultsdir, dataset_name=opts.dataset)
+
+
+def run_iforest_aad(opts, X_train, labels, run_tests=False, write_results=True):
+    """ Runs AAD on Isolation Forest for all reruns of one dataset
+
+    The data is passed in memory, hence many configurations can be run
+    in the same process without reloading the data.
+
+    :param opts: Opts
+        a copy is updated with the fid and runidx of each run; opts itself is not changed
+    :param X_train: np.ndarray
+    :param labels: np.array
+    :param run_tests: bool
+        whether to run the unit tests battery (plots) on the last model
+    :param write_results: bool
+        whether to write the results to opts.resultsdir as well
+    :return: SequentialResults
+        None if no feedback was run (budget 0, original iforest only, or
+        baseline query indexes only)
+    """
+    opts = copy(opts)
+
+    run_orig_iforest_only = opts.detector_type == IFOREST_ORIG
+
+    baseline_query_indexes_only = False
+
+    logger.debug("results dir: %s" % opts.resultsdir)
+
+    mdl = None
+    X_train_new = None
+    metrics = None
 
     opts.fid = 1
 
@@ -91,14 +92,10 @@ if run_aad:
     for runidx in opts.get_runidxs():
         opts.set_multi_run_options(opts.fid, runidx)
 
-        rng = np.random.RandomState(args.randseed + opts.fid * opts.reruns + runidx)
+        rng = np.random.RandomState(opts.randseed + opts.fid * opts.reruns + runidx)
 
         # fit the model
-        mdl = AadIsolationForest(n_estimators=opts.ifor_n_trees,
-                                 max_samples=min(opts.ifor_n_samples, X_train.shape[0]),
-                                 score_type=opts.ifor_score_type, random_state=rng,
-                                 add_leaf_nodes_only=opts.ifor_add_leaf_nodes_only)
-        mdl.fit(X_train)
+        mdl = get_aad_iforest_model(opts, X_train, rng)
         logger.debug("total #nodes: %d" % (len(mdl.all_regions)))
 
         if run_orig_iforest_only:
@@ -152,33 +149,74 @@ if run_aad:
             X_train_new = None
             ensemble = None
 
+    results = None
     if all_num_seen is not None:
         results = SequentialResults(num_seen=all_num_seen, num_seen_baseline=all_num_seen_baseline,
                                     true_queried_indexes=all_queried_indexes,
                                     true_queried_indexes_baseline=all_queried_indexes_baseline)
-        write_sequential_results_to_csv(results, opts)
+        if write_results:
+            write_sequential_results_to_csv(results, opts)
     else:
         logger.debug("baseline:\n%s\norig iforest:\n%s" % (all_baseline, all_orig_iforest))
 
-    if all_orig_num_seen is not None:
+    if write_results and all_orig_num_seen is not None:
         prefix = opts.get_alad_metrics_name_prefix()
         orig_num_seen_file = os.path.join(opts.resultsdir, "%s-orig_num_seen.csv" % (prefix,))
         np.savetxt(orig_num_seen_file, all_orig_num_seen, fmt='%d', delimiter=',')
 
-    if len(baseline_query_info) > 0:
+    if write_results and len(baseline_query_info) > 0:
         write_baseline_query_indexes(baseline_query_info, opts)
 
-if run_tests:
-    rng = np.random.RandomState(args.randseed)
+    if run_tests:
+        run_iforest_unit_tests(opts, X_train, labels, mdl=mdl, metrics=metrics)
 
-    if mdl is None:
-        # fit the model
-        mdl = AadIsolationForest(n_estimators=opts.ifor_n_trees,
-                                 max_samples=min(opts.ifor_n_samples, X_train.shape[0]),
-                                 score_type=opts.ifor_score_type, random_state=rng,
-                                 add_leaf_nodes_only=opts.ifor_add_leaf_nodes_only)
-        mdl.fit(X_train)
+    return results
+
+
+def main():
+    if True:
+        # PRODUCTION code
+        args = get_command_args(debug=False)
+        # print "log file: %s" % args.log_file
+        configure_logger(args)
+    else:
+        # DEBUG code
+        datasets = ["abalone", "ann_thyroid_1v3", "cardiotocography_1", "covtype_sub",
+                    "kddcup_sub", "mammography_sub", "shuttle_sub", "toy", "yeast"]
+
+        dataset = datasets[7]
+        datapath = "/Users/moy/work/datasets/anomaly/%s/fullsamples/%s_1.csv" % (dataset, dataset)
+        outputdir = "/Users/moy/work/ADAPT/data/bovia_scores/feedback"
+
+        budget = 0  # 10
+        n_runs = 10
+        args = get_aad_iforest_args(dataset=dataset, budget=budget, reruns=n_runs,
+                                    log_file="/Users/moy/work/ADAPT/data/bovia_scores/feedback/alad.txt")
+        args.datafile = datapath
+        args.resultsdir = os.path.join(outputdir, args.dataset, "if_aad_%d_%d_%d_sig%4.3f_cx%4.3f" %
+                                       (args.ifor_n_trees, args.ifor_n_samples, args.budget,
+                                        args.sigma2, args.Cx))
+        dir_create(args.resultsdir)
+
+    opts = Opts(args)
+    # print opts.str_opts()
+    logger.debug(opts.str_opts())
+
+    run_aad = False
+    run_tests = True and opts.reruns == 1
+
+    X_train, labels = read_labeled_csv(opts.datafile)
+
+    # X_train = X_train[0:10, :]
+    # labels = labels[0:10]
+
+    logger.debug("loaded file: %s" % opts.datafile)
+
+    if run_aad:
+        run_iforest_aad(opts, X_train, labels, run_tests=run_tests)
+    elif run_tests:
+        run_iforest_unit_tests(opts, X_train, labels)
 
-    iforest_unit_tests_battery(X_train, labels, mdl, metrics, opts,
-                               args.resultsdir, dataset_name=args.dataset)
 
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import numpy as np
 from r_support import matrix, logger
+from instrumentation import count_event
 
 
 def get_num_batches(n, batch_size):
@@ -27,6 +28,7 @@ def avg_loss_check(losses, epoch, n=20, eps=1e-6):
 
 
 def debug_log_sgd_losses(sgd_type, losses, epoch, n=20):
+    count_event("epochs", epoch)
     if False:
         # disable logging -- should be used in PRODUCTION
         return
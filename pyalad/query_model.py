@@ -58,6 +58,8 @@ class QueryGP(Query):
         self.budget = kwargs.get("budget")
         self.s = 0
         self.f = 0
+        # GP train kernel/Cholesky factor maintained across feedback iterations
+        self.gp_state = GPTrainState(length_scale=20., noise=0.005)
 
     def update_query_state(self, **kwargs):
         rewarded = kwargs.get("rewarded")
@@ -86,7 +88,8 @@ class QueryGP(Query):
                 get_gp_predictions(x, anom_score,
                                    ordered_indexes=ordered_indexes,
                                    queried_indexes=queried_items,
-                                   n_train=100, n_test=self.opts.n_explore)
+                                   n_train=100, n_test=self.opts.n_explore,
+                                   gp_state=self.gp_state)
             if False:
                 logger.debug("gp_var:\n%s\ntrain_indexes:%s\ntest_indexes:\n%s" %
                              (str(list(gp_var)), str(list(train_indexes)), str(list(test_indexes))))
@@ -190,7 +193,7 @@ class QuerySequential(Query):
 
     def get_next_query(self, **kwargs):
         x = kwargs.get("x")
-        labels = kwargs.get("labels")
+        labels = kwargs.get("labels", kwargs.get("lbls"))
         w = kwargs.get("w")
         hf = kwargs.get("hf")
         remaining_budget = kwargs.get("remaining_budget")
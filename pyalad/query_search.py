@@ -1,6 +1,10 @@
 from loda_support import *
 from alad_simple import *
 from weight_inference import *
+from region_index import to_sparse_region_features
+
+Parallel = LazyImport("joblib", "Parallel")
+delayed = LazyImport("joblib", "delayed")
 
 
 class ActionValue(object):
@@ -9,74 +13,204 @@ class ActionValue(object):
         self.value = value
 
 
+class QuerySearchState(object):
+    """ A state in the query lookahead search
+
+    A state is identified by the set of (instance, label) feedback pairs.
+    The weights, scores and score ECDF are computed once per state and
+    reused wherever the state is reached again.
+    """
+    def __init__(self, hf, lbls, w, scores):
+        self.hf = hf
+        self.lbls = lbls
+        self.w = w
+        self.scores = scores
+        self.scores_ecdf = ecdf(scores)
+        self.key = frozenset([(int(i), int(lbls[i])) for i in hf])
+        self.voi = None
+
+
+class QueryLookaheadSearch(object):
+    """ Memoized lookahead search for the next query
+
+    The value of a query is the expected value (over both label outcomes)
+    of the best query sequence that follows, and the leaves are valued by
+    the change in VOI loss (see compute_reward). Search states are memoized
+    by the set of (instance, label) feedback pairs. Hence, the weights of a
+    state are those of the first path through which it was reached.
+
+    Each (instance, label) branch at the root is searched on its own, with
+    its own memo and its own random state for the query candidates (see
+    get_branch_random_state). Hence, the branches can be evaluated in
+    parallel and the best query does not depend on n_jobs.
+
+    Attributes:
+        beam_width: int
+            max number of candidates expanded per state (0: no limit)
+        max_nodes: int
+            max number of states expanded in one search (0: no limit),
+            divided equally among the root branches. Once exhausted, the
+            remaining nodes are valued as leaves.
+        n_jobs: int
+            number of processes over which the branches at the root
+            are evaluated
+        random_state: np.random.RandomState
+            draws whether the query candidates of a state explore
+    """
+    def __init__(self, x, opts, beam_width=0, max_nodes=0, n_jobs=1, random_state=None):
+        self.x = x
+        self.opts = opts
+        self.beam_width = beam_width
+        self.max_nodes = max_nodes
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.states = dict()
+        self.values = dict()
+        self.n_expanded = 0
+
+    def get_root_state(self, lbls, w, hf):
+        lbls = np.array(lbls)
+        hf = np.array(hf, dtype=int)
+        state = QuerySearchState(hf, lbls, w, self.x.dot(w))
+        return self.states.setdefault(state.key, state)
+
+    def get_child_state(self, state, a, y):
+        key = state.key.union([(int(a), int(y))])
+        child = self.states.get(key)
+        if child is None:
+            opts = self.opts
+            hf_new = append(state.hf, [a])
+            lbls_new = np.array(state.lbls)
+            lbls_new[a] = y
+            w_new = weight_update_online_simple(self.x, lbls_new, hf_new, state.w,
+                                                nu=opts.nu, Ca=opts.Ca, Cn=opts.Cn,
+                                                sigma2=opts.priorsigma2,
+                                                relativeto=opts.relativeto,
+                                                tau_anomaly=opts.tau, tau_nominal=opts.tau_nominal)
+            child = QuerySearchState(hf_new, lbls_new, w_new, self.x.dot(w_new))
+            self.states[key] = child
+        return child
+
+    def get_voi(self, state):
+        if state.voi is None:
+            state.voi = voi_loss(self.x, state.scores, state.hf, self.opts.tau)
+        return state.voi
+
+    def is_exhausted(self):
+        return 0 < self.max_nodes <= self.n_expanded
+
+    def get_candidates(self, state, remaining_budget):
+        candidates = generate_query_candidates(self.x, state.hf, state.w, state.scores,
+                                               remaining_budget, self.opts,
+                                               random_state=self.random_state)
+        if self.beam_width > 0:
+            candidates = candidates[0:self.beam_width]
+        return candidates
+
+    def get_query_value(self, state, a, y, k, remaining_budget):
+        """ Value of querying instance a (with outcome y) in state
+        followed by k more queries """
+        child = self.get_child_state(state, a, y)
+        if k <= 0 or remaining_budget <= 0 or self.is_exhausted():
+            R = self.get_voi(child) - self.get_voi(state)
+            # logger.debug("inst: %d, R: %f, rem. budget: %d, k: %d" % (a, R, remaining_budget, k))
+            return R
+        return self.get_best_query(child, k, remaining_budget).value
+
+    def get_expected_query_value(self, state, a, k, remaining_budget):
+        v_0 = self.get_query_value(state, a, 0, k, remaining_budget)
+        v_1 = self.get_query_value(state, a, 1, k, remaining_budget)
+        p_anomaly_given_x = state.scores_ecdf(state.scores[a])
+        return (p_anomaly_given_x * v_1) + ((1 - p_anomaly_given_x) * v_0)
+
+    def get_best_query(self, state, k, remaining_budget):
+        memo_key = (state.key, k, remaining_budget)
+        best = self.values.get(memo_key)
+        if best is not None:
+            return best
+        self.n_expanded += 1
+        best = ActionValue(action=None, value=-np.Inf)
+        for a in self.get_candidates(state, remaining_budget):
+            v_a = self.get_expected_query_value(state, a, k - 1, remaining_budget - 1)
+            if v_a > best.value:
+                best = ActionValue(action=a, value=v_a)
+        self.values[memo_key] = best
+        return best
+
+    def search(self, lbls, w, hf, remaining_budget, k):
+        """ Returns the best next query (ActionValue) looking k queries ahead """
+        k = min(k, remaining_budget)
+        root = self.get_root_state(lbls, w, hf)
+        if k <= 0:
+            return ActionValue(action=None, value=0)
+        self.random_state = get_branch_random_state(self.opts, root.hf)
+        candidates = self.get_candidates(root, remaining_budget)
+        branches = [(a, y) for a in candidates for y in [0, 1]]
+        max_nodes = 0
+        if self.max_nodes > 0:
+            max_nodes = max(1, self.max_nodes // len(branches))
+        if self.n_jobs == 1:
+            values = [get_query_branch_value(self.x, root.lbls, root.w, root.hf, a, y,
+                                             k - 1, remaining_budget - 1, self.opts,
+                                             self.beam_width, max_nodes, branch=i)
+                      for i, (a, y) in enumerate(branches)]
+        else:
+            values = Parallel(n_jobs=self.n_jobs)(
+                delayed(get_query_branch_value)(self.x, root.lbls, root.w, root.hf, a, y,
+                                                k - 1, remaining_budget - 1, self.opts,
+                                                self.beam_width, max_nodes, branch=i)
+                for i, (a, y) in enumerate(branches))
+        best = ActionValue(action=None, value=-np.Inf)
+        for i, a in enumerate(candidates):
+            p_anomaly_given_x = root.scores_ecdf(root.scores[a])
+            v_a = (p_anomaly_given_x * values[2 * i + 1]) + ((1 - p_anomaly_given_x) * values[2 * i])
+            if v_a > best.value:
+                best = ActionValue(action=a, value=v_a)
+        logger.debug("hf: %s" % ",".join([str(i) for i in hf]))
+        logger.debug("best inst: %s, value: %f, root branches: %d" %
+                     (best.action, best.value, len(branches)))
+        return best
+
+
+def get_branch_random_state(opts, hf, branch=None):
+    """ Random state for the query candidates of the search from feedback hf
+
+    It is derived from opts.randseed, the number of feedback instances and
+    the index of the root branch (None for the root), hence the search is
+    reproducible and does not depend on the process a branch runs in.
+    """
+    seed = [opts.randseed, len(hf)]
+    if branch is not None:
+        seed.append(branch + 1)
+    return np.random.RandomState(seed)
+
+
+def get_query_branch_value(x, lbls, w, hf, a, y, k, remaining_budget, opts,
+                           beam_width=0, max_nodes=0, branch=0):
+    """ Evaluates one branch at the root of the search (possibly in a worker process) """
+    search = QueryLookaheadSearch(x, opts, beam_width=beam_width, max_nodes=max_nodes,
+                                  random_state=get_branch_random_state(opts, hf, branch))
+    root = search.get_root_state(lbls, w, hf)
+    return search.get_query_value(root, a, y, k, remaining_budget)
+
+
 def get_next_query_and_utility(x=None, lbls=None,
                                w=None, hf=None, remaining_budget=0,
                                k=0, a=None, y=None, opts=None):
-    #logger.debug("query search budget: %d, k: %d, a: %d, y: %d" % (remaining_budget, k, a, y))
-    k = min(k, remaining_budget)
+    """ Returns the best query (ActionValue) looking k queries ahead
 
-    hf_new = hf
-    lbls_new = lbls
-    w_new = w
-    scores = x.dot(w)
-    scores_new = scores
-
-    scores_ecdf = ecdf(scores)
-    scores_new_ecdf = scores_ecdf
-
-    if False:
-        # DEBUG only block
-        ordered_indexes = order(scores_new, decreasing=True)
-        p = p_logistic(x, ordered_indexes, tau=opts.tau)
-        logger.debug(np.round(p[:, 0], 4))
-        raise NotImplementedError("debug")
-    
-    if a is not None:
-        hf_new = append(hf, [a])
-        lbls_new[a] = y
-        w_new = weight_update_online_simple(x, lbls_new, hf_new, w,
-                                            nu=opts.nu, Ca=opts.Ca, Cn=opts.Cn,
-                                            sigma2=opts.priorsigma2,
-                                            relativeto=opts.relativeto,
-                                            tau_anomaly=opts.tau, tau_nominal=opts.tau_nominal)
-        scores_new = x.dot(w_new)
-        scores_new_ecdf = ecdf(scores_new)
-        R = compute_reward(x, w, hf, scores, w_new, hf_new, scores_new, opts,
-                           scores_ecdf=scores_ecdf, scores_new_ecdf=scores_new_ecdf)
-        logger.debug("inst: %d, R: %f, rem. budget: %d, k: %d" % (a, R, remaining_budget, k))
-    else:
-        R = 0
-    
-    if k <= 0 or remaining_budget <= 0:
-        if k > remaining_budget:
-            raise ValueError("warning: k > remaining_budget (k=%d, rem. budget=%d)" %
-                             (k, remaining_budget))
-        return ActionValue(action=a, value=R)
-    
-    Q = generate_query_candidates(x, hf_new, w_new, scores_new, remaining_budget, opts)
-
-    A = []
-    best_i = 0
-    best_v = -np.Inf
-    for i in range(len(Q)):
-        uv_0 = get_next_query_and_utility(x, lbls_new, w_new, hf_new,
-                                          remaining_budget - 1, k - 1, Q[i], 0, opts)
-        uv_1 = get_next_query_and_utility(x, lbls_new, w_new, hf_new,
-                                          remaining_budget - 1, k - 1, Q[i], 1, opts)
-        p_anomaly_given_x = scores_new_ecdf(scores_new[Q[i]])
-        v_i = (p_anomaly_given_x * uv_1.value) + ((1-p_anomaly_given_x) * uv_0.value)  # compute the value
-        logger.debug("inst: %d, v: %f, v_0: %f, v_1: %f, p(y=1|x): %f" %
-                     (Q[i], v_i, uv_0.value, uv_1.value, p_anomaly_given_x))
-        A.append(ActionValue(action=Q[i], value=v_i))
-        if v_i > best_v:
-            best_i = i
-            best_v = v_i
+    If a is not None, returns the value of querying a (with label y) instead.
+    """
+    k = min(k, remaining_budget)
+    search = QueryLookaheadSearch(x, opts,
+                                  beam_width=opts.query_search_beam_width,
+                                  max_nodes=opts.query_search_max_nodes,
+                                  n_jobs=opts.query_search_n_jobs)
     if a is None:
-        # only when called initially and not for intermittent stages
-        logger.debug("hf: %s" % ",".join([str(i) for i in hf]))
-        logger.debug("best inst: %d" % A[best_i].action)
-    
-    return A[best_i]
+        return search.search(lbls, w, hf, remaining_budget, k)
+    search.random_state = get_branch_random_state(opts, hf)
+    root = search.get_root_state(lbls, w, hf)
+    return ActionValue(action=a, value=search.get_query_value(root, a, y, k, remaining_budget))
 
 
 def compute_reward(x, w, hf, scores, w_new, hf_new, scores_new, opts,
@@ -117,26 +251,26 @@ def voi_loss(x, scores, hf, tau):
     topn = n * tau
     p = p_logistic(x, ordered_indexs, tau)
     # logger.debug(p)
-    loss = 0
-    for i in range(n):
-        item = ordered_indexs[i]
-        if len(np.where(hf == item)[0]) > 0:
-            p_y1 = p[item]    #scores_ecdf(scores[item])
-            if i <= topn:
-                loss += (1 - p_y1)
-            else:
-                loss += p_y1
+    # ranks of the labeled instances
+    ranks = np.where(np.isin(ordered_indexs, hf))[0]
+    p_y1 = p[ordered_indexs[ranks]]  # scores_ecdf(scores[item])
+    loss = np.sum(np.where(ranks <= topn, 1 - p_y1, p_y1))
     return loss / float(n-len(hf))
 
 
-def generate_query_candidates(x, hf, w, scores, remaining_budget, opts):
+def generate_query_candidates(x, hf, w, scores, remaining_budget, opts, random_state=None):
     # generate one-step query candidates
     # with probability p_r = f(remaining_budget, max_budget) return candidates for exploration.
     # with probability 1-p_r return the top ranked instance.
+    # random_state draws the exploration; the global numpy random state if None.
     ordered_idxs = order(scores, decreasing = True)
     p_r = exploration_probability(remaining_budget, opts.budget)
     logger.debug("Explore prob (%d, %d): %6.4f" % (remaining_budget, opts.budget, p_r))
-    if runif(1, min=0.0, max=1.0)[0] > p_r:
+    if random_state is None:
+        u = runif(1, min=0.0, max=1.0)[0]
+    else:
+        u = random_state.uniform(0.0, 1.0)
+    if u > p_r:
         # return the top ranked item
         candidates = get_first_vals_not_marked(ordered_idxs, hf, n=1, start=1)
     else:
@@ -159,6 +293,7 @@ def p_logistic(x, ordered_indexes, tau):
     n = nrow(x)
     n1 = int(round(tau * n, 0))
     lbls = np.array(append(list(rep(1, n1, dtype=int)), list(rep(0, n - n1, dtype=int))))
+    x = to_sparse_region_features(x)
     lr = LogisticRegressionClassifier.fit(x[ordered_indexes, :], lbls)
     p = lr.predict_prob_for_class(x, 1)
     # cls = lr.predict(x, type="class")
@@ -5,23 +5,13 @@ import random
 import os
 import os.path
 import errno
-from pandas import DataFrame
+import importlib
 import sys
 from timeit import default_timer as timer
 from datetime import timedelta
 import traceback
 
-from statsmodels.distributions.empirical_distribution import ECDF
-import ranking
-from ranking import Ranking
-
 from scipy.sparse import csr_matrix
-import scipy.stats as stats
-import scipy.optimize as opt
-
-from sklearn.linear_model import LogisticRegression as LR
-
-import cvxopt
 
 
 """
@@ -29,6 +19,52 @@ Some R-like functions to help port R code to python
 """
 
 
+class LazyImport(object):
+    """ Stands in for a module, or an attribute of a module, which is imported on first use
+
+    The heavy dependencies (pandas, statsmodels, sklearn, scipy.optimize, cvxopt)
+    are only needed by the optimizers, R-compat helpers and scripts. Importing
+    them lazily keeps the import of the scoring code (numpy and scipy.sparse
+    only) fast.
+
+    Usage:
+        stats = LazyImport("scipy.stats")
+        DataFrame = LazyImport("pandas", "DataFrame")
+    """
+    def __init__(self, module_name, attr=None):
+        self._module_name = module_name
+        self._attr = attr
+        self._obj = None
+
+    def _load(self):
+        if self._obj is None:
+            obj = importlib.import_module(self._module_name)
+            if self._attr is not None:
+                obj = getattr(obj, self._attr)
+            self._obj = obj
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+DataFrame = LazyImport("pandas", "DataFrame")
+
+ECDF = LazyImport("statsmodels.distributions.empirical_distribution", "ECDF")
+ranking = LazyImport("ranking")
+Ranking = LazyImport("ranking", "Ranking")
+
+stats = LazyImport("scipy.stats")
+opt = LazyImport("scipy.optimize")
+
+LR = LazyImport("sklearn.linear_model", "LogisticRegression")
+
+cvxopt = LazyImport("cvxopt")
+
+
 logger = logging.getLogger(__name__)
 
 
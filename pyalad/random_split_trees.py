@@ -5,6 +5,7 @@ from __future__ import division
 
 import logging
 import copy
+from functools import partial
 
 import numpy as np
 import scipy as sp
@@ -18,21 +19,23 @@ from numpy import random
 from scipy.sparse import issparse
 
 import numbers
-from sklearn.externals import six
-from sklearn.tree import ExtraTreeRegressor
 from sklearn.utils import check_random_state, check_array
+from sklearn.utils.random import sample_without_replacement
+from sklearn.externals import six
 
-from sklearn.ensemble.bagging import BaseBagging
-from sklearn.tree._tree import Tree
 from sklearn.ensemble import IsolationForest
 
 from multiprocessing import Pool
 
 from r_support import *
+from aad_scoring import get_tree_leaves, get_tree_paths, get_element_lookup, get_elements
 
-__all__ = ["ArrTree", "HSSplitter", "HSTree", "HSTrees",
+__all__ = ["ArrTree", "get_arr_tree_from_arrays", "RandomSplitTree", "RandomSplitForest",
+           "HSSplitter", "HSTree", "HSTrees",
            "RSForestSplitter", "RSTree", "RSForest",
-           "IForest", "StreamingSupport"]
+           "IForest", "StreamingSupport",
+           "get_arr_tree_from_sklearn_tree", "ArrIForest", "convert_isolation_forest",
+           "IsolationTreeBuilder", "IsolationTree", "IsolationTrees"]
 
 INTEGER_TYPES = (numbers.Integral, np.int)
 
@@ -152,6 +155,9 @@ class ArrTree(object):
         weighted_n_node_samples : array of int, shape [node_count]
             weighted_n_node_samples[i] holds the weighted number of training samples
             reaching node i.
+
+        is_compact : bool
+            Whether compact() has been called. See compact().
     """
     def __init__(self, n_features, max_depth=0):
         self.n_features = n_features
@@ -159,6 +165,7 @@ class ArrTree(object):
 
         self.node_count = 0
         self.capacity = 0
+        self.is_compact = False
 
         self.nodes = None
         self.children_left = None
@@ -209,6 +216,8 @@ class ArrTree(object):
         """ Guts of resize """
 
         # below code is from Cython implementation in sklearn
+        if self.is_compact:
+            raise ValueError("Compact trees cannot be resized")
         if capacity == self.capacity and self.nodes is not None:
             return 0
 
@@ -245,6 +254,36 @@ class ArrTree(object):
     def reset_n_node_samples(self):
         self.n_node_samples[:] = 0
 
+    def compact(self):
+        """Converts the fitted tree to the compact representation
+
+        The children and feature arrays become int32 and the thresholds
+        float32. The arrays are trimmed to node_count, and the arrays not
+        needed after fitting (nodes, value, impurity, weighted_n_node_samples)
+        are dropped. The sample counts and volumes stay float64 since they
+        are accumulated by stream updates.
+
+        Since the thresholds are rounded to float32 (relative error < 6e-8),
+        an instance that is closer than that to a threshold might go to a
+        different child than in the full precision tree. A compact tree
+        cannot be grown further.
+        """
+        n = self.node_count
+        self.children_left = np.asarray(self.children_left[0:n], dtype=np.int32)
+        self.children_right = np.asarray(self.children_right[0:n], dtype=np.int32)
+        self.feature = np.asarray(self.feature[0:n], dtype=np.int32)
+        self.threshold = np.asarray(self.threshold[0:n], dtype=np.float32)
+        self.v = self.v[0:n]
+        self.acc_log_v = self.acc_log_v[0:n]
+        self.n_node_samples = self.n_node_samples[0:n]
+        self.n_node_samples_buffer = self.n_node_samples_buffer[0:n]
+        self.nodes = None
+        self.value = None
+        self.impurity = None
+        self.weighted_n_node_samples = None
+        self.capacity = n
+        self.is_compact = True
+
     def add_node(self, parent, is_left, is_leaf, feature,
                  threshold, v, impurity, n_node_samples,
                  weighted_n_node_samples):
@@ -294,23 +333,14 @@ class ArrTree(object):
         if self.node_count < 1:
             # no nodes; likely tree has not been constructed yet
             raise ValueError("Tree not constructed yet")
-        for i in np.arange(X.shape[0]):
-            node = 0  # start at root
-            while node >= 0:
-                if current:
-                    self.n_node_samples[node] += 1
-                else:
-                    self.n_node_samples_buffer[node] += 1
-                val = X[i, self.feature[node]]
-                if self.children_left[node] == -1 and self.children_right[node] == -1:
-                    # reached leaf
-                    # self.n_node_samples[node] += 1
-                    break
-                if val <= self.threshold[node]:
-                    next_node = self.children_left[node]
-                else:
-                    next_node = self.children_right[node]
-                node = next_node
+        counts = self.n_node_samples if current else self.n_node_samples_buffer
+        # all instances are moved down the tree together (see get_tree_paths);
+        # X might be dense or sparse
+        _, nodes, _ = get_tree_paths(self.children_left, self.children_right,
+                                     self.feature, self.threshold, X)
+        node_counts = np.bincount(nodes, minlength=self.node_count)[0:self.node_count]
+        node_counts[0] += X.shape[0]  # every instance passes through the root
+        counts[0:self.node_count] += node_counts
 
     def get_all_leaf_nodes(self):
         leaves = np.zeros(self.node_count, dtype=int)
@@ -351,34 +381,36 @@ class ArrTree(object):
         if self.node_count < 1:
             # no nodes; likely tree has not been constructed yet
             raise ValueError("Tree not constructed yet")
+        if not getnodeinds:
+            return self.apply_leaves(X) if getleaves else None
         n = X.shape[0]
+        rows, nodes, _ = get_tree_paths(self.children_left, self.children_right,
+                                        self.feature, self.threshold, X)
         leaves = None
         if getleaves:
+            # nodes are in the order of depth, hence the last node of each row is its leaf
             leaves = np.zeros(n, dtype=int)
-        x_tmp = None
-        if getnodeinds:
-            nodeinds = csr_matrix((0, self.node_count), dtype=float)
-            x_tmp = lil_matrix((n, self.node_count), dtype=nodeinds.dtype)
-        for i in np.arange(n):
-            node = 0  # start at root
-            while node >= 0:
-                if getnodeinds:
-                    x_tmp[i, node] = 1
-                v = X[i, self.feature[node]]
-                if self.children_left[node] == -1 and self.children_right[node] == -1:
-                    # reached leaf
-                    if getleaves:
-                        leaves[i] = node
-                    break
-                if v <= self.threshold[node]:
-                    next_node = self.children_left[node]
-                else:
-                    next_node = self.children_right[node]
-                node = next_node
-        if getnodeinds:
-            nodeinds = x_tmp.tocsr()
-            return leaves, nodeinds
-        return leaves
+            leaves[rows] = nodes
+        # every instance passes through the root
+        all_rows = np.append(np.arange(n), rows)
+        all_nodes = np.append(np.zeros(n, dtype=int), nodes)
+        nodeinds = csr_matrix((np.ones(len(all_rows), dtype=float), (all_rows, all_nodes)),
+                              shape=(n, self.node_count))
+        return leaves, nodeinds
+
+    def apply_leaves(self, X):
+        """Returns the leaf node index for each instance (row) of dense or sparse matrix X
+
+        All instances are moved down the tree together, one level at a time.
+        """
+        return get_tree_leaves(self.children_left, self.children_right,
+                               self.feature, self.threshold, X)
+
+    def __setstate__(self, state):
+        # trees pickled before compact() was added are not compact
+        self.__dict__.update(state)
+        if "is_compact" not in self.__dict__:
+            self.is_compact = False
 
     def __repr__(self):
         s = ''
@@ -399,6 +431,56 @@ class ArrTree(object):
         return self.__repr__()
 
 
+def get_arr_tree_from_arrays(n_features, children_left, children_right, feature, threshold,
+                             n_node_samples, n_node_samples_buffer=None, v=None, acc_log_v=None,
+                             max_depth=0):
+    """Creates an ArrTree that uses the input arrays without copying them
+
+    The arrays might be memory-mapped. The node count is the length of the arrays.
+    """
+    tree = ArrTree(n_features, max_depth=max_depth)
+    node_count = len(children_left)
+    tree.nodes = np.arange(node_count)
+    tree.children_left = children_left
+    tree.children_right = children_right
+    tree.feature = feature
+    tree.threshold = threshold
+    tree.n_node_samples = n_node_samples
+    tree.n_node_samples_buffer = n_node_samples_buffer if n_node_samples_buffer is not None \
+        else np.zeros(node_count, dtype=float)
+    tree.v = v if v is not None else np.ones(node_count, dtype=float)
+    tree.acc_log_v = acc_log_v if acc_log_v is not None else np.zeros(node_count, dtype=float)
+    tree.node_count = node_count
+    tree.capacity = node_count
+    return tree
+
+
+def get_arr_tree_from_sklearn_tree(tree_, n_features, features=None):
+    """Copies a fitted sklearn tree (e.g., of an IsolationForest) to an ArrTree
+
+    :param tree_: sklearn.tree._tree.Tree
+    :param n_features: int
+        number of features of the data on which the forest was fit
+    :param features: np.array(dtype=int)
+        features on which this tree was fit (estimators_features_ of the
+        forest); the feature indexes of the tree are mapped back to the
+        columns of the original data. None if all features were used.
+    :return: ArrTree
+        the sample counts are copied and the stream buffer counts are zero
+    """
+    children_left = np.array(tree_.children_left, dtype=int)
+    feature = np.array(tree_.feature, dtype=int)
+    if features is not None:
+        internal = np.where(children_left != TREE_LEAF)[0]
+        feature[internal] = np.asarray(features, dtype=int)[feature[internal]]
+    return get_arr_tree_from_arrays(n_features, children_left,
+                                    np.array(tree_.children_right, dtype=int),
+                                    feature,
+                                    np.array(tree_.threshold, dtype=float),
+                                    np.array(tree_.n_node_samples, dtype=float),
+                                    max_depth=tree_.max_depth)
+
+
 def HPDByInverseCDF(x, p=0.90, sigs=0):
     """Highest probability density by inverse cumulative distribution function
 
@@ -418,6 +500,64 @@ def HPDByInverseCDF(x, p=0.90, sigs=0):
     return cis[0] - sigs * v, cis[1] + sigs * v, v
 
 
+def get_hpd_ranges(X, p=0.90, sigs=0, max_rows=0, random_state=None):
+    """HPDByInverseCDF() for all columns of X at once
+
+    Same as calling HPDByInverseCDF() on each column, without creating an
+    ECDF per column. The ECDF at t is looked up from the number of values
+    <= t in the same way as statsmodels ECDF, and the variances are computed
+    over the Fortran-ordered columns, so that the results are identical.
+
+    Args:
+        X: np.ndarray or scipy.sparse matrix
+        max_rows: int
+            if > 0 and X has more rows, the ranges are estimated on a
+            random subsample of max_rows rows
+        random_state: np.random.RandomState
+            used to draw the subsample
+
+    Returns: (np.array, np.array, np.array)
+        lower intervals, upper intervals, variances of the columns of X
+    """
+    n = X.shape[0]
+    if 0 < max_rows < n:
+        rnd = check_random_state(random_state)
+        X = X[sample_without_replacement(n, max_rows, random_state=rnd)]
+        n = max_rows
+    lc = (1 - p) / 2
+    uc = p + lc
+    # ECDF values for 0..n instances <= t, as in statsmodels
+    y = np.r_[0., np.linspace(1. / n, 1, n)]
+    if issparse(X):
+        X = X.tocsc()
+        col_nnz = np.diff(X.indptr)
+        cols = np.repeat(np.arange(X.shape[1]), col_nnz)
+        n_zeros = n - col_nnz
+        means = np.asarray(X.sum(axis=0), dtype=float).reshape(-1) / n
+        v = (np.bincount(cols, weights=(X.data - means[cols]) ** 2, minlength=X.shape[1]) +
+             n_zeros * means ** 2) / n
+
+        def count_le(t):
+            # the implicit zeros are <= t iff 0 <= t
+            return np.bincount(cols[X.data <= t], minlength=X.shape[1]) + (n_zeros if 0 <= t else 0)
+
+        first = np.asarray(X[0, :].todense(), dtype=float).reshape(-1)
+    else:
+        X = np.asfortranarray(X)
+        v = np.var(X, axis=0)
+
+        def count_le(t):
+            return np.sum(X <= t, axis=0)
+
+        first = X[0, :]
+    lower = y[count_le(lc)] - sigs * v
+    upper = y[count_le(uc)] + sigs * v
+    const = v == 0
+    lower[const] = first[const]
+    upper[const] = first[const]
+    return lower, upper, v
+
+
 class RandomTreeBuilder(object):
     """
     Attributes:
@@ -518,6 +658,104 @@ class RandomTreeBuilder(object):
         tree.add_samples(X)
 
 
+class IsolationTreeBuilder(object):
+    """Builds an isolation tree on the instances X (usually a subsample)
+
+    Every node splits on a random feature which is not constant on its
+    instances, at a value drawn uniformly in their range. The tree is built
+    level by level. The instances of a node are the range [start, end) of a
+    single index array, and all the nodes of a level are partitioned
+    together with one stable sort of that array. Hence, X is never copied
+    and no index arrays are allocated per node; per node, only the values
+    of the candidate features are read.
+
+    Attributes:
+        max_depth: int
+        random_state: np.random.RandomState
+    """
+    def __init__(self, max_depth, random_state=None):
+        self.max_depth = max_depth
+        self.random_state = check_random_state(random_state)
+
+    def build(self, tree, X, y=None, sample_weight=None, X_idx_sorted=None):
+        """Build an isolation tree from the instances in X
+
+        The node sample counts are the sizes of the partitions, hence no
+        separate pass over X is needed to count them.
+
+        Args:
+            tree: ArrTree
+            X: numpy.ndarray or scipy.sparse matrix
+        """
+        X_rows = None
+        if issparse(X):
+            # rows, to find the features that are not all zeros in a node
+            X_rows = X.tocsr()
+        X = get_element_lookup(X)
+        n, d = X.shape
+        rnd = self.random_state
+
+        # an isolation tree of n instances has at most 2n - 1 nodes
+        tree.resize(max(1, 2 * n - 1))
+
+        samples = np.arange(n)
+        depth = 0
+
+        # nodes of the current level: (start, end, parent, is_left)
+        level = [(0, n, TREE_UNDEFINED, 0)]
+        while len(level) > 0:
+            # sort keys of the positions in samples; the positions of a split
+            # node [start, end) get 2*start (left) or 2*start + 1 (right) and
+            # every other position p keeps 2*p, hence a stable sort moves the
+            # instances of each split node to the left or right of its range
+            keys = None
+            next_level = []
+            for start, end, parent, is_left in level:
+                idxs = samples[start:end]
+
+                feature = TREE_UNDEFINED
+                threshold = TREE_UNDEFINED
+                vals = None
+                if depth < self.max_depth and end - start > 1:
+                    if X_rows is None:
+                        candidates = rnd.permutation(d)
+                    else:
+                        # features which are all zeros (the most) in the node are constant
+                        candidates = rnd.permutation(np.unique(X_rows[idxs].indices))
+                    # try the features in random order till one is not constant
+                    for f in candidates:
+                        if X_rows is None:
+                            vals = X[idxs, f]
+                        else:
+                            vals = get_elements(X, idxs, np.repeat(f, len(idxs)))
+                        mn, mx = np.min(vals), np.max(vals)
+                        if mn < mx:
+                            feature = f
+                            threshold = rnd.uniform(mn, mx)
+                            break
+                is_leaf = feature == TREE_UNDEFINED
+
+                node_id = tree.add_node(parent, is_left, is_leaf, feature, threshold, 1.,
+                                        0., end - start, end - start)
+
+                if not is_leaf:
+                    if keys is None:
+                        keys = 2 * np.arange(n)
+                    right = vals > threshold
+                    keys[start:end] = 2 * start
+                    keys[start:end] += right
+                    pos = end - int(np.sum(right))
+                    next_level.append((start, pos, node_id, 1))
+                    next_level.append((pos, end, node_id, 0))
+
+            if keys is not None:
+                samples = samples[np.argsort(keys, kind='mergesort')]
+
+            tree.max_depth = depth
+            level = next_level
+            depth += 1
+
+
 class RandomSplitTree(object):
     def __init__(self,
                  criterion=None,
@@ -610,6 +848,7 @@ class RandomSplitForest(StreamingSupport):
             - If int, then draw `max_samples` samples.
             - If float, then draw `max_samples * X.shape[0]` samples.
             - If "auto", then `max_samples=min(256, n_samples)`.
+            - If None, then all samples are used.
         If max_samples is larger than the number of samples provided,
         all samples will be used for all trees (no sampling).
 
@@ -648,6 +887,11 @@ class RandomSplitForest(StreamingSupport):
     verbose : int, optional (default=0)
         Controls the verbosity of the tree building process.
 
+    count_all_samples : boolean, optional (default=False)
+        If True, the node sample counts of each tree are computed on all of
+        X after the tree is built on its subsample. This pass takes time
+        linear in the number of samples.
+
 
     Attributes
     ----------
@@ -677,7 +921,8 @@ class RandomSplitForest(StreamingSupport):
                  bootstrap=False,
                  n_jobs=1,
                  random_state=None,
-                 verbose=0):
+                 verbose=0,
+                 count_all_samples=False):
         self.max_samples=max_samples
         self.max_features=max_features
         self.n_estimators = n_estimators
@@ -686,7 +931,9 @@ class RandomSplitForest(StreamingSupport):
         self.max_vals = max_vals
         self.max_depth = max_depth
         self.random_state = random_state
+        self.count_all_samples = count_all_samples
         self.estimators_ = None
+        self.max_samples_ = None
 
     def _set_oob_score(self, X, y):
         raise NotImplementedError("OOB score not supported by iforest")
@@ -697,14 +944,44 @@ class RandomSplitForest(StreamingSupport):
     def get_decision_function(self):
         raise NotImplementedError("get_decision_function() not implemented")
 
+    def get_max_samples(self, n_samples):
+        """Returns the number of samples on which each tree is fit"""
+        if self.max_samples is None:
+            return n_samples
+        elif isinstance(self.max_samples, six.string_types):
+            if self.max_samples == "auto":
+                return min(256, n_samples)
+            raise ValueError("max_samples (%s) is not supported. Valid choices are: "
+                             "\"auto\", int or float" % self.max_samples)
+        elif isinstance(self.max_samples, INTEGER_TYPES):
+            if self.max_samples > n_samples:
+                warn("max_samples (%s) is greater than the total number of samples (%s). "
+                     "max_samples will be set to n_samples for estimation."
+                     % (self.max_samples, n_samples))
+            return min(self.max_samples, n_samples)
+        else:
+            if not (0. < self.max_samples <= 1.):
+                raise ValueError("max_samples must be in (0, 1], got %r" % self.max_samples)
+            return max(1, int(self.max_samples * n_samples))
+
+    def get_tree_max_depth(self):
+        return self.max_depth
+
     def _fit(self, X, y, max_samples, max_depth, sample_weight=None):
         n_trees = self.n_estimators
         n_pool = self.n_jobs
+        n_samples = X.shape[0]
 
         p = Pool(n_pool)
         rnd_int = self.random_state.randint(42)
-        trees = p.map(self.get_fitting_function(),
-                      [(max_depth, X, rnd_int + i) for i in range(n_trees)])
+        if max_samples < n_samples:
+            # each tree gets its own subsample; only the subsamples are sent to the workers
+            args = [(max_depth, X[sample_without_replacement(n_samples, max_samples,
+                                                             random_state=self.random_state)],
+                     rnd_int + i) for i in range(n_trees)]
+        else:
+            args = [(max_depth, X, rnd_int + i) for i in range(n_trees)]
+        trees = p.map(self.get_fitting_function(), args)
         return trees
 
     def fit(self, X, y=None, sample_weight=None):
@@ -725,7 +1002,7 @@ class RandomSplitForest(StreamingSupport):
         """
         # ensure_2d=False because there are actually unit test checking we fail
         # for 1d.
-        X = check_array(X, accept_sparse=['csc'], ensure_2d=True)
+        X = check_array(X, accept_sparse=['csc', 'csr'], ensure_2d=True)
         if issparse(X):
             # Pre-sort indices to avoid that each individual tree of the
             # ensemble sorts the indices.
@@ -737,12 +1014,17 @@ class RandomSplitForest(StreamingSupport):
         # ensure that max_sample is in [1, n_samples]:
         n_samples = X.shape[0]
 
-        self.max_samples_ = n_samples
+        self.max_samples_ = self.get_max_samples(n_samples)
 
-        self.estimators_ = self._fit(X, y, self.max_samples,
-                                     max_depth=self.max_depth,
+        self.estimators_ = self._fit(X, y, self.max_samples_,
+                                     max_depth=self.get_tree_max_depth(),
                                      sample_weight=sample_weight)
 
+        if self.count_all_samples and self.max_samples_ < n_samples:
+            for estimator in self.estimators_:
+                estimator.tree_.reset_n_node_samples()
+                estimator.tree_.add_samples(X)
+
         if False:
             for i, estimator in enumerate(self.estimators_):
                 logger.debug("Estimator %d:\n%s" % (i, str(estimator.tree_)))
@@ -781,6 +1063,11 @@ class RandomSplitForest(StreamingSupport):
         for tree in self.estimators_:
             tree.tree_.add_samples(X, current)
 
+    def compact(self):
+        """Converts all fitted trees to the compact representation (see ArrTree.compact())"""
+        for tree in self.estimators_:
+            tree.tree_.compact()
+
     def update_model_from_stream_buffer(self):
         for tree in self.estimators_:
             tree.tree_.update_model_from_stream_buffer()
@@ -804,8 +1091,13 @@ class HSSplitter(object):
         :return: (np.array, np.array)
         """
         rnd = self.random_state if rnd is None else rnd
-        min_vals = np.min(X, axis=0)
-        max_vals = np.max(X, axis=0)
+        if issparse(X):
+            # the implicit zeros are included in the min and max
+            min_vals = np.asarray(X.min(axis=0).todense(), dtype=float).reshape(-1)
+            max_vals = np.asarray(X.max(axis=0).todense(), dtype=float).reshape(-1)
+        else:
+            min_vals = np.min(X, axis=0)
+            max_vals = np.max(X, axis=0)
         diff = max_vals - min_vals
         sq = rnd.uniform(0, 1, len(min_vals))
         # logger.debug("sq: %s" % (str(sq)))
@@ -872,19 +1164,23 @@ class HSTree(RandomSplitTree):
 class HSTrees(RandomSplitForest):
     def __init__(self,
                  n_estimators=100,
+                 max_samples=None,
                  max_features=1.,
                  min_vals=None,
                  max_vals=None,
                  max_depth=10,
                  n_jobs=1,
-                 random_state=None):
+                 random_state=None,
+                 count_all_samples=False):
         RandomSplitForest.__init__(self, n_estimators=n_estimators,
+                                   max_samples=max_samples,
                                    max_features=max_features,
                                    min_vals=min_vals,
                                    max_vals=max_vals,
                                    max_depth=max_depth,
                                    n_jobs=n_jobs,
-                                   random_state=random_state)
+                                   random_state=random_state,
+                                   count_all_samples=count_all_samples)
 
     def get_fitting_function(self):
         return hstree_fit
@@ -919,8 +1215,9 @@ class RSForestSplitter(HSSplitter):
     Attributes:
         split_context: SplitContext
     """
-    def __init__(self, random_state=None):
+    def __init__(self, random_state=None, hpd_max_rows=0):
         HSSplitter.__init__(self, random_state=random_state)
+        self.hpd_max_rows = hpd_max_rows
 
     def get_feature_ranges(self, X, rnd=None):
         """
@@ -928,11 +1225,7 @@ class RSForestSplitter(HSSplitter):
         :return: (np.array, np.array)
         """
         rnd = self.random_state if rnd is None else rnd
-        d = X.shape[1]
-        mn = np.zeros(d, dtype=float)
-        mx = np.zeros(d, dtype=float)
-        for i in np.arange(d):
-            mn[i], mx[i], _ = HPDByInverseCDF(X[:, i], p=0.9, sigs=3)
+        mn, mx, _ = get_hpd_ranges(X, p=0.9, sigs=3, max_rows=self.hpd_max_rows, random_state=rnd)
         return mn, mx
 
     def node_split(self, impurity, split_record, n_constant_features):
@@ -986,32 +1279,43 @@ class RSTree(RandomSplitTree):
 class RSForest(RandomSplitForest):
     def __init__(self,
                  n_estimators=100,
+                 max_samples=None,
                  max_features=1.,
                  min_vals=None,
                  max_vals=None,
                  max_depth=10,
                  n_jobs=1,
-                 random_state=None):
+                 random_state=None,
+                 count_all_samples=False,
+                 hpd_max_rows=0):
+        """
+        :param hpd_max_rows: int
+            if > 0, the feature ranges of each tree are estimated on at most
+            this many of its instances (see get_hpd_ranges())
+        """
         RandomSplitForest.__init__(self, n_estimators=n_estimators,
+                                   max_samples=max_samples,
                                    max_features=max_features,
                                    min_vals=min_vals,
                                    max_vals=max_vals,
                                    max_depth=max_depth,
                                    n_jobs=n_jobs,
-                                   random_state=random_state)
+                                   random_state=random_state,
+                                   count_all_samples=count_all_samples)
+        self.hpd_max_rows = hpd_max_rows
 
     def get_fitting_function(self):
-        return rsforest_fit
+        return partial(rsforest_fit, hpd_max_rows=self.hpd_max_rows)
 
     def get_decision_function(self):
         return rsforest_decision
 
 
-def rsforest_fit(args):
+def rsforest_fit(args, hpd_max_rows=0):
     max_depth = args[0]
     X = args[1]
     random_state = args[2]
-    rsf = RSTree(splitter=RSForestSplitter(random_state=random_state),
+    rsf = RSTree(splitter=RSForestSplitter(random_state=random_state, hpd_max_rows=hpd_max_rows),
                  max_depth=max_depth, max_features=X.shape[1],
                  random_state=random_state)
     rsf.fit(X, None)
@@ -1028,6 +1332,179 @@ def rsforest_decision(args):
     return scores
 
 
+def _average_path_lengths(n_samples_leaf):
+    """Average path length of unsuccessful BST search in trees of n_samples_leaf instances
+
+    Same as IsolationForest._average_path_length in sklearn.
+    """
+    n_samples_leaf = np.asarray(n_samples_leaf, dtype=float)
+    n = np.maximum(n_samples_leaf, 2.)
+    return np.where(n_samples_leaf <= 1, 1.,
+                    2. * (np.log(n - 1.) + 0.5772156649) - 2. * (n - 1.) / n)
+
+
+class ArrIForest(RandomSplitForest):
+    """Isolation Forest fitted by sklearn with the trees copied to ArrTree
+
+    The sklearn trees can only be traversed with tree.apply() (which
+    returns the leaves) or one instance at a time. After the conversion,
+    all instances are moved down a tree together, and the trees support
+    the stream updates (add_samples, update_model_from_stream_buffer) in
+    the same way as HSTrees and RSForest.
+
+    sklearn casts the instances to float32 before traversing its trees; the
+    converted trees compare in float64. Hence an instance within float32
+    round-off of a threshold might go to a different child than in sklearn.
+
+    Attributes:
+        max_samples_: int
+            number of instances used to fit each tree
+        estimators_: list of RandomSplitTree
+            the trees as ArrTree are in estimators_[i].tree_
+    """
+    def __init__(self,
+                 n_estimators=100,
+                 max_samples="auto",
+                 max_features=1.,
+                 n_jobs=1,
+                 random_state=None):
+        RandomSplitForest.__init__(self, n_estimators=n_estimators,
+                                   max_samples=max_samples,
+                                   max_features=max_features,
+                                   n_jobs=n_jobs,
+                                   random_state=random_state)
+        self.max_samples_ = None
+
+    def fit(self, X, y=None, sample_weight=None):
+        """Fits a sklearn IsolationForest and copies its trees"""
+        iforest = IsolationForest(n_estimators=self.n_estimators, max_samples=self.max_samples,
+                                  max_features=self.max_features, n_jobs=self.n_jobs,
+                                  random_state=self.random_state)
+        iforest.fit(X)
+        self.set_trees_from_isolation_forest(iforest)
+        return self
+
+    def set_trees_from_isolation_forest(self, iforest):
+        n_features = iforest.n_features_
+        estimators_features = getattr(iforest, "estimators_features_", None)
+        self.estimators_ = []
+        for i, sk_tree in enumerate(iforest.estimators_):
+            features = None
+            if estimators_features is not None and len(estimators_features[i]) < n_features:
+                features = estimators_features[i]
+            estimator = RandomSplitTree(max_depth=sk_tree.tree_.max_depth)
+            estimator.n_features_ = n_features
+            estimator.tree_ = get_arr_tree_from_sklearn_tree(sk_tree.tree_, n_features, features)
+            self.estimators_.append(estimator)
+        self.n_estimators = len(self.estimators_)
+        self.max_samples_ = iforest.max_samples_
+
+    def decision_function(self, X):
+        """Average anomaly score of X (smaller values are more anomalous)
+
+        Same as IsolationForest.decision_function() in sklearn, but the leaf
+        sample counts are the ones updated by the stream.
+        """
+        X = get_element_lookup(X)
+        depths = np.zeros(X.shape[0], dtype=float)
+        for estimator in self.estimators_:
+            tree = estimator.tree_
+            rows, nodes, path_lengths = get_tree_paths(tree.children_left, tree.children_right,
+                                                       tree.feature, tree.threshold, X)
+            # nodes are in the order of depth, hence the last node of each row is its leaf
+            leaves = np.zeros(X.shape[0], dtype=int)
+            leaves[rows] = nodes
+            depths += path_lengths + _average_path_lengths(tree.n_node_samples[leaves])
+        scores = 2 ** (-depths / (len(self.estimators_) * _average_path_lengths(self.max_samples_)))
+        return 0.5 - scores
+
+
+class IsolationTree(RandomSplitTree):
+    def __init__(self,
+                 max_depth=8,
+                 random_state=None):
+        RandomSplitTree.__init__(self,
+                                 max_depth=max_depth,
+                                 max_features=1,
+                                 random_state=random_state)
+
+    def get_splitter(self, splitter=None):
+        # the splits are chosen by IsolationTreeBuilder
+        return None
+
+    def get_builder(self, splitter, max_depth):
+        return IsolationTreeBuilder(max_depth, random_state=self.random_state)
+
+    def decision_function(self, X):
+        """Path length of X (smaller values are more anomalous)
+
+        The depth of the leaf plus the average path length of the samples
+        at the leaf, as in Isolation Forest.
+        """
+        tree = self.tree_
+        rows, nodes, path_lengths = get_tree_paths(tree.children_left, tree.children_right,
+                                                   tree.feature, tree.threshold, X)
+        leaves = np.zeros(X.shape[0], dtype=int)
+        leaves[rows] = nodes
+        return path_lengths + _average_path_lengths(tree.n_node_samples[leaves])
+
+
+class IsolationTrees(ArrIForest):
+    """Isolation Forest built with IsolationTreeBuilder instead of sklearn
+
+    Each tree is built on its own subsample of max_samples instances, to a
+    depth of ceil(log2(max_samples)) unless max_depth is set. Hence the fit
+    time depends on max_samples and not on the number of instances (unless
+    count_all_samples=True).
+    """
+    def __init__(self,
+                 n_estimators=100,
+                 max_samples="auto",
+                 max_depth=None,
+                 n_jobs=1,
+                 random_state=None,
+                 count_all_samples=False):
+        ArrIForest.__init__(self, n_estimators=n_estimators,
+                            max_samples=max_samples,
+                            n_jobs=n_jobs,
+                            random_state=random_state)
+        self.max_depth = max_depth
+        self.count_all_samples = count_all_samples
+
+    def fit(self, X, y=None, sample_weight=None):
+        return RandomSplitForest.fit(self, X, y, sample_weight=sample_weight)
+
+    def get_tree_max_depth(self):
+        if self.max_depth is not None:
+            return self.max_depth
+        return int(np.ceil(np.log2(max(self.max_samples_, 2))))
+
+    def get_fitting_function(self):
+        return isolation_tree_fit
+
+
+def isolation_tree_fit(args):
+    max_depth = args[0]
+    X = args[1]
+    random_state = args[2]
+    itree = IsolationTree(max_depth=max_depth, random_state=random_state)
+    itree.fit(X, None)
+    return itree
+
+
+def convert_isolation_forest(iforest):
+    """Returns an ArrIForest with the trees of a fitted sklearn IsolationForest
+
+    :param iforest: sklearn.ensemble.IsolationForest (or IForest)
+    :return: ArrIForest
+    """
+    forest = ArrIForest(n_estimators=len(iforest.estimators_), max_samples=iforest.max_samples,
+                        max_features=iforest.max_features, n_jobs=iforest.n_jobs,
+                        random_state=iforest.random_state)
+    forest.set_trees_from_isolation_forest(iforest)
+    return forest
+
+
 class IForest(IsolationForest, StreamingSupport):
     def __init__(self,
                  n_estimators=100,
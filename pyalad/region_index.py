@@ -0,0 +1,172 @@
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+
+"""
+Fixed-width (ELL) representation of the region features of forests which
+have only leaf regions (add_leaf_nodes_only=True).
+
+Every instance falls in exactly one leaf of each tree. Hence the region
+features have exactly one nonzero per tree in every row, and the nonzero
+for region r is d[r]. Instead of a CSR matrix (data, indices and indptr),
+only the (n, n_trees) int32 matrix of region ids is stored and the values
+are looked up in d. This is about a third of the size of the CSR matrix and
+is created without going through lil_matrix.
+
+RegionIndexMatrix supports the operations which the detectors, losses and
+optimizers use on the region features:
+
+    x.shape, x.dot(w), x.T.dot(c), x[idxs], x[idxs, :], x.sum(axis=0), x.copy()
+
+Query strategies that need general sparse algebra (e.g., kernels) get a
+CSR matrix with to_sparse_region_features().
+"""
+
+
+class RegionIndexTranspose(object):
+    """ Transpose of a RegionIndexMatrix; only supports dot() """
+    def __init__(self, x):
+        self.x = x
+        self.shape = (x.shape[1], x.shape[0])
+
+    def dot(self, c):
+        return self.x.transpose_dot(c)
+
+
+class RegionIndexMatrix(object):
+    """ Region features stored as the region id of each instance in each tree
+
+    Attributes:
+        regions: np.ndarray(dtype=np.int32)
+            regions[i, t] is the region in which instance i falls in tree t
+        d: np.array
+            region scores, i.e., the value of each region feature
+        shape: (int, int)
+            (n, m) where m = len(d) is the total number of regions
+    """
+    def __init__(self, regions, d):
+        regions = np.asarray(regions, dtype=np.int32)
+        if len(regions.shape) != 2:
+            raise ValueError("Expected 2-D matrix of region ids, found %d dimension(s)" % len(regions.shape))
+        self.regions = regions
+        self.d = d
+        self.shape = (regions.shape[0], len(d))
+        self.csr = None
+
+    @property
+    def dtype(self):
+        return self.d.dtype
+
+    @property
+    def nnz(self):
+        return self.regions.size
+
+    @property
+    def T(self):
+        return RegionIndexTranspose(self)
+
+    def get_num_trees(self):
+        return self.regions.shape[1]
+
+    def get_values(self):
+        """ Returns the (n, n_trees) matrix of feature values """
+        return self.d[self.regions]
+
+    def dot(self, w):
+        """ Same as X.dot(w) for the equivalent sparse matrix X
+
+        :param w: np.array or np.ndarray
+            vector of length m, or (m, k) matrix of k weight vectors
+        :return: np.array of shape (n,) or np.ndarray of shape (n, k)
+        """
+        w = np.asarray(w)
+        if len(w.shape) == 1:
+            dw = self.d * w
+        else:
+            dw = self.d.reshape((-1, 1)) * w
+        # the products are float64 if w is float64, even if d is float32
+        return np.take(dw, self.regions, axis=0).sum(axis=1)
+
+    def transpose_dot(self, c):
+        """ Same as X.T.dot(c) for the equivalent sparse matrix X
+
+        Since each row has a single nonzero per tree, the sum over rows is
+        a weighted count of the region ids.
+        """
+        c = np.asarray(c, dtype=float).reshape(-1)
+        if len(c) != self.shape[0]:
+            raise ValueError("dimension mismatch: %d rows, vector of length %d" % (self.shape[0], len(c)))
+        counts = np.bincount(self.regions.reshape(-1), weights=np.repeat(c, self.get_num_trees()),
+                             minlength=self.shape[1])
+        return counts * self.d
+
+    def sum(self, axis=None, dtype=None, out=None):
+        if axis is None:
+            return np.sum(self.get_values(), dtype=float)
+        elif axis == 0:
+            return self.transpose_dot(np.ones(self.shape[0], dtype=float))
+        elif axis == 1:
+            return np.sum(self.get_values(), axis=1, dtype=float)
+        else:
+            raise ValueError("axis %s out of range" % str(axis))
+
+    def __getitem__(self, key):
+        # supports row selection like x[i], x[idxs], x[idxs, :] as with csr_matrix
+        if isinstance(key, tuple):
+            if len(key) != 2 or not (isinstance(key[1], slice) and key[1] == slice(None)):
+                raise NotImplementedError("Only row indexing like [idxs] or [idxs, :] is supported")
+            key = key[0]
+        rows = self.regions[key]
+        if len(rows.shape) == 1:
+            # a single row, which stays a 1 x m matrix as with csr_matrix
+            rows = rows.reshape((1, -1))
+        return RegionIndexMatrix(rows, self.d)
+
+    def copy(self):
+        return RegionIndexMatrix(self.regions.copy(), self.d)
+
+    def tocsr(self):
+        """ Returns the equivalent csr_matrix; the result is cached """
+        if self.csr is None:
+            n, n_trees = self.regions.shape
+            x = csr_matrix((self.get_values().reshape(-1), self.regions.reshape(-1),
+                            np.arange(0, n * n_trees + 1, n_trees)), shape=self.shape)
+            x.sort_indices()
+            x.eliminate_zeros()
+            self.csr = x
+        return self.csr
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+    def __getstate__(self):
+        # the cached csr_matrix is not pickled
+        state = self.__dict__.copy()
+        state["csr"] = None
+        return state
+
+
+def is_region_index(x):
+    return isinstance(x, RegionIndexMatrix)
+
+
+def to_sparse_region_features(x):
+    """ Returns x as csr_matrix if it is a RegionIndexMatrix, else x unchanged """
+    if isinstance(x, RegionIndexMatrix):
+        return x.tocsr()
+    return x
+
+
+def vstack_region_features(blocks):
+    """ Stacks the rows of region feature matrices
+
+    RegionIndexMatrix blocks (which must share the same region scores d)
+    are stacked into a RegionIndexMatrix, other blocks with scipy vstack.
+    """
+    if len(blocks) > 0 and all([isinstance(b, RegionIndexMatrix) for b in blocks]):
+        d = blocks[0].d
+        for b in blocks[1:]:
+            if b.d is not d and not np.array_equal(b.d, d):
+                raise ValueError("Cannot stack region index matrices with different region scores")
+        return RegionIndexMatrix(np.vstack([b.regions for b in blocks]), d)
+    return vstack([to_sparse_region_features(b) for b in blocks]).tocsr()
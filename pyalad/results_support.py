@@ -1,4 +1,5 @@
 from alad_support import *
+from instrumentation import get_instrumentation
 
 
 def write_sequential_results_to_csv(results, opts):
@@ -30,6 +31,20 @@ def write_sequential_results_to_csv(results, opts):
         np.savetxt(stream_window_baseline_file, results.stream_window_baseline, fmt='%d', delimiter=',')
     if results.aucs is not None:
         np.savetxt(aucs_file, results.aucs, fmt='%f', delimiter=',')
+    write_instrumentation_report(opts)
+
+
+def write_instrumentation_report(opts):
+    """ Writes the stage timings and counters if --instrument is set """
+    instr = get_instrumentation()
+    if not instr.enabled or opts.instrument == "":
+        return
+    prefix = opts.get_alad_metrics_name_prefix()
+    stages_file = os.path.join(opts.resultsdir, "%s-stages.%s" % (prefix, opts.instrument))
+    if opts.instrument == "json":
+        instr.write_json(stages_file)
+    else:
+        instr.write_csv(stages_file)
 
 
 def summarize_alad_to_csv(samples=None, ensembles=None, metrics=None, opts=None):
@@ -85,6 +85,30 @@ def test_get_gp_train_test():
     print("train:\n%s\ntest:\n%s" % (str(list(train)), str(list(test))))
 
 
+def test_gp_train_state():
+    rnd = np.random.RandomState(42)
+    x = rnd.uniform(0, 1, (120, 5))
+    state = GPTrainState(length_scale=20., noise=0.005)
+    K_all = kernel(x, x, length_scale=state.length_scale)
+    train = np.arange(50)
+    queried = np.zeros(0, dtype=int)
+    for i in range(10):
+        if i % 2 == 0:
+            # regular train points drawn afresh as in get_gp_train_test()
+            train = np.append(rnd.choice(np.arange(60, 120), 40, replace=False), queried)
+        else:
+            # a new query appends one point
+            queried = np.append(queried, i)
+            train = np.append(train, i)
+        factor_train, L = state.update(x, train)
+        assert np.array_equal(np.sort(factor_train), np.sort(train))
+        L_full = np.linalg.cholesky(K_all[factor_train][:, factor_train] +
+                                    state.noise * np.eye(len(factor_train)))
+        assert np.allclose(L, L_full, atol=1e-10)
+    assert state.n_incremental == 5
+    print("GPTrainState: ok, refactored %d times" % state.n_refactor)
+
+
 def test_sparse_variance():
     x_tmp = lil_matrix((2, 5), dtype=float)
     x_tmp[0, 2] = 1
@@ -114,5 +138,6 @@ def test_sparse_variance():
 if __name__ == '__main__':
     # plot_beta_explore_exploit(a=1., b=1., budget=60)
     test_thompson()
+    test_gp_train_state()
     # test_get_gp_train_test()
     # test_sparse_variance()
@@ -0,0 +1,47 @@
+import numpy as np
+
+import logging
+from app_globals import *
+
+from r_support import *
+
+from query_search import *
+
+"""
+python pyalad/test_query_search.py --log_file=./temp/query_search.log --debug
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def test_search_n_jobs(rnd, opts):
+    """ The lookahead search returns the same query for any number of processes """
+    opts = copy(opts)
+    opts.budget = 10
+    opts.query_search_candidates = 3
+    n = 100
+    x = rnd.uniform(0, 1, (n, 8))
+    w = np.ones(x.shape[1]) / np.sqrt(x.shape[1])
+    lbls = np.zeros(n, dtype=int)
+    lbls[0:5] = 1
+    hf = np.array([0, 7], dtype=int)
+    results = []
+    for n_jobs in [1, 1, 2]:
+        search = QueryLookaheadSearch(x, opts, n_jobs=n_jobs)
+        # remaining budget close to the budget, so that the candidates explore
+        results.append(search.search(lbls, w, hf, remaining_budget=9, k=2))
+    for best in results[1:]:
+        assert best.action == results[0].action
+        assert np.isclose(best.value, results[0].value)
+    logger.debug("search n_jobs: ok, query: %d" % results[0].action)
+
+
+args = get_command_args(debug=False)
+configure_logger(args)
+
+opts = Opts(args)
+rnd = np.random.RandomState(args.randseed)
+
+test_search_n_jobs(rnd, opts)
+
+logger.debug("test completed...")
@@ -1,5 +1,10 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 from numpy import random
+from scipy.sparse import csr_matrix, csc_matrix
+from sklearn.ensemble import IsolationForest
 
 import logging
 
@@ -7,9 +12,379 @@ from app_globals import *
 
 from random_split_trees import *
 from forest_aad_detector import *
+from aad_scoring import *
 
 logger = logging.getLogger(__name__)
 
+
+def test_model_arrays_round_trip(rnd):
+    """ A model saved with save_aad_model_arrays and loaded with load_aad_model scores the same """
+    X = rnd.uniform(0, 1, (200, 4))
+    X_new = rnd.uniform(0, 1, (50, 4))
+    for detector_type, score_type in [(AAD_IFOREST, IFOR_SCORE_TYPE_NEG_PATH_LEN),
+                                      (AAD_HSTREES, HST_SCORE_TYPE)]:
+        mdl = AadForest(n_estimators=5, max_samples=64, max_depth=6, score_type=score_type,
+                        random_state=np.random.RandomState(rnd.randint(10000)),
+                        add_leaf_nodes_only=True, detector_type=detector_type)
+        mdl.fit(X)
+        dirpath = tempfile.mkdtemp()
+        try:
+            save_aad_model_arrays(dirpath, mdl)
+            # copy-on-write since the loaded trees are updated from the stream below
+            mdl_loaded = load_aad_model(dirpath, mmap_mode='c')
+            x = mdl.transform_to_region_features(X, dense=False)
+            x_loaded = mdl_loaded.transform_to_region_features(X, dense=False)
+            assert np.allclose(x.toarray(), x_loaded.toarray())
+            assert np.allclose(mdl.get_score(x), mdl_loaded.get_score(x_loaded))
+            if detector_type == AAD_HSTREES:
+                for m in [mdl, mdl_loaded]:
+                    m.add_samples(X_new, current=False)
+                    m.update_model_from_stream_buffer()
+                assert np.allclose(mdl.d, mdl_loaded.d)
+                assert np.allclose(mdl.get_score(mdl.transform_to_region_features(X_new, dense=False)),
+                                   mdl_loaded.get_score(mdl_loaded.transform_to_region_features(X_new, dense=False)))
+        finally:
+            shutil.rmtree(dirpath)
+    logger.debug("model arrays round trip: ok")
+
+
+def test_old_model_pickle(rnd, opts):
+    """ A model pickled before the compact, region index, tenant and count_all_samples
+    attributes were added loads with their defaults and its weights can be updated """
+    X = rnd.uniform(0, 1, (200, 4))
+    mdl = AadForest(n_estimators=5, max_samples=64, max_depth=6, score_type=HST_SCORE_TYPE,
+                    random_state=np.random.RandomState(rnd.randint(10000)),
+                    detector_type=AAD_HSTREES)
+    mdl.fit(X)
+    for name in ["compact", "count_all_samples", "node_region_lookups", "tenant_names", "W"]:
+        del mdl.__dict__[name]
+    for estimator in mdl.clf.estimators_:
+        del estimator.tree_.__dict__["is_compact"]
+    dirpath = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(dirpath, "model.pydata")
+        save_aad_model(filepath, mdl)
+        mdl_loaded = load_aad_model(filepath)
+    finally:
+        shutil.rmtree(dirpath)
+    assert not mdl_loaded.compact and not mdl_loaded.count_all_samples
+    assert mdl_loaded.tenant_names == [] and mdl_loaded.W is None
+    assert not mdl_loaded.clf.estimators_[0].tree_.is_compact
+    opts = copy(opts)
+    opts.detector_type = AAD_HSTREES
+    x = mdl_loaded.transform_to_region_features(X, dense=False)
+    ordered = np.argsort(-mdl_loaded.get_score(x))
+    mdl_loaded.update_weights(x, np.zeros(X.shape[0], dtype=int),
+                              ha=np.zeros(0, dtype=int), hn=ordered[0:5], opts=opts)
+    assert mdl_loaded.w.shape[0] == x.shape[1] and mdl_loaded.w.dtype == float
+    logger.debug("old model pickle: ok")
+
+
+def test_compact_model(rnd):
+    """ A compact model scores the same as the full precision model up to float32 round-off
+
+    The tolerance is the one documented in AadForest (relative difference of
+    about 1e-6). Isolation trees are used since HS trees might split within
+    float32 round-off of an instance (see AadForest).
+    """
+    X = rnd.uniform(0, 1, (300, 4))
+    seed = rnd.randint(10000)
+    mdls = []
+    for compact in [False, True]:
+        mdl = AadForest(n_estimators=20, max_samples=128, score_type=IFOR_SCORE_TYPE_NEG_PATH_LEN,
+                        random_state=np.random.RandomState(seed), add_leaf_nodes_only=True,
+                        detector_type=AAD_IFOREST, compact=compact)
+        mdl.fit(X)
+        mdls.append(mdl)
+    mdl, mdl_compact = mdls
+    for estimator in mdl_compact.clf.estimators_:
+        tree = estimator.tree_
+        assert tree.children_left.dtype == np.int32 and tree.children_right.dtype == np.int32
+        assert tree.feature.dtype == np.int32
+        assert tree.threshold.dtype == np.float32
+    assert mdl_compact.d.dtype == np.float32 and mdl_compact.w.dtype == np.float32
+    assert mdl.d.dtype == np.float64 and mdl.w.dtype == np.float64
+    x = mdl.transform_to_region_features(X, dense=False)
+    x_compact = mdl_compact.transform_to_region_features(X, dense=False)
+    assert x_compact.dtype == np.float32
+    scores = mdl.get_score(x)
+    scores_compact = mdl_compact.get_score(x_compact)
+    assert np.allclose(scores_compact, scores, rtol=1e-6, atol=0)
+    logger.debug("compact model: ok, max relative difference: %g" %
+                 np.max(np.abs(scores_compact - scores) / np.abs(scores)))
+
+
+def test_region_index_matrix(rnd):
+    """ RegionIndexMatrix operations and the loss gradients agree with the CSR region features """
+    X = rnd.uniform(0, 1, (200, 4))
+    mdl = AadForest(n_estimators=10, max_samples=64, score_type=IFOR_SCORE_TYPE_NEG_PATH_LEN,
+                    random_state=np.random.RandomState(rnd.randint(10000)),
+                    add_leaf_nodes_only=True, detector_type=AAD_IFOREST)
+    mdl.fit(X)
+    x_idx = mdl.transform_to_region_index(X)
+    x_csr = mdl.transform_to_region_features(X, dense=False)
+    m = len(mdl.d)
+    assert x_idx.shape == x_csr.shape
+    assert np.allclose(x_idx.toarray(), x_csr.toarray())
+
+    w = rnd.uniform(0, 1, m)
+    W = rnd.uniform(0, 1, (m, 3))
+    c = rnd.uniform(-1, 1, X.shape[0])
+    assert np.allclose(x_idx.dot(w), x_csr.dot(w))
+    assert np.allclose(x_idx.dot(W), x_csr.dot(W))
+    assert np.allclose(x_idx.T.dot(c), x_csr.T.dot(c))
+    assert np.allclose(x_idx.sum(axis=0), np.asarray(x_csr.sum(axis=0)).reshape(-1))
+
+    idxs = rnd.choice(X.shape[0], 20, replace=False)
+    assert np.allclose(x_idx[idxs].toarray(), x_csr[idxs].toarray())
+    assert np.allclose(x_idx[idxs, :].toarray(), x_csr[idxs, :].toarray())
+    assert x_idx[idxs[0]].shape == (1, m)
+    assert np.allclose(x_idx[idxs[0]].toarray(), x_csr[idxs[0]].toarray())
+
+    # labeled instances and the tau-th ranked instance as in the weight updates
+    yi = np.zeros(len(idxs), dtype=int)
+    yi[0:8] = 1
+    qval = np.percentile(x_csr.dot(w), 50)
+    x_tau = x_csr[[idxs[-1]]]
+    x_tau_idx = x_idx[[idxs[-1]]]
+    for loss_gradient in [forest_aad_loss_gradient_linear, forest_aad_loss_gradient_exp]:
+        grad_csr = loss_gradient(w, x_csr[idxs], yi, qval, x_tau=x_tau, Ca=1., Cn=1., Cx=0.5)
+        grad_idx = loss_gradient(w, x_idx[idxs], yi, qval, x_tau=x_tau_idx, Ca=1., Cn=1., Cx=0.5)
+        grad_dense = loss_gradient(w, x_csr[idxs].toarray(), yi, qval, x_tau=x_tau.toarray(),
+                                   Ca=1., Cn=1., Cx=0.5)
+        assert np.allclose(grad_idx, grad_csr)
+        assert np.allclose(grad_dense, grad_csr)
+    logger.debug("region index matrix: ok")
+
+
+def get_tree_path_loop(tree, x):
+    """ Returns the nodes from root to leaf of the dense instance x, one node at a time """
+    path = [0]
+    node = 0
+    while tree.children_left[node] != -1:
+        if x[tree.feature[node]] <= tree.threshold[node]:
+            node = tree.children_left[node]
+        else:
+            node = tree.children_right[node]
+        path.append(node)
+    return path
+
+
+def test_arr_tree_traversal(rnd):
+    """ ArrTree.apply and add_samples (vectorized) agree with traversing one instance at a time """
+    X = rnd.uniform(0, 1, (200, 5))
+    forest = IsolationTrees(n_estimators=3, max_samples=64, random_state=np.random.RandomState(rnd.randint(10000)))
+    forest.fit(X)
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        paths = [get_tree_path_loop(tree, X[i, :]) for i in range(X.shape[0])]
+        nodeinds_loop = np.zeros((X.shape[0], n_nodes), dtype=float)
+        counts_loop = np.zeros(n_nodes, dtype=float)
+        for i, path in enumerate(paths):
+            nodeinds_loop[i, path] = 1
+            counts_loop[path] += 1
+        leaves_loop = np.array([path[-1] for path in paths], dtype=int)
+
+        assert np.array_equal(tree.apply(X, getleaves=True), leaves_loop)
+        leaves, nodeinds = tree.apply(X, getleaves=True, getnodeinds=True)
+        assert np.array_equal(leaves, leaves_loop)
+        assert np.array_equal(nodeinds.toarray(), nodeinds_loop)
+
+        buffer_before = np.array(tree.n_node_samples_buffer[0:n_nodes])
+        tree.add_samples(X, current=False)
+        assert np.allclose(tree.n_node_samples_buffer[0:n_nodes] - buffer_before, counts_loop)
+    logger.debug("ArrTree traversal: ok")
+
+
+def test_arr_iforest(rnd):
+    """ Trees converted from sklearn IsolationForest have the same leaves, counts and scores """
+    # values which float32 represents exactly, since sklearn traverses its trees in float32
+    X = rnd.uniform(0, 1, (300, 5)).astype(np.float32).astype(float)
+    iforest = IsolationForest(n_estimators=10, max_samples=64, max_features=0.6,
+                              random_state=np.random.RandomState(rnd.randint(10000)))
+    iforest.fit(X)
+    arr_iforest = convert_isolation_forest(iforest)
+    assert arr_iforest.max_samples_ == iforest.max_samples_
+    for sk_tree, features, estimator in zip(iforest.estimators_, iforest.estimators_features_,
+                                            arr_iforest.estimators_):
+        tree = estimator.tree_
+        assert tree.node_count == sk_tree.tree_.node_count
+        assert np.allclose(tree.n_node_samples, sk_tree.tree_.n_node_samples)
+        assert np.array_equal(tree.apply(X), sk_tree.apply(X[:, features]))
+    assert np.allclose(arr_iforest.decision_function(X), iforest.decision_function(X))
+    logger.debug("ArrIForest: ok")
+
+
+def test_isolation_tree_builder(rnd):
+    """ The node counts from the partitions of the builder are the counts of X through the tree """
+    X = rnd.uniform(0, 1, (300, 5)) * (rnd.uniform(0, 1, (300, 5)) < 0.5)
+    for x in [X, csr_matrix(X)]:
+        tree = ArrTree(X.shape[1])
+        IsolationTreeBuilder(max_depth=6, random_state=np.random.RandomState(rnd.randint(10000))).build(tree, x)
+        leaves, nodeinds = tree.apply(x, getleaves=True, getnodeinds=True)
+        assert np.allclose(tree.n_node_samples[0:tree.node_count], np.asarray(nodeinds.sum(axis=0)).reshape(-1))
+        depths = np.asarray(nodeinds.sum(axis=1)).reshape(-1) - 1
+        assert tree.max_depth == np.max(depths) and tree.max_depth <= 6
+        # a leaf above the max depth is reached only when all its instances are the same
+        for leaf in np.unique(leaves[depths < 6]):
+            rows = X[leaves == leaf]
+            assert np.all(rows == rows[0])
+    logger.debug("isolation tree builder: ok")
+
+
+def test_count_all_samples(rnd):
+    """ With count_all_samples, the node counts of each tree are on all the training instances """
+    X = rnd.uniform(0, 1, (300, 4))
+    for detector_type, score_type in [(AAD_IFOREST, IFOR_SCORE_TYPE_NEG_PATH_LEN),
+                                      (AAD_HSTREES, HST_SCORE_TYPE),
+                                      (AAD_RSFOREST, RSF_SCORE_TYPE)]:
+        for count_all_samples in [False, True]:
+            mdl = AadForest(n_estimators=3, max_samples=64, max_depth=6, detector_type=detector_type,
+                            score_type=score_type, random_state=np.random.RandomState(rnd.randint(10000)),
+                            count_all_samples=count_all_samples)
+            mdl.fit(X)
+            n_root = X.shape[0] if count_all_samples else 64
+            for estimator in mdl.clf.estimators_:
+                assert estimator.tree_.n_node_samples[0] == n_root
+    logger.debug("count all samples: ok")
+
+
+def test_sparse_traversal(rnd):
+    """ Dense, CSR and CSC instances go to the same nodes and get the same scores """
+    # mostly zeros, so that the sparse matrices store only a few of the values
+    X = rnd.uniform(0, 1, (200, 6)) * (rnd.uniform(0, 1, (200, 6)) < 0.3)
+    inputs = [X, csr_matrix(X), csc_matrix(X)]
+
+    forest = IsolationTrees(n_estimators=3, max_samples=64, random_state=np.random.RandomState(rnd.randint(10000)))
+    forest.fit(X)
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        leaves_dense, nodeinds_dense = tree.apply(X, getleaves=True, getnodeinds=True)
+        buffer_before = np.array(tree.n_node_samples_buffer[0:n_nodes])
+        tree.add_samples(X, current=False)
+        counts_dense = tree.n_node_samples_buffer[0:n_nodes] - buffer_before
+        for x in inputs[1:]:
+            assert np.array_equal(tree.apply(x), leaves_dense)
+            leaves, nodeinds = tree.apply(x, getleaves=True, getnodeinds=True)
+            assert np.array_equal(leaves, leaves_dense)
+            assert np.array_equal(nodeinds.toarray(), nodeinds_dense.toarray())
+            buffer_before = np.array(tree.n_node_samples_buffer[0:n_nodes])
+            tree.add_samples(x, current=False)
+            assert np.allclose(tree.n_node_samples_buffer[0:n_nodes] - buffer_before, counts_dense)
+    scores_dense = forest.decision_function(X)
+    for x in inputs[1:]:
+        assert np.allclose(forest.decision_function(x), scores_dense)
+
+    mdl = AadForest(n_estimators=5, max_samples=64, score_type=IFOR_SCORE_TYPE_NEG_PATH_LEN,
+                    random_state=np.random.RandomState(rnd.randint(10000)), detector_type=AAD_IFOREST)
+    mdl.fit(X)
+    x_dense = mdl.transform_to_region_features(X, dense=False)
+    for x in inputs[1:]:
+        x_sparse = mdl.transform_to_region_features(x, dense=False)
+        assert np.allclose(x_sparse.toarray(), x_dense.toarray())
+        assert np.allclose(mdl.get_score(x_sparse), mdl.get_score(x_dense))
+    logger.debug("sparse traversal: ok")
+
+def test_tenant_weights(rnd, opts):
+    """ A tenant update changes only the tenant's column of W, and score_tenants
+    scores as get_score with each tenant's weights, with the region index
+    (leaf regions only) as well as with the CSR region features """
+    X = rnd.uniform(0, 1, (200, 4))
+    opts = copy(opts)
+    opts.detector_type = AAD_IFOREST
+    names = ["a", "b", "c"]
+    for add_leaf_nodes_only in [True, False]:
+        mdl = AadForest(n_estimators=10, max_samples=64, score_type=IFOR_SCORE_TYPE_NEG_PATH_LEN,
+                        random_state=np.random.RandomState(rnd.randint(10000)),
+                        add_leaf_nodes_only=add_leaf_nodes_only, detector_type=AAD_IFOREST)
+        mdl.fit(X)
+        for name in names:
+            w = rnd.uniform(0, 1, len(mdl.d))
+            mdl.add_tenant_weights(name, w / np.sqrt(w.dot(w)))
+        x = mdl.transform_to_region_features(X, dense=False)
+        W_before = np.array(mdl.W)
+        ordered = np.argsort(-mdl.get_score(x, mdl.get_tenant_weights("b")))
+        y = np.zeros(X.shape[0], dtype=int)
+        y[ordered[0:2]] = 1
+        ha, hn = ordered[0:2], ordered[2:5]
+        mdl.update_tenant_weights("b", x, y, ha=ha, hn=hn, opts=opts)
+        j = mdl.get_tenant_index("b")
+        w_b = mdl.get_updated_weights(x, y, ha, hn, opts, w=W_before[:, j])
+        assert np.allclose(mdl.W[:, j], w_b)
+        assert not np.allclose(mdl.W[:, j], W_before[:, j])
+        others = [k for k in range(len(names)) if k != j]
+        assert np.array_equal(mdl.W[:, others], W_before[:, others])
+
+        if add_leaf_nodes_only:
+            x_new = mdl.transform_to_region_index(X)
+            assert isinstance(x_new, RegionIndexMatrix)
+        else:
+            x_new = x
+        scores, top = mdl.score_tenants(X, topK=5)
+        for name in names:
+            s = mdl.get_score(x_new, mdl.get_tenant_weights(name))
+            assert np.allclose(scores[name], s)
+            assert np.allclose(s[top[name]], np.sort(s)[::-1][0:5])
+        scores, _ = mdl.score_tenants(X, tenants=["c", "a"])
+        assert sorted(scores.keys()) == ["a", "c"]
+        assert np.allclose(scores["c"], mdl.get_score(x_new, mdl.get_tenant_weights("c")))
+    logger.debug("tenant weights: ok")
+
+def test_topk_selector(rnd):
+    """ TopKSelector selects the same rows as a full sort, for any chunking """
+    scores = rnd.normal(0, 1, 1000)
+    ordered = np.argsort(-scores)
+    for k in [0, 1, 10, 1000, 1500]:
+        for chunk_size in [1, 7, 100, 1000]:
+            selector = TopKSelector(k)
+            for start in range(0, len(scores), chunk_size):
+                selector.add(scores[start:(start + chunk_size)], start=start)
+            ids, top_scores = selector.get_top()
+            assert np.array_equal(ids, ordered[0:k])
+            assert np.array_equal(top_scores, scores[ordered[0:k]])
+    # explicit row ids
+    ids = rnd.permutation(len(scores)) + 5000
+    selector = TopKSelector(20)
+    selector.add(scores[0:600], ids=ids[0:600])
+    selector.add(scores[600:], ids=ids[600:])
+    assert np.array_equal(selector.get_top()[0], ids[ordered[0:20]])
+    logger.debug("TopKSelector: ok")
+
+
+def test_score_in_chunks(rnd):
+    """ The memmap scores and the top rows of score_in_chunks are the same as
+    scoring all rows together, with AadForest and with AadScoringModel """
+    X = rnd.uniform(0, 1, (500, 4))
+    k = 15
+    dirpath = tempfile.mkdtemp()
+    try:
+        for add_leaf_nodes_only in [True, False]:
+            mdl = AadForest(n_estimators=10, max_samples=64, score_type=IFOR_SCORE_TYPE_NEG_PATH_LEN,
+                            random_state=np.random.RandomState(rnd.randint(10000)),
+                            add_leaf_nodes_only=add_leaf_nodes_only, detector_type=AAD_IFOREST)
+            mdl.fit(X)
+            expected = mdl.get_score(mdl.transform_to_region_features(X, dense=False))
+            ordered = np.argsort(-expected)
+            modeldir = os.path.join(dirpath, "model")
+            save_aad_model_arrays(modeldir, mdl)
+            for model in [mdl, load_aad_scoring_model(modeldir)]:
+                scores_path = os.path.join(dirpath, "scores.bin")
+                scores, top_ids, top_scores = score_in_chunks(model, iter_array_chunks(X, chunk_size=64),
+                                                              topK=k, scores_path=scores_path)
+                assert isinstance(scores, np.memmap) and scores.shape == (X.shape[0],)
+                assert np.allclose(scores, expected)
+                # forest scores have ties, hence the ids are compared through their scores
+                assert len(np.unique(top_ids)) == k
+                assert np.allclose(top_scores, expected[ordered[0:k]])
+                assert np.allclose(expected[top_ids], top_scores)
+                del scores
+            shutil.rmtree(modeldir)
+    finally:
+        shutil.rmtree(dirpath)
+    logger.debug("score in chunks: ok")
+
 args = get_command_args(debug=False)
 # print "log file: %s" % args.log_file
 configure_logger(args)
@@ -94,4 +469,17 @@ endtime = timer()
 tdiff = difftime(endtime, starttime, units="secs")
 logger.debug("Completed in %f sec(s)" % (tdiff))
 
+test_model_arrays_round_trip(rnd)
+test_old_model_pickle(rnd, Opts(args))
+test_compact_model(rnd)
+test_region_index_matrix(rnd)
+test_arr_tree_traversal(rnd)
+test_arr_iforest(rnd)
+test_isolation_tree_builder(rnd)
+test_count_all_samples(rnd)
+test_sparse_traversal(rnd)
+test_tenant_weights(rnd, Opts(args))
+test_topk_selector(rnd)
+test_score_in_chunks(rnd)
+
 logger.debug("test completed...")
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 import scipy as sp
 
@@ -17,6 +20,50 @@ python pyalad/test_stream.py --log_file=./temp/stream.log --debug
 
 logger = logging.getLogger(__name__)
 
+
+def read_all(stream, n=3):
+    xs = []
+    ys = []
+    while not stream.empty():
+        x, y = stream.read_next_from_stream(n)
+        xs.append(x)
+        if y is not None:
+            ys.append(y)
+    stream.close()
+    return np.vstack(xs), np.concatenate(ys) if len(ys) > 0 else None
+
+
+def test_stream_sources(rnd):
+    """ The csv, pipe and npy sources read the same instances and labels """
+    dirpath = tempfile.mkdtemp()
+    try:
+        X = np.round(rnd.uniform(0, 1, (10, 3)), 4)
+        y = np.array([1, 0, 0, 1, 0, 0, 0, 0, 1, 0], dtype=int)
+        csvpath = os.path.join(dirpath, "data.csv")
+        # same format as the data files in the repo: header and label in the first column
+        with open(csvpath, 'w') as f:
+            f.write("label,x1,x2,x3\n")
+            for i in range(X.shape[0]):
+                f.write("%s,%s\n" % ("anomaly" if y[i] == 1 else "nominal", ",".join([str(v) for v in X[i]])))
+        for source in ["csv", "pipe"]:
+            stream = get_data_stream(csvpath, source=source, chunk_size=4)
+            x_read, y_read = read_all(stream)
+            assert np.allclose(x_read, X) and np.array_equal(y_read, y)
+            if source == "pipe":
+                assert stream.f.closed
+
+        npypath = os.path.join(dirpath, "data.npy")
+        np.save(npypath, X)
+        x_read, y_read = read_all(get_data_stream(npypath, label_index=None))
+        assert np.allclose(x_read, X) and y_read is None
+        np.save(npypath, np.hstack([y.reshape(-1, 1), X]))
+        x_read, y_read = read_all(get_data_stream(npypath))
+        assert np.allclose(x_read, X) and np.array_equal(y_read, y)
+    finally:
+        shutil.rmtree(dirpath)
+    logger.debug("stream sources: ok")
+
+
 args = get_command_args(debug=False)
 # print "log file: %s" % args.log_file
 configure_logger(args)
@@ -37,4 +84,6 @@ while not ds.empty():
     insts = ds.read_next_from_stream(2)
     logger.debug("%03d:\n%s" % (i, str(insts)))
 tm.message("Completed in")
+
+test_stream_sources(rnd)
 logger.debug("test completed...")
@@ -0,0 +1,98 @@
+import numpy as np
+import os
+import tempfile
+import shutil
+import cPickle as pickle
+
+import logging
+from app_globals import *
+
+from r_support import *
+
+from weight_history import *
+from alad_support import get_weight_history
+
+"""
+python pyalad/test_weight_history.py --log_file=./temp/weight_history.log --debug
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def get_weight_sequence(rnd, m, n):
+    """ Weights which change by small updates, as in the feedback iterations """
+    ws = []
+    w = rnd.uniform(-1, 1, m)
+    for i in range(n):
+        w = w + 0.01 * rnd.normal(0, 1, m)
+        # some updates leave most weights unchanged
+        w[rnd.uniform(0, 1, m) < 0.3] = 0
+        ws.append(w / np.sqrt(w.dot(w)))
+    return ws
+
+
+def check_weight_history(wh, ws, rnd):
+    """ Every record decodes to exactly the float32 weights, in any order """
+    assert len(wh) == len(ws)
+    order = list(range(len(ws))) + list(rnd.permutation(len(ws))) + [len(ws) - 1, 0, 0]
+    for i in order:
+        w_i = np.float32(ws[i])
+        assert np.array_equal(wh[i], w_i)
+        assert np.array_equal(wh[i, :], w_i)
+    assert np.array_equal(wh[-1], np.float32(ws[-1]))
+    assert np.array_equal(wh.to_array(), np.array(ws, dtype=np.float32))
+    for w, w_i in zip(wh, ws):
+        assert np.array_equal(w, np.float32(w_i))
+
+
+def test_weight_history(rnd, tmpdir):
+    m = 60
+    ws = get_weight_sequence(rnd, m, 47)
+    for filepath in [None, os.path.join(tmpdir, "weights.bin")]:
+        wh = WeightHistory(m, filepath=filepath, keyframe_interval=10)
+        for w in ws:
+            wh.append(w)
+        check_weight_history(wh, ws, rnd)
+
+        # pickling keeps the records (or the file offsets) but not the decode cache
+        wh_copy = pickle.loads(pickle.dumps(wh, protocol=pickle.HIGHEST_PROTOCOL))
+        check_weight_history(wh_copy, ws, rnd)
+        wh_copy.close()
+        wh.close()
+        logger.debug("weight history (%s): ok" % ("memory" if filepath is None else "file",))
+
+
+def test_weight_history_paths(rnd, opts, tmpdir):
+    """ A second history for the same run must not invalidate the first """
+    opts = copy(opts)
+    opts.resultsdir = tmpdir
+    opts.weights_history_to_file = True
+    m = 20
+    whs = []
+    for k in range(2):
+        ws = get_weight_sequence(rnd, m, 5)
+        wh = get_weight_history(m, opts)
+        for w in ws:
+            wh.append(w)
+        whs.append((wh, ws))
+    assert whs[0][0].filepath != whs[1][0].filepath
+    for wh, ws in whs:
+        check_weight_history(wh, ws, rnd)
+        wh.close()
+    logger.debug("weight history paths: ok")
+
+
+args = get_command_args(debug=False)
+configure_logger(args)
+
+opts = Opts(args)
+rnd = np.random.RandomState(args.randseed)
+
+tmpdir = tempfile.mkdtemp()
+try:
+    test_weight_history(rnd, tmpdir)
+    test_weight_history_paths(rnd, opts, tmpdir)
+finally:
+    shutil.rmtree(tmpdir)
+
+logger.debug("test completed...")
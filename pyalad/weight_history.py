@@ -0,0 +1,169 @@
+import os
+import zlib
+import numpy as np
+
+import logging
+
+
+"""
+Compact storage for the weight vectors learned in each feedback iteration.
+
+The weights of forest detectors have one entry per region, hence keeping
+a dense (budget x m) float64 matrix of all iterations needs a lot of memory.
+WeightHistory stores each iteration as float32, encoded as the bitwise
+difference (XOR) from the previous iteration, and compressed with zlib.
+The encoding is lossless w.r.t. the float32 values. Every keyframe_interval
+iterations the full vector is encoded instead so that any single iteration
+can be decoded without reading all the earlier ones.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class WeightHistory(object):
+    """ Append-only store of per-iteration weight vectors
+
+    Usage:
+        wh = WeightHistory(m)
+        wh.append(w)   # in each iteration
+        w_i = wh[i]    # or wh[i, :], returns a float32 vector
+
+    Attributes:
+        m: int
+            length of each weight vector
+        filepath: str
+            if not None, the compressed records are appended to this file
+            and read back on access; else they are kept in memory. The file
+            is truncated when the WeightHistory is created, hence it must
+            not be shared with another WeightHistory that is still in use.
+        keyframe_interval: int
+        compresslevel: int
+            zlib compression level
+        offsets: list of int
+            start of each record in the file (only when filepath is not None)
+        sizes: list of int
+            number of compressed bytes of each record
+    """
+    def __init__(self, m, filepath=None, keyframe_interval=20, compresslevel=6):
+        self.m = m
+        self.filepath = filepath
+        self.keyframe_interval = keyframe_interval
+        self.compresslevel = compresslevel
+        self.offsets = []
+        self.sizes = []
+        self.records = None if filepath is not None else []
+        self.last_bits = None
+        self.fh = None
+        self.cached_index = -1
+        self.cached_bits = None
+        if filepath is not None:
+            # truncate any earlier file; records are appended as they arrive
+            open(filepath, 'wb').close()
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @property
+    def shape(self):
+        return len(self), self.m
+
+    def is_keyframe(self, i):
+        return i % self.keyframe_interval == 0
+
+    def append(self, w):
+        if len(w) != self.m:
+            raise ValueError("Expected weight vector of length %d, found %d" % (self.m, len(w)))
+        bits = np.asarray(w, dtype=np.float32).view(np.uint32)
+        i = len(self)
+        if self.is_keyframe(i):
+            delta = bits
+        else:
+            delta = np.bitwise_xor(bits, self.last_bits)
+        record = zlib.compress(delta.tobytes(), self.compresslevel)
+        if self.filepath is None:
+            self.records.append(record)
+            self.offsets.append(0)
+        else:
+            self._close_reader()
+            with open(self.filepath, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                self.offsets.append(f.tell())
+                f.write(record)
+        self.sizes.append(len(record))
+        self.last_bits = bits.copy()
+
+    def _read_record(self, i):
+        if self.filepath is None:
+            record = self.records[i]
+        else:
+            if self.fh is None:
+                self.fh = open(self.filepath, 'rb')
+            self.fh.seek(self.offsets[i])
+            record = self.fh.read(self.sizes[i])
+        return np.frombuffer(zlib.decompress(record), dtype=np.uint32)
+
+    def _close_reader(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def get_weights(self, i):
+        """ Decodes the weights of iteration i
+
+        Decoding starts from the closest keyframe at or before i, or from
+        the last decoded iteration if that is closer, so that sequential
+        access decodes every record only once.
+        """
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("iteration %d out of range [0, %d)" % (i, n))
+        start = i - (i % self.keyframe_interval)
+        if start <= self.cached_index <= i:
+            bits = self.cached_bits.copy()
+            start = self.cached_index + 1
+        else:
+            bits = None
+        for j in range(start, i + 1):
+            delta = self._read_record(j)
+            if bits is None:
+                bits = delta.copy()
+            else:
+                np.bitwise_xor(bits, delta, out=bits)
+        self.cached_index = i
+        self.cached_bits = bits
+        return bits.copy().view(np.float32)
+
+    def __getitem__(self, key):
+        # supports wh[i] and wh[i, :] as with the dense matrix used earlier
+        if isinstance(key, tuple):
+            if len(key) != 2 or key[1] != slice(None):
+                raise NotImplementedError("Only indexing like [i] or [i, :] is supported")
+            key = key[0]
+        return self.get_weights(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_weights(i)
+
+    def to_array(self):
+        w = np.zeros(shape=self.shape, dtype=np.float32)
+        for i, wi in enumerate(self):
+            w[i, :] = wi
+        return w
+
+    def get_nbytes(self):
+        """ Returns the total size of the compressed records """
+        return sum(self.sizes)
+
+    def close(self):
+        self._close_reader()
+
+    def __getstate__(self):
+        # file handles and decode caches are not pickled
+        state = self.__dict__.copy()
+        state["fh"] = None
+        state["cached_index"] = -1
+        state["cached_bits"] = None
+        return state